@@ -0,0 +1,397 @@
+import asyncio
+import functools
+import hashlib
+import os
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+
+# Client library for the API. Client keeps one pooled requests.Session for all
+# calls; AsyncClient exposes the same methods as coroutines. Requests answered
+# with 429 or 503 (a full job backlog, an overloaded server) are retried with
+# exponential backoff and jitter, honouring Retry-After. Bulk helpers run
+# uploads and inference with at most ``concurrency`` requests in flight.
+#
+#     with Client('http://localhost:8000/api') as client:
+#         project = client.create_project('alice', 'Image Classification', 'Cats')
+#         client.upload_images(project['project_id'], ['cat.png', ('dog.png', 'dog')])
+#         client.wait_for_job(client.enqueue_training(project['project_id'])['job_id'])
+
+DEFAULT_BASE_URL = 'http://localhost:8000/api'
+RETRY_STATUSES = {429, 503}
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'PUT', 'DELETE'}  # Also retried after connection errors
+FINISHED_STATUSES = {'done', 'failed'}
+ITERATOR_METHODS = {'paginate', 'user_projects', 'project_images', 'training_progress'}  # Lists in AsyncClient
+
+
+class ApiError(Exception):
+    """A response with an error status; ``payload`` is its JSON body when it has one."""
+
+    def __init__(self, status, payload, method, url):
+        self.status = status
+        self.payload = payload
+        message = payload.get('error') if isinstance(payload, dict) else None
+        super().__init__(f'{method} {url} returned {status}: {message or payload}')
+
+
+class JobFailed(Exception):
+    def __init__(self, job):
+        self.job = job
+        super().__init__(f"Job {job['job_id']} failed: {job.get('error')}")
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def backoff_delay(attempt, base, cap, retry_after=None):
+    """Seconds to wait before retry number ``attempt`` (0-based): Retry-After if given, else full jitter."""
+    if retry_after is not None:
+        try:
+            return min(float(retry_after), cap)
+        except ValueError:
+            pass  # An HTTP date; fall back to our own schedule
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def _rewind(files):
+    for value in (files or {}).values():
+        stream = value[1] if isinstance(value, tuple) else value
+        if hasattr(stream, 'seek'):
+            stream.seek(0)
+
+
+def _bounded_map(fn, items, concurrency, return_exceptions=False):
+    """``[fn(item) for item in items]`` on ``concurrency`` threads, never holding more than that many in flight."""
+    results = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        in_flight = deque()
+        for item in items:
+            if len(in_flight) >= concurrency:
+                results.append(_outcome(in_flight.popleft(), return_exceptions))
+            in_flight.append(executor.submit(fn, item))
+        while in_flight:
+            results.append(_outcome(in_flight.popleft(), return_exceptions))
+    return results
+
+
+def _outcome(future, return_exceptions):
+    try:
+        return future.result()
+    except Exception as e:
+        if not return_exceptions:
+            raise
+        return e
+
+
+def _upload_item(item):
+    """``path`` or ``(path, label)`` from the files given to the bulk upload helpers."""
+    return (item, '') if isinstance(item, (str, os.PathLike)) else (item[0], item[1] or '')
+
+
+class Client:
+    """Synchronous API client over one pooled, thread-safe session."""
+
+    def __init__(self, base_url=DEFAULT_BASE_URL, timeout=30, retries=5, backoff=0.5, max_backoff=30,
+                 pool_size=16, session=None):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = session or requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def request(self, method, path, **kwargs):
+        """Send a request, retrying 429/503 responses; returns the decoded JSON body (None for an empty one)."""
+        url = f'{self.base_url}/{path.lstrip("/")}'
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.retries + 1):
+            _rewind(kwargs.get('files'))
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.ConnectionError:
+                if method not in IDEMPOTENT_METHODS or attempt == self.retries:
+                    raise
+                time.sleep(backoff_delay(attempt, self.backoff, self.max_backoff))
+                continue
+            if response.status_code in RETRY_STATUSES and attempt < self.retries:
+                response.close()
+                time.sleep(backoff_delay(attempt, self.backoff, self.max_backoff,
+                                         response.headers.get('Retry-After')))
+                continue
+            break
+        try:
+            payload = response.json()
+        except ValueError:
+            payload = response.text or None
+        if response.status_code >= 400:
+            raise ApiError(response.status_code, payload, method, url)
+        return payload
+
+    def get(self, path, **params):
+        return self.request('GET', path, params=params or None)
+
+    def post(self, path, json=None, **kwargs):
+        return self.request('POST', path, json=json, **kwargs)
+
+    def put(self, path, json=None):
+        return self.request('PUT', path, json=json)
+
+    def delete(self, path):
+        return self.request('DELETE', path)
+
+    def paginate(self, path, limit=None, fields=None):
+        """Every item of a keyset-paginated listing, fetching page after page."""
+        after = 0
+        while True:
+            page = self.get(path, after=after, limit=limit, fields=','.join(fields) if fields else None)
+            yield from page['items']
+            if page['next_cursor'] is None:
+                return
+            after = page['next_cursor']
+
+    # Users and projects
+
+    def register_user(self, username, password):
+        return self.post('register/', {'username': username, 'password': password})
+
+    def get_user(self, username):
+        return self.get(f'user/{username}/')
+
+    def user_projects(self, username, fields=None):
+        return self.paginate(f'user/{username}/projects/', fields=fields)
+
+    def delete_user(self, username):
+        return self.delete(f'delete_user/{username}/')
+
+    def create_project(self, username, project_type, name=None):
+        return self.post('create_project/', {'username': username, 'project_type': project_type, 'name': name})
+
+    def get_project(self, project_id):
+        return self.get(f'project/{project_id}/')
+
+    def project_images(self, project_id, fields=None):
+        return self.paginate(f'project/{project_id}/images/', fields=fields)
+
+    def delete_project(self, project_id):
+        return self.delete(f'delete_project/{project_id}/')
+
+    def analyze_project(self, project_id, bins=None):
+        return self.get(f'analyze_project/{project_id}/', bins=bins)
+
+    # Images
+
+    def upload_image(self, project_id, path, label='', dedupe=True):
+        """Upload one file; with ``dedupe`` bytes the server already stores are not sent again."""
+        filename = os.path.basename(path)
+        if dedupe:
+            content_hash = hash_file(path)
+            try:
+                self.get(f'blobs/{content_hash}/')
+                return self.post(f'upload_image/{project_id}/',
+                                 data={'content_hash': content_hash, 'filename': filename, 'label': label})
+            except ApiError as e:
+                if e.status != 404:  # Content the server lacks, or reaped since the check: send the bytes
+                    raise
+        with open(path, 'rb') as f:
+            return self.post(f'upload_image/{project_id}/', files={'file': (filename, f)}, data={'label': label})
+
+    def upload_images(self, project_id, files, concurrency=8, dedupe=True, return_exceptions=False):
+        """Upload ``path`` or ``(path, label)`` items with at most ``concurrency`` uploads at once.
+
+        Results come back in input order; with ``return_exceptions`` a failed
+        upload's exception takes its place instead of being raised.
+        """
+        def upload(item):
+            path, label = _upload_item(item)
+            return self.upload_image(project_id, path, label, dedupe)
+        return _bounded_map(upload, files, concurrency, return_exceptions)
+
+    def get_image(self, image_id):
+        return self.get(f'image/{image_id}/')
+
+    def relabel_image(self, image_id, label):
+        return self.put(f'image/{image_id}/label/', {'label': label})
+
+    def delete_image(self, username, project_id, image_id):
+        return self.delete(f'delete_image/{username}/{project_id}/{image_id}/')
+
+    # Training
+
+    def configure_training(self, project_id, learning_rate, epochs, batch_size):
+        return self.post(f'configure_training/{project_id}/',
+                         {'learning_rate': learning_rate, 'epochs': epochs, 'batch_size': batch_size})
+
+    def enqueue_training(self, project_id, full=False):
+        return self.post(f'enqueue_training/{project_id}/', {'full': True} if full else None)
+
+    def training_results(self, project_id):
+        return self.get(f'training_results/{project_id}/')
+
+    def training_progress(self, job_id, poll_timeout=25):
+        """Yield each epoch's metrics as it finishes, long-polling until the job ends."""
+        after = 0
+        while True:
+            progress = self.get(f'jobs/{job_id}/progress/', after=after, timeout=poll_timeout)
+            yield from progress['metrics']
+            after = progress['next_cursor'] or after
+            if progress['status'] in FINISHED_STATUSES:
+                if progress['status'] == 'failed':
+                    raise JobFailed(self.get_job(job_id))
+                return
+
+    # Inference
+
+    def enqueue_inference(self, project_id, image_id):
+        return self.post(f'enqueue_inference/{project_id}/{image_id}/')
+
+    def enqueue_inference_batch(self, project_id, image_ids=None):
+        """Queue inference for ``image_ids``, or every image of the project when None."""
+        body = {'all': True} if image_ids is None else {'image_ids': list(image_ids)}
+        return self.post(f'enqueue_inference_batch/{project_id}/', body)
+
+    def inference_results(self, image_id):
+        return self.get(f'inference_results/{image_id}/')
+
+    def infer_images(self, project_id, image_ids, chunk_size=1000, concurrency=8, timeout=None):
+        """Run inference on many images and return ``{image_id: prediction}``.
+
+        Batches of ``chunk_size`` ids are enqueued concurrently; once their jobs
+        are done the results are fetched with ``concurrency`` requests in flight.
+        """
+        image_ids = list(image_ids)
+        chunks = [image_ids[i:i + chunk_size] for i in range(0, len(image_ids), chunk_size)]
+        batches = _bounded_map(lambda chunk: self.enqueue_inference_batch(project_id, chunk), chunks, concurrency)
+        self.wait_for_jobs([job_id for batch in batches for job_id in batch['job_ids']], timeout, concurrency)
+        skipped = {i for batch in batches for i in batch['skipped_image_ids']}
+        found = [i for i in image_ids if i not in skipped]
+        results = _bounded_map(self.inference_results, found, concurrency)
+        return {image_id: result['prediction'] for image_id, result in zip(found, results)}
+
+    # Jobs
+
+    def get_job(self, job_id):
+        return self.get(f'jobs/{job_id}/')
+
+    def queue_stats(self):
+        return self.get('jobs/stats/')
+
+    def wait_for_job(self, job_id, timeout=None, interval=0.25, max_interval=5, raise_on_failure=True):
+        """Poll a job until it is done or failed; the interval doubles up to ``max_interval``."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            job = self.get_job(job_id)
+            if job['status'] in FINISHED_STATUSES:
+                if job['status'] == 'failed' and raise_on_failure:
+                    raise JobFailed(job)
+                return job
+            if deadline is not None and time.monotonic() + interval > deadline:
+                raise TimeoutError(f'Job {job_id} still {job["status"]} after {timeout}s')
+            time.sleep(interval)
+            interval = min(interval * 2, max_interval)
+
+    def wait_for_jobs(self, job_ids, timeout=None, concurrency=8, raise_on_failure=True):
+        return _bounded_map(lambda job_id: self.wait_for_job(job_id, timeout, raise_on_failure=raise_on_failure),
+                            job_ids, concurrency)
+
+
+class AsyncClient:
+    """Client's methods as coroutines, for asyncio applications.
+
+    Methods that iterate (listings, training_progress) resolve to lists.
+    Calls run on a private thread pool over the pooled session, so the event
+    loop never blocks on the network; bulk helpers bound the requests in
+    flight with a semaphore, and polling waits with asyncio.sleep.
+    """
+
+    def __init__(self, base_url=DEFAULT_BASE_URL, concurrency=16, **options):
+        self.client = Client(base_url, pool_size=concurrency, **options)
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='api-client')
+
+    async def close(self):
+        self._executor.shutdown(wait=False)
+        self.client.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def call(self, method, *args, **kwargs):
+        function = getattr(self.client, method)
+        if method in ITERATOR_METHODS:
+            iterate = function
+            function = lambda *a, **kw: list(iterate(*a, **kw))  # noqa: E731
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(function, *args, **kwargs))
+
+    def __getattr__(self, name):
+        if name.startswith('_') or not callable(getattr(Client, name, None)):
+            raise AttributeError(name)
+
+        async def method(*args, **kwargs):
+            return await self.call(name, *args, **kwargs)
+        method.__name__ = name
+        return method
+
+    async def _gather_bounded(self, coroutine_fn, items, concurrency, return_exceptions=False):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(item):
+            async with semaphore:
+                return await coroutine_fn(item)
+        return await asyncio.gather(*(run(item) for item in items), return_exceptions=return_exceptions)
+
+    async def upload_images(self, project_id, files, concurrency=8, dedupe=True, return_exceptions=False):
+        async def upload(item):
+            path, label = _upload_item(item)
+            return await self.call('upload_image', project_id, path, label, dedupe)
+        return await self._gather_bounded(upload, files, concurrency, return_exceptions)
+
+    async def wait_for_job(self, job_id, timeout=None, interval=0.25, max_interval=5, raise_on_failure=True):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            job = await self.call('get_job', job_id)
+            if job['status'] in FINISHED_STATUSES:
+                if job['status'] == 'failed' and raise_on_failure:
+                    raise JobFailed(job)
+                return job
+            if deadline is not None and time.monotonic() + interval > deadline:
+                raise TimeoutError(f'Job {job_id} still {job["status"]} after {timeout}s')
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, max_interval)
+
+    async def wait_for_jobs(self, job_ids, timeout=None, concurrency=8, raise_on_failure=True):
+        return await self._gather_bounded(
+            lambda job_id: self.wait_for_job(job_id, timeout, raise_on_failure=raise_on_failure), job_ids, concurrency)
+
+    async def infer_images(self, project_id, image_ids, chunk_size=1000, concurrency=8, timeout=None):
+        image_ids = list(image_ids)
+        chunks = [image_ids[i:i + chunk_size] for i in range(0, len(image_ids), chunk_size)]
+        batches = await self._gather_bounded(
+            lambda chunk: self.call('enqueue_inference_batch', project_id, chunk), chunks, concurrency)
+        await self.wait_for_jobs([job_id for batch in batches for job_id in batch['job_ids']], timeout, concurrency)
+        skipped = {i for batch in batches for i in batch['skipped_image_ids']}
+        found = [i for i in image_ids if i not in skipped]
+        results = await self._gather_bounded(lambda i: self.call('inference_results', i), found, concurrency)
+        return {image_id: result['prediction'] for image_id, result in zip(found, results)}
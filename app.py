@@ -1,6 +1,10 @@
 from flask import Flask
 from extensions import db, init_app
 from routes import api as api_blueprint
+import task_manager
+import migrations
+import cache
+import metrics
 
 from config import DevelopmentConfig, TestConfig
 
@@ -9,7 +13,11 @@ def create_app(config_object=DevelopmentConfig):
     app = Flask(__name__)
     app.config.from_object(config_object)
     init_app(app)  # Initialize database and other extensions
+    cache.init_app(app)
+    metrics.init_app(app)  # GET /metrics, request and SQL timing
     app.register_blueprint(api_blueprint, url_prefix='/api')
+    task_manager.init_app(app)  # Start training/inference workers
+    migrations.init_app(app)  # flask upgrade-db
     return app
 
 
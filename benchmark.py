@@ -0,0 +1,531 @@
+import io
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import click
+import requests
+from requests.adapters import HTTPAdapter
+from sqlalchemy import insert
+from werkzeug.security import generate_password_hash
+from config import Config
+import dataloader
+import features
+import inference_pool
+from features import PILImage
+from models import Image, InferenceResult, Job, Project, TrainingConfig, TrainingMetric, TrainingResult, User, db
+import storage
+import vector_index
+
+# Offline benchmark of every route in routes.api. A dataset of thousands of
+# users, projects and images is bulk-inserted into a fresh database, then the
+# app is started locally in a child process and driven over HTTP:
+#
+#   endpoints  latency percentiles and throughput per route, workers stopped so
+#              only the request path is measured
+#   uploads    concurrent single-image upload throughput at several concurrencies
+#   queue      enqueue-to-done latency of training and inference jobs, workers running
+#
+# Results are written as JSON (git commit, host and parameters included), and
+# --compare prints the change against an earlier run, exiting non-zero when a
+# route's p50 or throughput regressed by more than --threshold.
+#
+#   python benchmark.py --users 2000 --output bench.json --compare baseline.json
+
+logger = logging.getLogger(__name__)
+
+PASSWORD = 'benchmark'
+PERCENTILES = (50, 90, 95, 99)
+
+
+# Tiny grayscale PNGs: shade picks the pixel value, variant makes the bytes unique
+def make_png(shade, variant=0, size=32):
+    if PILImage is None:
+        return b'\x89PNG\r\n\x1a\n' + bytes([shade % 256]) * size + variant.to_bytes(8, 'big')
+    img = PILImage.new('L', (size, size), shade % 256)
+    img.putpixel((0, 0), variant % 256)
+    img.putpixel((1, 0), variant // 256 % 256)
+    img.putpixel((2, 0), variant // 65536 % 256)
+    out = io.BytesIO()
+    img.save(out, 'PNG')
+    return out.getvalue()
+
+
+class Dataset:
+    """Ids of the seeded rows, laid out deterministically so requests can pick valid targets."""
+
+    def __init__(self, users, projects_per_user, images_per_project, victims, blobs):
+        self.users = users
+        self.projects_per_user = projects_per_user
+        self.images_per_project = images_per_project
+        self.victims = victims
+        self.blobs = blobs  # Content hashes of the stored files
+        self.projects = users * projects_per_user
+        self.images = self.projects * images_per_project
+        # Rows that the DELETE routes consume, one per request
+        self.victim_owner = 'victim-owner'
+        self.victim_users = [f'victim-{i}' for i in range(victims)]
+        self.victim_projects = list(range(self.projects + 1, self.projects + victims + 1))
+        self.victim_image_project = self.projects + victims + 1
+        self.victim_images = list(range(self.images + 1, self.images + victims + 1))
+        self.jobs = min(self.projects, 1000)
+
+    def username(self, user_id):
+        return f'user{user_id}'
+
+    def owner(self, project_id):
+        return (project_id - 1) // self.projects_per_user + 1
+
+    def project_images(self, project_id):
+        first = (project_id - 1) * self.images_per_project + 1
+        return list(range(first, first + self.images_per_project))
+
+
+def seed(dataset, upload_folder, chunk_size=5000):
+    """Bulk-insert the dataset into the current app's (empty) database."""
+    db.create_all()
+    password_hash = generate_password_hash(PASSWORD)  # Hashed once; hashing per user would dominate seeding
+    now = datetime.utcnow()
+    shades = [int(255 * i / max(1, len(dataset.blobs) - 1)) for i in range(len(dataset.blobs))]
+
+    def bulk(model, rows):
+        for start in range(0, len(rows), chunk_size):
+            db.session.execute(insert(model), rows[start:start + chunk_size])
+
+    users = [{'id': i, 'username': dataset.username(i), 'password_hash': password_hash}
+             for i in range(1, dataset.users + 1)]
+    owner_id = dataset.users + 1
+    users.append({'id': owner_id, 'username': dataset.victim_owner, 'password_hash': password_hash})
+    users += [{'id': owner_id + 1 + i, 'username': name, 'password_hash': password_hash}
+              for i, name in enumerate(dataset.victim_users)]
+    bulk(User, users)
+
+    projects = [{'id': p, 'user_id': dataset.owner(p), 'project_type': 'Image Classification', 'name': f'project{p}'}
+                for p in range(1, dataset.projects + 1)]
+    projects += [{'id': p, 'user_id': owner_id, 'project_type': 'Image Classification', 'name': f'victim{p}'}
+                 for p in dataset.victim_projects + [dataset.victim_image_project]]
+    next_project = dataset.victim_image_project + 1
+    victim_user_projects = list(range(next_project, next_project + dataset.victims))
+    projects += [{'id': p, 'user_id': owner_id + 1 + i, 'project_type': 'Image Classification', 'name': 'mine'}
+                 for i, p in enumerate(victim_user_projects)]
+    bulk(Project, projects)
+    bulk(TrainingConfig, [{'project_id': p, 'learning_rate': 0.1, 'epochs': 1, 'batch_size': 32}
+                          for p in range(1, dataset.projects + 1)])
+
+    def image_row(image_id, project_id):
+        blob = (image_id - 1) % len(dataset.blobs)
+        return {'id': image_id, 'project_id': project_id, 'filename': f'{image_id}.png',
+                'content_hash': dataset.blobs[blob], 'label': 'dark' if shades[blob] < 128 else 'light',
+                'feature_size': 100.0 + blob, 'width': 32, 'height': 32, 'channels': 1, 'phash': f'{blob:016x}'}
+
+    images = [image_row(i, (i - 1) // dataset.images_per_project + 1) for i in range(1, dataset.images + 1)]
+    images += [image_row(i, dataset.victim_image_project) for i in dataset.victim_images]
+    next_image = dataset.images + dataset.victims + 1
+    for project_id in dataset.victim_projects + victim_user_projects:
+        images += [image_row(next_image, project_id), image_row(next_image + 1, project_id)]
+        next_image += 2
+    add_embeddings(images, len(dataset.blobs))
+    bulk(Image, images)
+    bulk(InferenceResult, [{'image_id': i, 'result': 'dark', 'created_at': now} for i in range(1, dataset.images + 1)])
+    bulk(TrainingResult, [{'project_id': p, 'accuracy': 0.5, 'loss': 0.7, 'created_at': now}
+                          for p in range(1, dataset.projects + 1)])
+    bulk(Job, [{'id': j, 'kind': 'training', 'project_id': j, 'user_id': dataset.owner(j), 'status': 'done',
+                'attempts': 1, 'created_at': now, 'started_at': now, 'finished_at': now}
+               for j in range(1, dataset.jobs + 1)])
+    bulk(TrainingMetric, [{'job_id': j, 'project_id': j, 'epoch': 1, 'epochs': 1, 'loss': 0.7, 'accuracy': 0.5,
+                           'images': dataset.images_per_project, 'seconds': 0.01, 'created_at': now}
+                          for j in range(1, dataset.jobs + 1)])
+    db.session.commit()
+    if db.engine.dialect.name == 'sqlite':
+        db.session.execute(db.text('ANALYZE'))
+        db.session.commit()
+    if vector_index.np is not None:
+        for project_id in range(1, dataset.projects + 1):
+            vector_index.rebuild(project_id)
+
+
+# Embeddings as features.embed would store them: images of the same blob are near-duplicates
+def add_embeddings(images, blobs, seed_value=0):
+    np = vector_index.np
+    if np is None:
+        return
+    rng = np.random.default_rng(seed_value)
+    bases = rng.standard_normal((blobs, features.EMBEDDING_SIZE ** 2)).astype(np.float32)
+    for start in range(0, len(images), 10000):
+        rows = images[start:start + 10000]
+        vectors = bases[[(row['id'] - 1) % blobs for row in rows]] + 0.1 * rng.standard_normal(
+            (len(rows), bases.shape[1]), dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        for row, vector in zip(rows, vectors):
+            row['embedding'] = vector.tobytes()
+
+
+def write_blobs(upload_folder, count):
+    hashes = []
+    for i in range(count):
+        content_hash, _size, _created = storage.save_stream(
+            io.BytesIO(make_png(int(255 * i / max(1, count - 1)))), upload_folder)
+        hashes.append(content_hash)
+    return hashes
+
+
+# Request for the i-th call of each route: (method, path, requests keyword arguments)
+def scenarios(dataset, rng, run_id):
+    def user():
+        return dataset.username(rng.randint(1, dataset.users))
+
+    def project():
+        return rng.randint(1, dataset.projects)
+
+    def image():
+        return rng.randint(1, dataset.images)
+
+    def inference(i):
+        project_id = project()
+        return 'POST', f'/enqueue_inference/{project_id}/{rng.choice(dataset.project_images(project_id))}/', {}
+
+    def inference_batch(i):
+        project_id = project()
+        return 'POST', f'/enqueue_inference_batch/{project_id}/', {
+            'json': {'image_ids': dataset.project_images(project_id)}}
+
+    def similar(i):
+        project_id = project()
+        return 'GET', f'/project/{project_id}/similar/', {
+            'params': {'image_id': rng.choice(dataset.project_images(project_id)), 'k': 10}}
+
+    def multipart(count, i):
+        return {'files': [('files', (f'{i}-{n}.png', make_png(i, n + 1)))
+                          for n in range(count)], 'data': {'label': 'dark'}}
+
+    return {
+        'api.register': lambda i: ('POST', '/register/',
+                                   {'json': {'username': f'new-{run_id}-{i}', 'password': PASSWORD}}),
+        'api.get_user': lambda i: ('GET', f'/user/{user()}/', {}),
+        'api.list_user_projects': lambda i: ('GET', f'/user/{user()}/projects/', {}),
+        'api.delete_user': lambda i: ('DELETE', f'/delete_user/{dataset.victim_users[i]}/', {}),
+        'api.create_project': lambda i: ('POST', '/create_project/', {'json': {
+            'username': user(), 'project_type': 'Image Classification', 'name': f'new-{i}'}}),
+        'api.get_project': lambda i: ('GET', f'/project/{project()}/', {}),
+        'api.list_project_images': lambda i: ('GET', f'/project/{project()}/images/', {}),
+        'api.list_project_training_results': lambda i: ('GET', f'/project/{project()}/training_results/', {}),
+        'api.list_project_inference_results': lambda i: ('GET', f'/project/{project()}/inference_results/', {}),
+        'api.delete_project': lambda i: ('DELETE', f'/delete_project/{dataset.victim_projects[i]}/', {}),
+        'api.upload_image': lambda i: ('POST', f'/upload_image/{project()}/', {
+            'files': {'file': (f'{i}.png', make_png(i, 1 << 20 | i))}, 'data': {'label': 'dark'}}),
+        'api.bulk_upload_images': lambda i: ('POST', f'/upload_images/{project()}/', multipart(10, i)),
+        'api.get_blob': lambda i: ('GET', f'/blobs/{rng.choice(dataset.blobs)}/', {}),
+        'api.get_image': lambda i: ('GET', f'/image/{image()}/', {}),
+        'api.relabel_image': lambda i: ('PUT', f'/image/{image()}/label/', {
+            'json': {'label': rng.choice(('dark', 'light'))}}),
+        'api.delete_image': lambda i: ('DELETE', f'/delete_image/{dataset.victim_owner}/'
+                                                 f'{dataset.victim_image_project}/{dataset.victim_images[i]}/', {}),
+        'api.analyze_project': lambda i: ('GET', f'/analyze_project/{project()}/', {}),
+        'api.similar_images': similar,
+        'api.list_duplicates': lambda i: ('GET', f'/project/{project()}/duplicates/', {}),
+        'api.configure_training': lambda i: ('POST', f'/configure_training/{project()}/', {'json': {
+            'learning_rate': 0.1, 'epochs': 1, 'batch_size': 32}}),
+        'api.enqueue_training': lambda i: ('POST', f'/enqueue_training/{project()}/', {}),
+        'api.get_training_results': lambda i: ('GET', f'/training_results/{project()}/', {}),
+        'api.enqueue_inference': inference,
+        'api.enqueue_inference_batch': inference_batch,
+        'api.get_inference_results': lambda i: ('GET', f'/inference_results/{image()}/', {}),
+        'api.get_job': lambda i: ('GET', f'/jobs/{rng.randint(1, dataset.jobs)}/', {}),
+        'api.get_queue_stats': lambda i: ('GET', '/jobs/stats/', {}),
+        'api.get_training_progress': lambda i: ('GET', f'/jobs/{rng.randint(1, dataset.jobs)}/progress/', {}),
+        'api.uploaded_file': lambda i: ('GET', f'/uploads/{rng.choice(dataset.blobs)}', {}),
+    }
+
+
+def summarize(latencies, wall_seconds, statuses):
+    """Latency percentiles in milliseconds (nearest rank), throughput and status counts."""
+    ordered = sorted(latencies)
+    summary = {'requests': len(ordered), 'errors': sum(n for code, n in statuses.items() if code >= 400),
+               'status_codes': {str(code): n for code, n in sorted(statuses.items())},
+               'throughput_rps': len(ordered) / wall_seconds if wall_seconds else None}
+    if ordered:
+        ms = [value * 1000 for value in ordered]
+        summary['latency_ms'] = dict(
+            {f'p{p}': ms[min(len(ms) - 1, max(0, -(-p * len(ms) // 100) - 1))] for p in PERCENTILES},
+            min=ms[0], max=ms[-1], mean=sum(ms) / len(ms))
+    return summary
+
+
+def new_session(concurrency):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    return session
+
+
+def measure(session, base_url, make_request, count, concurrency):
+    """Send ``count`` requests from ``concurrency`` threads; returns their summary."""
+    latencies, statuses, lock = [], Counter(), threading.Lock()
+    requests_to_send = [make_request(i) for i in range(count)]  # Built up front so timing covers only HTTP
+
+    def send(spec):
+        method, path, kwargs = spec
+        started = time.perf_counter()
+        try:
+            response = session.request(method, base_url + path, timeout=60, **kwargs)
+            response.content  # Read the whole body
+            status = response.status_code
+        except requests.RequestException:
+            status = 599
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            statuses[status] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(send, requests_to_send))
+    return summarize(latencies, time.perf_counter() - started, statuses)
+
+
+def wait_for_job(session, base_url, job_id, timeout=300, interval=0.01):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = session.get(f'{base_url}/jobs/{job_id}/', timeout=60).json()['status']
+        if status in ('done', 'failed'):
+            return status
+        time.sleep(interval)
+    return 'timeout'
+
+
+def measure_queue(session, base_url, make_request, count, concurrency):
+    """Latency from enqueueing a job to seeing it done, for ``count`` jobs sent from ``concurrency`` threads."""
+    latencies, statuses, lock = [], Counter(), threading.Lock()
+    requests_to_send = [make_request(i) for i in range(count)]
+
+    def run(spec):
+        method, path, kwargs = spec
+        started = time.perf_counter()
+        response = session.request(method, base_url + path, timeout=60, **kwargs)
+        if response.status_code == 202:
+            outcome = wait_for_job(session, base_url, response.json()['job_id'])
+        else:  # 200 is an inference answered from the result cache
+            outcome = 'cached' if response.status_code == 200 else str(response.status_code)
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            statuses[outcome] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(run, requests_to_send))
+    summary = summarize(latencies, time.perf_counter() - started, Counter())
+    summary.update(errors=sum(n for outcome, n in statuses.items() if outcome not in ('done', 'cached')),
+                   outcomes=dict(statuses))
+    summary['jobs_per_sec'] = summary.pop('throughput_rps')
+    del summary['status_codes']
+    return summary
+
+
+def _serve(overrides, ready, stop):
+    """Child process: run the app with ``overrides`` on an ephemeral port until ``stop`` is set."""
+    from werkzeug.serving import make_server
+    from app import create_app
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    app = create_app(type('BenchmarkConfig', (Config,), overrides))
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    ready.put(server.server_port)
+    stop.wait()
+    server.shutdown()
+    # A multiprocessing child joins its own children before atexit handlers run,
+    # so stop the workers and the decode, feature and inference process pools explicitly
+    app.extensions['worker_pool'].shutdown()
+    for module in (dataloader, features, inference_pool):
+        module._pool.shutdown()
+
+
+class LocalServer:
+    """The app in a child process, so client threads don't compete with it for the GIL."""
+
+    def __init__(self, overrides):
+        context = multiprocessing.get_context('spawn')
+        ready = context.Queue()
+        self.stop = context.Event()
+        # Not a daemon: the app starts process pools of its own for decoding
+        self.process = context.Process(target=_serve, args=(overrides, ready, self.stop))
+        self.process.start()
+        self.base_url = f'http://127.0.0.1:{ready.get(timeout=60)}/api'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop.set()
+        self.process.join(60)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, timeout=10,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run(users=2000, projects_per_user=2, images_per_project=10, requests_per_route=200, concurrency=8,
+        upload_requests=200, upload_concurrency=(1, 4, 16), queue_jobs=20, database_uri=None, work_dir=None,
+        seed_value=0):
+    """Seed a dataset, benchmark every route, uploads and the job queue; returns the results dict."""
+    from app import create_app
+    owns_dir = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix='benchmark-')
+    victims = requests_per_route  # One per DELETE request
+    folders = {name: os.path.join(work_dir, name) for name in ('uploads', 'models', 'cache', 'index')}
+    overrides = {
+        'SQLALCHEMY_DATABASE_URI': database_uri or 'sqlite:///' + os.path.join(work_dir, 'benchmark.db'),
+        'UPLOAD_FOLDER': folders['uploads'], 'MODEL_FOLDER': folders['models'],
+        'DECODED_CACHE_FOLDER': folders['cache'], 'INDEX_FOLDER': folders['index'], 'TASK_QUEUE_MAXSIZE': 0,
+        'TRAINING_WORKERS': 0, 'INFERENCE_WORKERS': 0, 'FEATURE_WORKERS': 0, 'INDEX_WORKERS': 0,
+        'REAPER_INTERVAL': 0,
+    }
+    results = {'meta': {
+        'started_at': datetime.utcnow().isoformat() + 'Z', 'git_commit': git_commit(),
+        'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+        'database': overrides['SQLALCHEMY_DATABASE_URI'].split(':', 1)[0],
+        'parameters': {'users': users, 'projects_per_user': projects_per_user,
+                       'images_per_project': images_per_project, 'requests_per_route': requests_per_route,
+                       'concurrency': concurrency, 'upload_requests': upload_requests,
+                       'upload_concurrency': list(upload_concurrency), 'queue_jobs': queue_jobs, 'seed': seed_value},
+    }}
+    try:
+        started = time.perf_counter()
+        app = create_app(type('BenchmarkSeedConfig', (Config,), overrides))
+        with app.app_context():
+            dataset = Dataset(users, projects_per_user, images_per_project, victims,
+                              write_blobs(folders['uploads'], 16))
+            seed(dataset, folders['uploads'])
+            db.session.remove()
+            db.engine.dispose()
+            routes = {rule.endpoint: rule for rule in app.url_map.iter_rules() if rule.endpoint.startswith('api.')}
+        results['meta']['seed_seconds'] = time.perf_counter() - started
+        results['meta']['rows'] = {'users': users, 'projects': dataset.projects, 'images': dataset.images}
+
+        rng = random.Random(seed_value)
+        plans = scenarios(dataset, rng, int(time.time()))
+        missing = sorted(set(routes) - set(plans))
+        if missing:
+            raise RuntimeError(f'No benchmark scenario for {", ".join(missing)}')
+
+        with LocalServer(overrides) as server:
+            session = new_session(max(concurrency, *upload_concurrency))
+            results['endpoints'] = {}
+            for endpoint in sorted(routes):
+                summary = measure(session, server.base_url, plans[endpoint], requests_per_route, concurrency)
+                rule = routes[endpoint]
+                results['endpoints'][endpoint] = dict(
+                    summary, rule=rule.rule, method=sorted(rule.methods - {'HEAD', 'OPTIONS'})[0])
+                logger.info("%s: %s", endpoint, summary.get('latency_ms'))
+
+            results['uploads'] = {}
+            payload_bytes = len(make_png(0, 1))
+            for level in upload_concurrency:
+                upload = plans['api.upload_image']
+                summary = measure(session, server.base_url, upload, upload_requests, level)
+                summary['bytes_per_sec'] = summary['throughput_rps'] * payload_bytes
+                results['uploads'][f'concurrency_{level}'] = summary
+
+        # Queue phase: cancel what the endpoint phase left queued, then run with workers
+        app = create_app(type('BenchmarkSeedConfig', (Config,), overrides))
+        with app.app_context():
+            Job.query.filter_by(status='queued').update({'status': 'failed', 'error': 'Benchmark reset'})
+            db.session.commit()
+            db.session.remove()
+            db.engine.dispose()
+        queue_overrides = dict(overrides, TRAINING_WORKERS=2, INFERENCE_WORKERS=2, FEATURE_WORKERS=1,
+                               JOB_POLL_INTERVAL=0.05)
+        with LocalServer(queue_overrides) as server:
+            session = new_session(concurrency * 2)
+            projects = rng.sample(range(1, dataset.projects + 1), min(queue_jobs, dataset.projects))
+            results['queue'] = {
+                'training': measure_queue(session, server.base_url,
+                                          lambda i: ('POST', f'/enqueue_training/{projects[i]}/', {}),
+                                          len(projects), concurrency),
+                'inference': measure_queue(session, server.base_url, plans['api.enqueue_inference'],
+                                           queue_jobs, concurrency),
+                'server_stats': session.get(f'{server.base_url}/jobs/stats/', timeout=60).json(),
+            }
+        results['meta']['finished_at'] = datetime.utcnow().isoformat() + 'Z'
+        return results
+    finally:
+        if owns_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def compare(baseline, current, threshold=0.2):
+    """Lines describing the change per route, and the routes that regressed by more than ``threshold``."""
+    lines, regressions = [], []
+    for endpoint, now in sorted(current.get('endpoints', {}).items()):
+        before = baseline.get('endpoints', {}).get(endpoint)
+        if not before or 'latency_ms' not in before or 'latency_ms' not in now:
+            lines.append(f'{endpoint:45} new')
+            continue
+        p50_change = now['latency_ms']['p50'] / before['latency_ms']['p50'] - 1 if before['latency_ms']['p50'] else 0
+        rps_change = now['throughput_rps'] / before['throughput_rps'] - 1 if before['throughput_rps'] else 0
+        regressed = p50_change > threshold or rps_change < -threshold
+        if regressed:
+            regressions.append(endpoint)
+        lines.append(f"{endpoint:45} p50 {before['latency_ms']['p50']:8.2f} -> {now['latency_ms']['p50']:8.2f} ms "
+                     f"({p50_change:+.0%})  rps {before['throughput_rps']:8.1f} -> {now['throughput_rps']:8.1f} "
+                     f"({rps_change:+.0%}){'  REGRESSED' if regressed else ''}")
+    return lines, regressions
+
+
+@click.command()
+@click.option('--users', default=2000, show_default=True)
+@click.option('--projects-per-user', default=2, show_default=True)
+@click.option('--images-per-project', default=10, show_default=True)
+@click.option('--requests', 'requests_per_route', default=200, show_default=True, help='Requests per route.')
+@click.option('--concurrency', default=8, show_default=True, help='Client threads per route.')
+@click.option('--upload-requests', default=200, show_default=True)
+@click.option('--upload-concurrency', default='1,4,16', show_default=True, help='Comma-separated levels.')
+@click.option('--queue-jobs', default=20, show_default=True, help='Jobs per kind timed end to end.')
+@click.option('--database-uri', default=None, help='Empty database to seed; a temporary SQLite file by default.')
+@click.option('--seed', 'seed_value', default=0, show_default=True)
+@click.option('--output', type=click.Path(dir_okay=False), default=None, help='Write the results JSON here.')
+@click.option('--compare', 'baseline_path', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='Results JSON of an earlier run to compare against.')
+@click.option('--threshold', default=0.2, show_default=True, help='Relative change counted as a regression.')
+def main(users, projects_per_user, images_per_project, requests_per_route, concurrency, upload_requests,
+         upload_concurrency, queue_jobs, database_uri, seed_value, output, baseline_path, threshold):
+    """Benchmark every API route against a locally started app."""
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    results = run(users, projects_per_user, images_per_project, requests_per_route, concurrency, upload_requests,
+                  tuple(int(level) for level in upload_concurrency.split(',')), queue_jobs, database_uri,
+                  seed_value=seed_value)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        click.echo(text)
+    if baseline_path:
+        with open(baseline_path) as f:
+            lines, regressions = compare(json.load(f), results, threshold)
+        click.echo('\n'.join(lines), err=True)
+        if regressions:
+            click.echo(f'{len(regressions)} routes regressed by more than {threshold:.0%}', err=True)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
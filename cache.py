@@ -0,0 +1,204 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from functools import wraps
+from flask import Response, current_app, g, request
+
+logger = logging.getLogger(__name__)
+
+# Response cache for read-heavy GET endpoints.
+#
+# Each cached response records the version of every tag it depends on
+# ("user:alice", "project:3", "images:3", "image:7", "training:3", "inference:7"). Mutating
+# code calls invalidate() with the tags it touched, which gives those tags new
+# versions; a cached entry is served only while all its tag versions are
+# unchanged. Versions are random tokens rather than counters, so a tag that is
+# evicted and recreated can never match an old entry: forgetting a tag only
+# costs misses, which is what keeps the memory backend's tags bounded.
+#
+# The memory backend only sees the invalidations of its own process. Uploads
+# handled by another web process, or jobs finished by workers in another
+# process, leave its entries stale until they expire, so it serves them for
+# CACHE_MEMORY_TTL at most; deployments with several processes should use the
+# redis backend, whose versions every process shares.
+
+
+class NullCache:
+    """Caching disabled."""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl=None):
+        pass
+
+    def tag_versions(self, tags):
+        return [None] * len(tags)
+
+    def invalidate(self, tags):
+        pass
+
+
+class MemoryCache:
+    """In-process LRU cache with per-entry TTL; each process invalidates only its own entries."""
+
+    def __init__(self, max_entries=1024, default_ttl=300, max_tags=None):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.max_tags = max_tags or 8 * max_entries  # A response depends on a handful of tags
+        self.entries = OrderedDict()  # key -> (expires_at, value)
+        self.tags = OrderedDict()  # tag -> version, least recently read first
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self.entries.get(key)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self.entries[key] = (time.monotonic() + (ttl or self.default_ttl), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def tag_versions(self, tags):
+        with self._lock:
+            versions = []
+            for tag in tags:
+                versions.append(self.tags.setdefault(tag, uuid.uuid4().hex))
+                self.tags.move_to_end(tag)
+            while len(self.tags) > self.max_tags:
+                self.tags.popitem(last=False)
+            return versions
+
+    def invalidate(self, tags):
+        with self._lock:
+            for tag in tags:
+                self.tags.pop(tag, None)  # Read again, it gets a new version
+
+
+class RedisCache:
+    """Cache shared by every process through a Redis-compatible server (needs the ``redis`` package)."""
+
+    def __init__(self, url, default_ttl=300, prefix='diyml:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.default_ttl = default_ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        return json.loads(raw) if raw else None
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, json.dumps(value), ex=ttl or self.default_ttl)
+
+    def tag_versions(self, tags):
+        pipe = self.client.pipeline()
+        for tag in tags:
+            pipe.set(self.prefix + 'tag:' + tag, uuid.uuid4().hex, nx=True)
+        for tag in tags:
+            pipe.get(self.prefix + 'tag:' + tag)
+        return [v.decode() for v in pipe.execute()[len(tags):]]
+
+    def invalidate(self, tags):
+        pipe = self.client.pipeline()
+        for tag in tags:
+            pipe.set(self.prefix + 'tag:' + tag, uuid.uuid4().hex)
+        pipe.execute()
+
+
+def init_app(app):
+    backend = app.config.get('CACHE_BACKEND', 'memory')
+    ttl = app.config.get('CACHE_TTL', 300)
+    if backend == 'redis':
+        cache = RedisCache(app.config['CACHE_URL'], ttl)
+    elif backend == 'memory':
+        cache = MemoryCache(app.config.get('CACHE_MAX_ENTRIES', 1024), min(ttl, app.config.get('CACHE_MEMORY_TTL', 10)))
+    else:
+        cache = NullCache()
+    app.extensions['cache'] = cache
+
+
+def get_cache():
+    return current_app.extensions['cache']
+
+
+def invalidate(*tags):
+    """Drop every cached response depending on any of ``tags``; call after the change is committed."""
+    if not tags:
+        return
+    try:
+        get_cache().invalidate(sorted(set(tags)))
+    except Exception:
+        logger.exception("Cache invalidation failed for %s", tags)
+
+
+def depends_on(*tags):
+    """Declare, while building a cached response, tags that can't be known from the URL.
+
+    Their versions are read once the view returns, so prefer the up-front tags of ``cached``.
+    """
+    if g.get('cache_tags') is not None:
+        g.cache_tags.extend(tags)
+
+
+def _respond(entry):
+    response = Response(entry['body'], mimetype=entry['mimetype'])
+    response.set_etag(entry['etag'])
+    return response.make_conditional(request)
+
+
+def cached(tags_for):
+    """Cache a GET view's 200 responses, with ETag/If-None-Match support.
+
+    ``tags_for`` receives the view's URL arguments and returns the tags known
+    up front; their versions are read before the view runs, so a change
+    committed while the response is being built still invalidates it.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            cache = get_cache()
+            key = 'response:' + request.full_path
+            try:
+                entry = cache.get(key)
+                if entry is not None and cache.tag_versions(entry['tags']) == entry['versions']:
+                    return _respond(entry)
+                tags = list(tags_for(**kwargs))
+                versions = cache.tag_versions(tags)
+            except Exception:
+                logger.exception("Cache lookup failed for %s", key)
+                return view(*args, **kwargs)
+
+            g.cache_tags = []
+            response = current_app.make_response(view(*args, **kwargs))
+            extra_tags, g.cache_tags = g.cache_tags, None
+            if response.status_code != 200:
+                return response
+            body = response.get_data(as_text=True)
+            entry = {
+                'body': body,
+                'mimetype': response.mimetype,
+                'etag': hashlib.sha1(body.encode()).hexdigest(),
+                'tags': tags + extra_tags,
+                'versions': versions + cache.tag_versions(extra_tags),
+            }
+            try:
+                cache.set(key, entry)
+            except Exception:
+                logger.exception("Cache store failed for %s", key)
+            return _respond(entry)
+        return wrapper
+    return decorator
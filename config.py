@@ -1,14 +1,101 @@
 class Config:
-    SQLALCHEMY_DATABASE_URI = 'sqlite:///project.db'
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///project.db'  # A postgresql:// URI needs no other change
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    DB_POOL_SIZE = 10  # Sized for request threads plus worker threads
+    DB_MAX_OVERFLOW = 10
+    DB_POOL_TIMEOUT = 30
+    DB_POOL_RECYCLE = 1800
+    SQLITE_JOURNAL_MODE = 'WAL'
+    SQLITE_SYNCHRONOUS = 'NORMAL'
+    SQLITE_BUSY_TIMEOUT_MS = 5000  # Wait this long for a lock instead of failing with "database is locked"
+    CACHE_BACKEND = 'memory'  # 'memory' (per process), 'redis' (shared, needs the redis package) or 'null'
+    CACHE_URL = 'redis://localhost:6379/0'
+    CACHE_TTL = 300  # Seconds a cached GET response may be served
+    CACHE_MAX_ENTRIES = 1024  # Responses held by the memory backend
+    # The memory backend misses other processes' invalidations (another web process, workers started
+    # elsewhere), so its responses are served this long at most; run several processes with redis
+    CACHE_MEMORY_TTL = 10
+    GROUP_COMMIT = True  # Commit worker results through one writer thread, in groups
+    GROUP_COMMIT_MAX_BATCH = 256  # Jobs per group commit
+    GROUP_COMMIT_MAX_DELAY = 0.02  # Seconds the writer waits for more results before committing
     UPLOAD_FOLDER = 'uploads'
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024
+    UPLOAD_CHUNK_SIZE = 1024 * 1024  # Bytes read per chunk while streaming uploads to disk
+    UPLOAD_SERVE_MODE = 'direct'  # 'direct', 'x-accel-redirect' (nginx) or 'x-sendfile' (Apache, lighttpd)
+    UPLOAD_ACCEL_PREFIX = '/protected-uploads'  # Internal nginx location aliased to UPLOAD_FOLDER
+    UPLOAD_MAX_AGE = 365 * 24 * 3600  # Cache-Control max-age for content-addressed files
+    UPLOAD_LEGACY_MAX_AGE = 3600  # For files stored by name before content addressing
+    THUMBNAIL_WIDTHS = (64, 128, 256, 512)  # Allowed ?w= values, so variants on disk stay bounded
+    MAX_INGEST_CONTENT_LENGTH = 20 * 1024 * 1024 * 1024  # Request body limit for bulk ingest
+    MAX_INGEST_FILES = 100000  # Multipart parts accepted by bulk ingest
+    MAX_INGEST_FORM_MEMORY = 16 * 1024 * 1024  # Bytes of form fields, such as labels, bulk ingest holds in memory
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'} # Allowed image extensions
+    TRAINING_WORKERS = 1  # Training worker threads per process
+    INFERENCE_WORKERS = 2  # Inference worker threads per process
+    INFERENCE_PROCESSES = 0  # Processes scoring inference batches with resident models; 0 scores in the worker thread
+    INFERENCE_PROCESS_MODEL_BYTES = 256 * 1024 * 1024  # Memory budget for models kept loaded by each of them
+    FEATURE_WORKERS = 1  # Threads dispatching feature extraction jobs to the process pool
+    FEATURE_PROCESSES = 2  # Processes decoding image headers and hashes; 0 extracts in the worker thread
+    FEATURE_BATCH_SIZE = 256  # Images per feature extraction job
+    INDEX_WORKERS = 1  # Threads rebuilding similarity indexes after feature extraction
+    INDEX_FOLDER = 'index'  # Similarity index segments, one folder per project
+    VECTOR_INDEX_IVF_MIN = 20000  # Projects with this many embeddings get an IVF coarse quantizer; fewer are scanned flat
+    VECTOR_INDEX_LISTS = None  # IVF lists (k-means centroids); None is the square root of the image count
+    VECTOR_INDEX_NPROBE = 8  # IVF lists scanned per query; more is slower and more exact
+    VECTOR_INDEX_DELTA_MIN = 1000  # New embeddings kept in the delta segment before the main one is rebuilt...
+    VECTOR_INDEX_DELTA_FRACTION = 0.05  # ...or this fraction of the main segment, whichever is larger
+    SIMILAR_MAX_K = 100  # Most neighbors one similarity query returns
+    NEAR_DUPLICATE_SIMILARITY = 0.98  # Neighbours at least this similar are flagged as near-duplicates
+    TASK_QUEUE_MAXSIZE = 1000  # Pending jobs per kind before enqueueing returns 429
+    JOB_POLL_INTERVAL = 1.0  # Seconds an idle worker waits before polling the job table
+    JOB_LEASE_SECONDS = 300  # Claimed jobs become claimable again after this long
+    JOB_MAX_ATTEMPTS = 3
+    JOB_CONCURRENCY_LIMITS = {  # Most jobs of a kind running at once per user and per project; None is unlimited
+        'training': {'user': 2, 'project': 1},
+        'inference': {'user': 4, 'project': None},
+        'features': {'user': 2, 'project': None},
+        'index': {'user': None, 'project': 1},  # One rebuild of a project's index at a time
+    }
+    JOB_STATS_WINDOW = 300  # Seconds of recently started jobs behind the wait times of /api/jobs/stats/
+    INFERENCE_BATCH_SIZE = 64  # Images scored per model invocation
+    INFERENCE_BATCH_WAIT = 0.05  # Seconds a worker waits for more same-project jobs to fill a batch
+    TRAINING_BACKEND = 'numpy'  # Name registered with training.register_backend
+    TRAINING_IMAGE_SIZE = 16  # Images are trained on as grayscale squares of this many pixels per side
+    TRAINING_SEED = 0  # Seeds the batch order, so the same data and config give the same model
+    INCREMENTAL_TRAINING = True  # Fine-tune the latest model on new and relabeled images while the config is unchanged
+    INCREMENTAL_MAX_FRACTION = 0.5  # Retrain in full once new and relabeled images exceed this share of the labeled ones
+    PROGRESS_POLL_INTERVAL = 0.5  # Seconds between database checks of a long-poll or event stream of training progress
+    PROGRESS_MAX_WAIT = 30  # Longest a long-poll for training progress is held open
+    PROGRESS_KEEPALIVE = 15  # Seconds between comment lines on an idle event stream
+    LOADER_PROCESSES = 2  # Processes decoding images for training and inference; 0 decodes in the worker thread
+    LOADER_PREFETCH = 2  # Batches decoded ahead of the one being trained on
+    DECODED_CACHE_FOLDER = 'cache'  # Memory-mapped decoded pixels per project; None disables the cache
+    MODEL_FOLDER = 'models'  # Trained models, one .npz file per TrainingResult
+    MODEL_CACHE_BYTES = 512 * 1024 * 1024  # Memory budget for models kept loaded by inference workers
+    REAPER_INTERVAL = 5.0  # Seconds between passes of the thread deleting tombstoned rows; 0 disables it
+    REAPER_BATCH_SIZE = 1000  # Rows per bulk DELETE
+    ORPHAN_GRACE_SECONDS = 3600  # `flask reap --sweep` keeps unreferenced blobs younger than this
+    REAPER_RECHECK_DELAY = 2.0  # Seconds a blob is set aside for uploads that found it to commit before it is unlinked
+    METRICS_ENABLED = True  # Serve Prometheus metrics at GET /metrics
+    PROFILE_SLOW_REQUESTS = None  # Seconds; requests slower than this get their sampled stacks written. None disables
+    PROFILE_INTERVAL = 0.005  # Seconds between stack samples of in-flight requests while profiling
+    PROFILE_FOLDER = 'profiles'  # Collapsed stacks of slow requests, ready for flamegraph.pl or speedscope
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'  # Use an in-memory SQLite database for tests
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    TRAINING_WORKERS = 0  # Tests drive the workers explicitly
+    INFERENCE_WORKERS = 0
+    FEATURE_WORKERS = 0
+    FEATURE_PROCESSES = 0
+    INDEX_WORKERS = 0
+    REAPER_INTERVAL = 0
+    REAPER_RECHECK_DELAY = 0
+    LOADER_PROCESSES = 0
+    DECODED_CACHE_FOLDER = None
+    GROUP_COMMIT = False
+    INFERENCE_BATCH_WAIT = 0
 
 class DevelopmentConfig(Config):
     # Development-specific configuration
@@ -0,0 +1,212 @@
+import os
+import tempfile
+import threading
+from collections import deque
+import process_pool
+import storage
+
+try:
+    import numpy as np
+except ImportError:  # Training and model inference need NumPy; the API itself doesn't
+    np = None
+from features import PILImage
+
+# Batched access to a project's images as model input. Files are decoded to
+# grayscale, scaled to image_size x image_size and flattened, so every batch is
+# one (n, image_size ** 2) float32 array with values in [0, 1].
+#
+# Decoding runs on a process pool a few batches ahead of the consumer. Workers
+# write pixels straight into a memory-mapped .npy file -- a small ring of batch
+# slots in shared memory, or the project's decoded cache -- so nothing but
+# row positions and ok flags is pickled between processes, and the loader's
+# memory use is fixed by batch_size and prefetch whatever the project size.
+
+SHARED_MEMORY_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+PENDING, DECODED, UNDECODABLE = 0, 1, 2
+
+_pool = process_pool.ProcessPool()
+
+
+def decode(path, image_size):
+    """Pixels of one image as a uint8 vector, or None for missing or undecodable files."""
+    try:
+        with PILImage.open(path) as img:
+            img.draft('L', (image_size * 2, image_size * 2))  # JPEGs decode at a fraction of full size
+            pixels = img.convert('L').resize((image_size, image_size))
+            return np.asarray(pixels, dtype=np.uint8).reshape(-1)
+    except (OSError, ValueError):
+        return None
+
+
+def decode_into(target_path, positions, paths, image_size):
+    """Decode ``paths`` into rows ``positions`` of the .npy file at ``target_path``; returns ok flags."""
+    target = np.load(target_path, mmap_mode='r+')
+    ok = []
+    for position, path in zip(positions, paths):
+        pixels = decode(path, image_size)
+        if pixels is not None:
+            target[position] = pixels
+        ok.append(pixels is not None)
+    target.flush()
+    del target
+    return ok
+
+
+def require():
+    if np is None or PILImage is None:
+        raise RuntimeError('Training and inference need NumPy and Pillow')
+
+
+class DecodedCache:
+    """A project's decoded pixels in memory-mapped .npy files, so later epochs and runs skip decoding.
+
+    ``<prefix>-pixels.npy`` holds one row per image in id order, next to
+    ``<prefix>-ids.npy``; ``<prefix>-state.npy`` marks each row pending,
+    decoded or undecodable. Opening it for a different set of images rewrites
+    the files, carrying over the rows already decoded.
+    """
+
+    def __init__(self, prefix, image_ids, num_features):
+        self.prefix = prefix
+        self.pixels_path = f'{prefix}-pixels.npy'
+        ids = np.unique(np.asarray(image_ids, dtype=np.int64))
+        old = self._open(num_features)
+        if old is None or not np.array_equal(old[0], ids):
+            self._rebuild(ids, num_features, old)
+            old = self._open(num_features)
+        self.ids, self.state, self.pixels = old
+        self.positions = np.searchsorted(self.ids, np.asarray(image_ids, dtype=np.int64))
+
+    def _open(self, num_features):
+        try:
+            ids = np.load(f'{self.prefix}-ids.npy')
+            state = np.load(f'{self.prefix}-state.npy', mmap_mode='r+')
+            pixels = np.load(self.pixels_path, mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        if not (len(ids) == len(state) == len(pixels)) or pixels.shape[1:] != (num_features,):
+            return None  # Interrupted rewrite or another image size
+        return ids, state, pixels
+
+    def _rebuild(self, ids, num_features, old):
+        os.makedirs(os.path.dirname(self.prefix) or '.', exist_ok=True)
+        tmp = f'{self.prefix}-{os.getpid()}-{threading.get_ident()}'
+        pixels = np.lib.format.open_memmap(f'{tmp}-pixels.npy', 'w+', np.uint8, (len(ids), num_features))
+        state = np.lib.format.open_memmap(f'{tmp}-state.npy', 'w+', np.int8, (len(ids),))
+        if old is not None:
+            old_ids, old_state, old_pixels = old
+            _, new_rows, old_rows = np.intersect1d(ids, old_ids, assume_unique=True, return_indices=True)
+            for start in range(0, len(new_rows), 4096):  # Bounded copies, however large the project
+                chunk = slice(start, start + 4096)
+                pixels[new_rows[chunk]] = old_pixels[old_rows[chunk]]
+                state[new_rows[chunk]] = old_state[old_rows[chunk]]
+        pixels.flush()
+        state.flush()
+        del pixels, state
+        np.save(f'{tmp}-ids.npy', ids)
+        for name in ('pixels', 'state', 'ids'):
+            os.replace(f'{tmp}-{name}.npy', f'{self.prefix}-{name}.npy')
+
+
+class BatchLoader:
+    """Iterates ``(pixels, targets, rows)`` batches over image rows.
+
+    ``rows`` need ``id``, ``filename`` and ``content_hash`` (see
+    storage.image_path). Files that can't be decoded are left out of their
+    batch and counted in ``skipped``. With ``shuffle`` every pass visits the
+    rows in a new order drawn from ``seed``, so a run is reproducible.
+
+    ``processes`` decode on a process pool with ``prefetch`` batches in
+    flight (0 decodes inline); ``cache_prefix`` keeps decoded pixels in a
+    DecodedCache. The yielded pixel array is reused for the next batch, so
+    consumers must be done with it before asking for another.
+    """
+
+    def __init__(self, upload_folder, rows, batch_size, image_size, targets=None, shuffle=False, seed=0,
+                 processes=0, prefetch=2, cache_prefix=None):
+        require()
+        self.upload_folder = upload_folder
+        self.rows = list(rows)
+        self.targets = np.asarray(targets if targets is not None else [0] * len(self.rows), dtype=np.int64)
+        self.batch_size = max(1, int(batch_size))
+        self.image_size = image_size
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+        self.processes = processes
+        self.prefetch = prefetch if processes else 0
+        self.cache = (DecodedCache(cache_prefix, [row.id for row in self.rows], self.num_features)
+                      if cache_prefix and self.rows else None)
+        self.skipped = 0
+        self._staging = np.empty((self.batch_size, self.num_features), dtype=np.uint8)
+        self._output = np.empty((self.batch_size, self.num_features), dtype=np.float32)
+
+    @property
+    def num_features(self):
+        return self.image_size * self.image_size
+
+    def __len__(self):
+        return -(-len(self.rows) // self.batch_size)
+
+    def __iter__(self):
+        order = self.rng.permutation(len(self.rows)) if self.shuffle else np.arange(len(self.rows))
+        batches = [order[start:start + self.batch_size] for start in range(0, len(order), self.batch_size)]
+        ring_path, ring = None, None
+        if self.cache is None and batches:
+            fd, ring_path = tempfile.mkstemp(dir=SHARED_MEMORY_DIR, prefix='loader-', suffix='.npy')
+            os.close(fd)
+            ring = np.lib.format.open_memmap(ring_path, 'w+', np.uint8,
+                                             ((self.prefetch + 1) * self.batch_size, self.num_features))
+        in_flight = deque()
+        submitted = 0
+        try:
+            for number in range(len(batches)):
+                while submitted < len(batches) and submitted <= number + self.prefetch:
+                    in_flight.append(self._submit(batches[submitted], submitted, ring_path))
+                    submitted += 1
+                kept, source = self._collect(in_flight.popleft(), ring)
+                if len(kept):
+                    pixels = np.multiply(source, np.float32(1 / 255), out=self._output[:len(kept)])
+                    yield pixels, self.targets[kept], [self.rows[i] for i in kept]
+        finally:
+            for task in in_flight:  # Workers must be done with the ring before it goes away
+                if hasattr(task[-1], 'result'):
+                    task[-1].result()
+            if ring_path:
+                del ring
+                os.remove(ring_path)
+
+    def _run(self, target_path, positions, indices):
+        paths = [storage.image_path(self.upload_folder, self.rows[i]) for i in indices]
+        positions = [int(p) for p in positions]
+        if not self.processes:
+            return decode_into(target_path, positions, paths, self.image_size)
+        return _pool.submit(self.processes, decode_into, target_path, positions, paths, self.image_size)
+
+    def _submit(self, indices, number, ring_path):
+        if self.cache is None:
+            start = (number % (self.prefetch + 1)) * self.batch_size
+            return indices, start, self._run(ring_path, range(start, start + len(indices)), indices)
+        positions = self.cache.positions[indices]
+        todo = self.cache.state[positions] == PENDING
+        if not todo.any():
+            return indices, None, None
+        return indices, positions[todo], self._run(self.cache.pixels_path, positions[todo], indices[todo])
+
+    def _collect(self, task, ring):
+        indices, where, result = task
+        ok = np.asarray(result.result() if hasattr(result, 'result') else result, dtype=bool)
+        if self.cache is None:
+            source = ring[where:where + len(indices)]
+            if not ok.all():
+                source = np.compress(ok, source, axis=0, out=self._staging[:int(ok.sum())])
+            kept = indices[ok]
+        else:
+            if where is not None:
+                self.cache.state[where] = np.where(ok, DECODED, UNDECODABLE)
+                self.cache.state.flush()
+            positions = self.cache.positions[indices]
+            decoded = self.cache.state[positions] == DECODED
+            kept = indices[decoded]
+            source = np.take(self.cache.pixels, positions[decoded], axis=0, out=self._staging[:len(kept)])
+        self.skipped += len(indices) - len(kept)
+        return kept, source
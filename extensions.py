@@ -1,6 +1,46 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
 
 db = SQLAlchemy()
 
+
+# Pool settings for the configured database; the in-memory test database keeps Flask-SQLAlchemy's StaticPool
+def engine_options(config):
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        return {}
+    return {
+        'pool_size': config.get('DB_POOL_SIZE', 10),
+        'max_overflow': config.get('DB_MAX_OVERFLOW', 10),
+        'pool_timeout': config.get('DB_POOL_TIMEOUT', 30),
+        'pool_recycle': config.get('DB_POOL_RECYCLE', 1800),
+        'pool_pre_ping': True,
+    }
+
+
+def set_sqlite_pragmas(config):
+    """WAL lets readers run alongside the writer; NORMAL sync is durable in WAL mode except on power loss."""
+    pragmas = [
+        f"PRAGMA journal_mode={config.get('SQLITE_JOURNAL_MODE', 'WAL')}",
+        f"PRAGMA synchronous={config.get('SQLITE_SYNCHRONOUS', 'NORMAL')}",
+        f"PRAGMA busy_timeout={int(config.get('SQLITE_BUSY_TIMEOUT_MS', 5000))}",
+    ]
+
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+    return on_connect
+
+
 def init_app(app):
+    # Explicit SQLALCHEMY_ENGINE_OPTIONS win over the derived pool settings
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        **engine_options(app.config), **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {})}
     db.init_app(app)
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == 'sqlite':
+                event.listen(engine, 'connect', set_sqlite_pragmas(app.config))
@@ -0,0 +1,136 @@
+import os
+import struct
+import process_pool
+
+try:
+    from PIL import Image as PILImage
+except ImportError:  # Perceptual hashes need Pillow; sizes and dimensions don't
+    PILImage = None
+try:
+    import numpy as np
+except ImportError:  # Embeddings need NumPy
+    np = None
+
+# Image metadata extraction. Dimensions and channels come from the PNG/JPEG
+# headers alone; only the perceptual hash and the embedding decode pixels, and
+# for JPEGs at a reduced scale. Everything here runs in worker processes, never
+# on a request thread (save one query image per similarity search).
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_CHANNELS = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}  # By IHDR colour type; palette images expand to RGB
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+HASH_SIZE = 8
+EMBEDDING_SIZE = 16  # Embeddings have EMBEDDING_SIZE ** 2 dimensions
+
+_pool = process_pool.ProcessPool()
+
+
+def _png_header(f):
+    f.seek(8)
+    length, chunk_type = struct.unpack('>I4s', f.read(8))
+    if chunk_type != b'IHDR':
+        return None
+    width, height, _bit_depth, colour_type = struct.unpack('>IIBB', f.read(10))
+    return width, height, PNG_CHANNELS.get(colour_type)
+
+
+def _jpeg_header(f):
+    f.seek(2)
+    while True:
+        byte = f.read(1)
+        if not byte:
+            return None
+        if byte != b'\xff':
+            continue
+        marker = f.read(1)
+        while marker == b'\xff':  # Fill bytes
+            marker = f.read(1)
+        if not marker:
+            return None
+        code = marker[0]
+        if code == 0x01 or 0xD0 <= code <= 0xD9:  # Markers without a length field
+            continue
+        segment = f.read(2)
+        if len(segment) < 2:
+            return None
+        length = struct.unpack('>H', segment)[0]
+        if code in JPEG_SOF_MARKERS:
+            _precision, height, width, channels = struct.unpack('>BHHB', f.read(6))
+            return width, height, channels
+        f.seek(length - 2, os.SEEK_CUR)
+
+
+# (width, height, channels) read from the file header, or None for unknown formats
+def read_header(path):
+    with open(path, 'rb') as f:
+        head = f.read(8)
+        try:
+            if head == PNG_SIGNATURE:
+                return _png_header(f)
+            if head.startswith(b'\xff\xd8'):
+                return _jpeg_header(f)
+        except struct.error:
+            return None
+    return None
+
+
+def perceptual_hash(path):
+    """64-bit difference hash (dHash) as 16 hex digits, or None without Pillow or for undecodable files."""
+    if PILImage is None:
+        return None
+    try:
+        with PILImage.open(path) as img:
+            img.draft('L', (HASH_SIZE * 4, HASH_SIZE * 4))  # JPEGs decode at a fraction of full size
+            pixels = img.convert('L').resize((HASH_SIZE + 1, HASH_SIZE)).tobytes()
+    except (OSError, ValueError):
+        return None
+    bits = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            bits = (bits << 1) | (left > pixels[row * (HASH_SIZE + 1) + col + 1])
+    return f'{bits:016x}'
+
+
+def embed(source, size=EMBEDDING_SIZE):
+    """Unit-length float32 vector of a grayscale size x size thumbnail with its mean removed, as bytes.
+
+    Dot products of embeddings are the correlation of the thumbnails, so they
+    ignore brightness and contrast changes. ``source`` is a path or a file
+    object; None without NumPy and Pillow or for undecodable files.
+    """
+    if PILImage is None or np is None:
+        return None
+    try:
+        with PILImage.open(source) as img:
+            img.draft('L', (size * 2, size * 2))
+            pixels = np.asarray(img.convert('L').resize((size, size), PILImage.BILINEAR), dtype=np.float32)
+    except (OSError, ValueError):
+        return None
+    vector = pixels.reshape(-1) - pixels.mean()
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm else vector).astype(np.float32).tobytes()  # A flat image embeds as zeros
+
+
+# Image columns for one file, or None if the file is gone
+def extract(path):
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return None
+    width, height, channels = read_header(path) or (None, None, None)
+    return {
+        'feature_size': float(size),
+        'width': width,
+        'height': height,
+        'channels': channels,
+        'phash': perceptual_hash(path),
+        'embedding': embed(path),
+    }
+
+
+def extract_many(paths, processes):
+    """Extract metadata for many files on a process pool; ``processes=0`` runs inline."""
+    if not processes:
+        return [extract(path) for path in paths]
+    return _pool.map(processes, extract, paths, chunksize=16)
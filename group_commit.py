@@ -0,0 +1,95 @@
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+from sqlalchemy import insert, update
+from models import db
+import job_queue
+
+logger = logging.getLogger(__name__)
+
+# Workers describe what a finished job writes as a list of (operation, Model, rows)
+# tuples: ('insert', InferenceResult, [{...}]) or ('update', Image, [{'id': ..., ...}]).
+# The writes and the completion of the jobs are applied in one transaction,
+# either directly or through the GroupCommitWriter, which merges the writes of
+# many jobs from many worker threads into a single commit.
+
+
+def apply(writes, lease_tokens):
+    """Execute writes in the current session and mark the jobs holding ``lease_tokens`` done; no commit."""
+    merged = defaultdict(list)
+    for operation, model, rows in writes:
+        merged[(operation, model)].extend(rows)
+    for (operation, model), rows in merged.items():
+        if rows:
+            statement = insert(model) if operation == 'insert' else update(model)
+            db.session.execute(statement, rows)
+    job_queue.complete(lease_tokens)
+
+
+class GroupCommitWriter:
+    """One writer thread per process that commits worker results in groups.
+
+    With SQLite only one connection can write at a time; funnelling every
+    worker's results through a single thread avoids "database is locked"
+    contention and turns one commit (and one fsync) per job into one per group.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.max_batch = app.config.get('GROUP_COMMIT_MAX_BATCH', 256)
+        self.max_delay = app.config.get('GROUP_COMMIT_MAX_DELAY', 0.02)
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='group-commit-writer', daemon=True)
+        self.thread.start()
+
+    def submit(self, writes, lease_tokens):
+        """Queue writes for the next group; the returned Future resolves once they are committed."""
+        future = Future()
+        self.queue.put((writes, lease_tokens, future))
+        return future
+
+    def shutdown(self, timeout=None):
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+    def _run(self):
+        with self.app.app_context():
+            stopping = False
+            while not stopping:
+                item = self.queue.get()
+                if item is None:
+                    break
+                group = [item]
+                deadline = time.monotonic() + self.max_delay
+                while len(group) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    try:
+                        item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        stopping = True
+                        break
+                    group.append(item)
+                self._commit(group)
+            db.session.remove()
+
+    def _commit(self, group):
+        try:
+            apply([w for writes, _, _ in group for w in writes], [t for _, tokens, _ in group for t in tokens])
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            if len(group) > 1:
+                # Commit one by one so a single bad write only fails its own jobs
+                for item in group:
+                    self._commit([item])
+                return
+            logger.exception("Group commit failed")
+            group[0][2].set_exception(e)
+            return
+        for _, _, future in group:
+            future.set_result(None)
@@ -0,0 +1,90 @@
+import functools
+import os
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import wait
+import dataloader
+import process_pool
+import storage
+import training
+from dataloader import np
+
+# Process-based inference. With INFERENCE_PROCESSES, inference workers hand
+# their batches to a pool of spawned processes instead of scoring them in the
+# worker thread, so decoding and model execution use every core rather than
+# taking turns on the GIL.
+#
+# Each pool process keeps the models it has scored with resident, keyed by
+# TrainingResult id and evicted least recently used first past
+# INFERENCE_PROCESS_MODEL_BYTES. A batch gets one shared-memory .npy of pixel
+# rows; every task decodes its slice of the batch straight into it and scores
+# those rows, so only paths, row offsets and labels are pickled. Database
+# access stays with the caller, which reads the images and writes the results.
+
+MIN_CHUNK = 16  # Fewest images worth a task of their own
+
+_pool = process_pool.ProcessPool()
+_models = OrderedDict()  # In a pool process: TrainingResult id -> Classifier
+_model_bytes = 0
+
+
+@functools.lru_cache(maxsize=1024)
+def _image_size(model_path):
+    with np.load(model_path) as data:  # Reads just this member of the archive
+        return int(data['image_size'])
+
+
+def resident_model(version, model_path, max_bytes):
+    """The model of TrainingResult ``version``, loaded into this process on first use."""
+    global _model_bytes
+    model = _models.get(version)
+    if model is not None:
+        _models.move_to_end(version)
+        return model
+    model = _models[version] = training.load_classifier(model_path)
+    _model_bytes += model.nbytes
+    while _model_bytes > max_bytes and len(_models) > 1:
+        _model_bytes -= _models.popitem(last=False)[1].nbytes
+    return model
+
+
+def score_rows(version, model_path, max_bytes, pixels_path, start, paths):
+    """Decode ``paths`` into rows from ``start`` of the .npy at ``pixels_path`` and label them.
+
+    Returns one label per path, None for files that can't be decoded.
+    """
+    model = resident_model(version, model_path, max_bytes)
+    ok = dataloader.decode_into(pixels_path, range(start, start + len(paths)), paths, model.image_size)
+    kept = np.flatnonzero(ok)
+    labels = [None] * len(paths)
+    if len(kept):
+        rows = np.load(pixels_path, mmap_mode='r')[start + kept]
+        for i, index in zip(kept, model.model.predict(np.multiply(rows, np.float32(1 / 255)))):
+            labels[i] = model.classes[index]
+    return labels
+
+
+def predict(version, model_path, images, upload_folder, processes, max_bytes):
+    """Labels for Image rows from the model of TrainingResult ``version`` saved at ``model_path``.
+
+    The batch is split across ``processes`` pool processes; 0 scores it in
+    this thread, with the same shared buffer and resident models.
+    """
+    dataloader.require()
+    paths = [storage.image_path(upload_folder, image) for image in images]
+    if not paths:
+        return []
+    fd, pixels_path = tempfile.mkstemp(dir=dataloader.SHARED_MEMORY_DIR, prefix='inference-', suffix='.npy')
+    os.close(fd)
+    try:
+        size = _image_size(model_path)
+        np.lib.format.open_memmap(pixels_path, 'w+', np.uint8, (len(paths), size * size))  # Header and zeroed rows
+        if not processes:
+            return score_rows(version, model_path, max_bytes, pixels_path, 0, paths)
+        chunk = max(MIN_CHUNK, -(-len(paths) // processes))
+        futures = [_pool.submit(processes, score_rows, version, model_path, max_bytes, pixels_path, start,
+                                paths[start:start + chunk]) for start in range(0, len(paths), chunk)]
+        wait(futures)  # Every task is done with the buffer before it goes away
+        return [label for future in futures for label in future.result()]
+    finally:
+        os.remove(pixels_path)
@@ -0,0 +1,136 @@
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import zipfile
+
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.sansio.multipart import NEED_DATA, Epilogue, Field, File, MultipartDecoder
+
+# Readers for bulk image ingest. Each yields (name, stream, label) one file at a
+# time so the caller can stream it into storage before the next is read; nothing
+# holds a whole archive in memory.
+
+TAR_MIMETYPES = {'application/x-tar', 'application/gzip', 'application/x-gzip', 'application/x-gtar'}
+ZIP_MIMETYPES = {'application/zip', 'application/x-zip-compressed'}
+
+
+# Archives follow the class-per-directory convention: cats/1.png is labelled "cats"
+def label_from_path(name):
+    parent = os.path.dirname(name.strip('/'))
+    return os.path.basename(parent)
+
+
+def _skip(name):
+    base = os.path.basename(name)
+    return base.startswith('.') or name.startswith('__MACOSX/')
+
+
+class MultipartReader:
+    """The parts of a multipart body, decoded as the body is read.
+
+    Iterating yields the Field or File event heading each part; ``read`` then
+    returns the part's data, and whatever of it is left unread is skipped when
+    the next part is asked for.
+    """
+
+    def __init__(self, stream, boundary, chunk_size, max_parts=None):
+        self.stream, self.chunk_size = stream, chunk_size
+        self.decoder = MultipartDecoder(boundary, max_parts=max_parts)
+        self.pending, self.in_part = b'', False
+
+    def _event(self):
+        event = self.decoder.next_event()
+        while event is NEED_DATA:
+            self.decoder.receive_data(self.stream.read(self.chunk_size) or None)
+            event = self.decoder.next_event()
+        return event
+
+    def read(self, size):
+        """Up to ``size`` more bytes of the current part; b'' at its end."""
+        while not self.pending and self.in_part:
+            event = self._event()
+            self.pending, self.in_part = event.data, event.more_data
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+    def __iter__(self):
+        while True:
+            while self.read(self.chunk_size):
+                pass
+            event = self._event()
+            if isinstance(event, Epilogue):
+                return
+            if isinstance(event, (Field, File)):
+                self.in_part = True
+                yield event
+
+
+def _read_field(reader, max_size):
+    value = bytearray()
+    while chunk := reader.read(reader.chunk_size):
+        value += chunk
+        if max_size is not None and len(value) > max_size:
+            raise RequestEntityTooLarge()
+    return value.decode()
+
+
+def _parse_labels(value):
+    try:
+        labels = json.loads(value)
+    except ValueError:
+        labels = None
+    if not isinstance(labels, dict) or not all(isinstance(label, str) for label in labels.values()):
+        raise ValueError('labels must be a JSON object mapping filenames to label strings')
+    return labels
+
+
+# Multipart files take their label from the optional "labels" field, a JSON object of filename -> label, else
+# from the "label" field. The body is parsed as it streams in, so fields label only the files after them, the
+# order browsers, requests and werkzeug send them in; fields are held in memory up to max_form_memory_size
+def iter_multipart(request, chunk_size):
+    if request.mimetype != 'multipart/form-data':
+        return
+    boundary = request.mimetype_params.get('boundary')
+    if not boundary:
+        raise ValueError('multipart body without a boundary')
+    reader = MultipartReader(request.stream, boundary.encode(), chunk_size, request.max_form_parts)
+    labels, default_label = {}, ''
+    for part in reader:
+        if isinstance(part, File):
+            if part.name in ('files', 'file'):
+                yield part.filename, reader, labels.get(part.filename, default_label)
+        elif part.name == 'labels':
+            labels = _parse_labels(_read_field(reader, request.max_form_memory_size))
+        elif part.name == 'label':
+            default_label = _read_field(reader, request.max_form_memory_size)
+
+
+def iter_tar(stream):
+    # Stream mode ('r|*') reads members sequentially and never seeks, so it works on a request body
+    with tarfile.open(fileobj=stream, mode='r|*') as archive:
+        for member in archive:
+            if member.isfile() and not _skip(member.name):
+                yield member.name, archive.extractfile(member), label_from_path(member.name)
+
+
+def iter_zip(stream, spool_dir, chunk_size):
+    # The zip index sits at the end of the file, so spool the body to disk (not memory) first
+    with tempfile.TemporaryFile(dir=spool_dir) as spool:
+        shutil.copyfileobj(stream, spool, chunk_size)
+        spool.seek(0)
+        with zipfile.ZipFile(spool) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or _skip(info.filename):
+                    continue
+                with archive.open(info) as member:
+                    yield info.filename, member, label_from_path(info.filename)
+
+
+def iter_request(request, spool_dir, chunk_size):
+    if request.mimetype in TAR_MIMETYPES:
+        return iter_tar(request.stream)
+    if request.mimetype in ZIP_MIMETYPES:
+        return iter_zip(request.stream, spool_dir, chunk_size)
+    return iter_multipart(request, chunk_size)
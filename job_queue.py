@@ -0,0 +1,324 @@
+import queue
+import uuid
+import zlib
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import and_, case, func, or_, select, true, update
+from sqlalchemy.orm import aliased
+from models import Job, Project, db
+
+# Durable job queue stored in the Job table. Any number of worker threads,
+# processes or hosts pointed at the same database can drain it: a job is
+# claimed under a lease, and a job whose lease expires (crashed worker) is
+# claimable again.
+#
+# Claims are scheduled rather than FIFO: a kind's queue is served by priority
+# class, then round-robin across users (Job.user_seq numbers the rounds: a
+# job joins the round being served when it is enqueued, or the round after
+# its user's last queued job, so one user's 500 jobs interleave with everyone
+# else's), then age. JOB_CONCURRENCY_LIMITS caps how many jobs
+# of a kind run at once per user and per project; jobs over a cap wait while
+# other users' jobs are claimed. SQLite runs the counting UPDATE under its
+# single writer lock; on Postgres, where SKIP LOCKED claimers count
+# concurrently, a claim serializes on transaction advisory locks for the
+# candidate's user and project and counts again before taking it.
+
+# Priority classes, most urgent first
+PRIORITIES = {'interactive': 0, 'batch': 1, 'training': 2, 'background': 3}
+DEFAULT_PRIORITIES = {'inference': 'interactive', 'training': 'training', 'features': 'background',
+                      'index': 'background'}
+PRIORITY_CLASSES = {value: name for name, value in PRIORITIES.items()}
+CLAIM_ATTEMPTS = 3  # Candidates a Postgres claim tries when concurrent claims fill their limits
+
+
+# Queued jobs, and running ones whose lease expired with attempts left (see fail_abandoned for the others)
+def _claimable(model, kind, now, project_id=None):
+    condition = and_(
+        model.kind == kind,
+        or_(model.status == 'queued',
+            and_(model.status == 'running', model.lease_expires_at < now,
+                 model.attempts < current_app.config.get('JOB_MAX_ATTEMPTS', 3))),
+    )
+    if project_id is not None:
+        condition = and_(condition, model.project_id == project_id)
+    return condition
+
+
+def _running(model, now):
+    return and_(model.status == 'running', model.lease_expires_at >= now)
+
+
+# The candidate's user and project are both below their JOB_CONCURRENCY_LIMITS for the kind
+def _under_limits(candidate, kind, now):
+    limits = current_app.config.get('JOB_CONCURRENCY_LIMITS', {}).get(kind) or {}
+    conditions = []
+    for scope, column in (('user', 'user_id'), ('project', 'project_id')):
+        if limits.get(scope):
+            running = aliased(Job)
+            count = (select(func.count()).select_from(running)
+                     .where(running.kind == kind, getattr(running, column) == getattr(candidate, column),
+                            _running(running, now))
+                     .scalar_subquery())
+            conditions.append(count < limits[scope])
+    return and_(true(), *conditions)
+
+
+def _lock_key(kind, scope):
+    """A stable signed 32-bit advisory lock class for a kind's user or project limit."""
+    key = zlib.crc32(f'job-limit:{kind}:{scope}'.encode())
+    return key - (1 << 32) if key >= 1 << 31 else key
+
+
+# Whether job still fits its user's and project's limits, counted while holding the advisory
+# locks of both, which other claimers of the same user or project wait on until we commit
+def _still_under_limits(job, kind, now):
+    limits = current_app.config.get('JOB_CONCURRENCY_LIMITS', {}).get(kind) or {}
+    scopes = [(scope, column, getattr(job, column))
+              for scope, column in (('user', 'user_id'), ('project', 'project_id'))
+              if limits.get(scope) and getattr(job, column) is not None]
+    for scope, _column, value in scopes:  # Always user before project, so claimers can't deadlock
+        db.session.execute(select(func.pg_advisory_xact_lock(_lock_key(kind, scope), value)))
+    for scope, column, value in scopes:
+        running = db.session.scalar(select(func.count()).select_from(Job)
+                                    .where(Job.kind == kind, getattr(Job, column) == value, _running(Job, now)))
+        if running >= limits[scope]:
+            return False
+    return True
+
+
+# Add a job, refusing it when the backlog for its kind is full
+def enqueue(kind, project_id, payload=None, priority=None):
+    return enqueue_many(kind, project_id, [payload], priority)[0]
+
+
+# Add several jobs in one transaction; all are refused if they don't fit in the backlog
+def enqueue_many(kind, project_id, payloads, priority=None):
+    maxsize = current_app.config.get('TASK_QUEUE_MAXSIZE', 0)
+    if maxsize:
+        pending = Job.query.filter_by(kind=kind, status='queued').count()
+        if pending + len(payloads) > maxsize:
+            raise queue.Full
+    user_id = db.session.query(Project.user_id).filter(Project.id == project_id).scalar()
+    priority = PRIORITIES[priority or DEFAULT_PRIORITIES.get(kind, 'background')]
+    # A user's jobs join the round being served now, or follow the user's last queued job: user_seq
+    # only grows per user, so later jobs never overtake (and starve) the ones queued before them
+    head, last = (db.session.query(func.min(Job.user_seq),
+                                   func.max(case((Job.user_id == user_id, Job.user_seq))))
+                  .filter(Job.kind == kind, Job.status == 'queued', Job.priority == priority).one())
+    start = max(head or 0, last + 1 if last is not None and user_id is not None else 0)
+    jobs = [Job(kind=kind, project_id=project_id, user_id=user_id, payload=payload, status='queued',
+                priority=priority, user_seq=start + i)
+            for i, payload in enumerate(payloads)]
+    db.session.add_all(jobs)
+    db.session.commit()
+    return jobs
+
+
+def enqueue_coalesced(kind, project_id, payload=None, priority=None, merge=None):
+    """Add a job unless the same one is still queued; returns ``(job, coalesced)``.
+
+    A queued job of the kind, project and priority class with an equal payload
+    is returned instead of adding another. With ``merge`` any such queued job
+    is reused, its payload becoming ``merge(queued_payload, payload)``, for
+    work where one run can serve both requests.
+    """
+    level = PRIORITIES[priority or DEFAULT_PRIORITIES.get(kind, 'background')]
+    pending = (Job.query.filter_by(kind=kind, status='queued', project_id=project_id, priority=level)
+               .order_by(Job.id).all())
+    for job in pending:
+        if job.payload == payload:
+            return job, True
+        if merge is not None:
+            result = db.session.execute(
+                update(Job).where(Job.id == job.id, Job.status == 'queued').values(payload=merge(job.payload, payload))
+                .execution_options(synchronize_session=False))
+            db.session.commit()
+            if result.rowcount:
+                return job, True
+    return enqueue(kind, project_id, payload, priority), False
+
+
+def _schedule_order(model):
+    return model.priority, model.user_seq, model.id
+
+
+def _lease(worker_id):
+    now = datetime.utcnow()
+    lease = timedelta(seconds=current_app.config.get('JOB_LEASE_SECONDS', 300))
+    return now, {
+        'status': 'running',
+        'worker_id': worker_id,
+        'lease_token': uuid.uuid4().hex,
+        'lease_expires_at': now + lease,
+        'started_at': now,
+        'attempts': Job.attempts + 1,
+    }
+
+
+# Claim the next claimable job of a kind for worker_id, or return None. With project_id only
+# that project's jobs are considered, to fill a micro-batch the worker already holds, so the
+# concurrency limits are not applied again.
+def claim(kind, worker_id, project_id=None):
+    now, values = _lease(worker_id)
+
+    if db.engine.dialect.name == 'postgresql':
+        # Row lock the candidate; concurrent claimers skip it instead of waiting
+        condition = _claimable(Job, kind, now, project_id)
+        if project_id is None:
+            condition = and_(condition, _under_limits(Job, kind, now))
+        stmt = (select(Job).where(condition).order_by(*_schedule_order(Job))
+                .limit(1).with_for_update(skip_locked=True))
+        for _attempt in range(CLAIM_ATTEMPTS):
+            job = db.session.execute(stmt).scalar_one_or_none()
+            if job is None:
+                db.session.rollback()
+                return None
+            if project_id is None and not _still_under_limits(job, kind, now):
+                db.session.rollback()  # A concurrent claim filled the limit; its job now counts, so look again
+                continue
+            db.session.execute(update(Job).where(Job.id == job.id).values(**values))
+            db.session.commit()
+            return db.session.get(Job, job.id)
+        return None
+
+    # Single UPDATE picking and taking the candidate atomically; whoever loses the race updates no rows
+    candidate = aliased(Job)
+    condition = _claimable(candidate, kind, now, project_id)
+    if project_id is None:
+        condition = and_(condition, _under_limits(candidate, kind, now))
+    next_id = (select(candidate.id).where(condition)
+               .order_by(*_schedule_order(candidate)).limit(1).scalar_subquery())
+    result = db.session.execute(
+        update(Job).where(Job.id == next_id, _claimable(Job, kind, now, project_id)).values(**values)
+        .execution_options(synchronize_session=False))
+    db.session.commit()
+    if result.rowcount == 0:
+        return None
+    return Job.query.filter_by(lease_token=values['lease_token']).first()
+
+
+# Claim up to limit claimable jobs of one project for worker_id in a single statement, under one
+# lease token, to fill a micro-batch (no concurrency limits, as in claim with project_id). The
+# jobs come back detached from the session with their claim-time values, so the caller's later
+# commits don't expire them and reading them never goes back to the database.
+def claim_many(kind, worker_id, project_id, limit):
+    if limit <= 0:
+        return []
+    now, values = _lease(worker_id)
+    if db.engine.dialect.name == 'postgresql':
+        ids = db.session.scalars(
+            select(Job.id).where(_claimable(Job, kind, now, project_id)).order_by(*_schedule_order(Job))
+            .limit(limit).with_for_update(skip_locked=True)).all()
+        if not ids:
+            db.session.rollback()
+            return []
+        db.session.execute(update(Job).where(Job.id.in_(ids)).values(**values)
+                           .execution_options(synchronize_session=False))
+    else:
+        candidate = aliased(Job)
+        ids = (select(candidate.id).where(_claimable(candidate, kind, now, project_id))
+               .order_by(*_schedule_order(candidate)).limit(limit))
+        result = db.session.execute(
+            update(Job).where(Job.id.in_(ids), _claimable(Job, kind, now, project_id)).values(**values)
+            .execution_options(synchronize_session=False))
+        if result.rowcount == 0:
+            db.session.commit()
+            return []
+    db.session.commit()
+    jobs = Job.query.filter_by(lease_token=values['lease_token']).order_by(*_schedule_order(Job)).all()
+    for job in jobs:
+        db.session.expunge(job)
+    return jobs
+
+
+# Put jobs claimed but not started back in the queue as they were, in one statement
+def release(jobs):
+    if not jobs:
+        return
+    db.session.execute(
+        update(Job).where(Job.id.in_([job.id for job in jobs]), Job.status == 'running',
+                          Job.lease_token.in_({job.lease_token for job in jobs}))
+        .values(status='queued', worker_id=None, lease_token=None, lease_expires_at=None, started_at=None,
+                attempts=Job.attempts - 1)
+        .execution_options(synchronize_session=False))
+    db.session.commit()
+
+
+# Mark the jobs claimed under lease_tokens finished, in the caller's transaction. A job whose
+# lease expired and was claimed again carries a new token and is left to its new owner.
+def complete(lease_tokens):
+    if not lease_tokens:
+        return
+    db.session.execute(
+        update(Job).where(Job.lease_token.in_(lease_tokens), Job.status == 'running')
+        .values(status='done', finished_at=datetime.utcnow(), lease_expires_at=None)
+        .execution_options(synchronize_session=False))
+
+
+# Requeue a failed job, or give up once it has used all its attempts. Like complete, this is fenced
+# by the lease: a worker whose lease expired leaves the job to whoever claimed it since.
+def fail(job, error):
+    db.session.rollback()
+    exhausted = Job.attempts >= current_app.config.get('JOB_MAX_ATTEMPTS', 3)
+    db.session.execute(
+        update(Job).where(Job.id == job.id, Job.lease_token == job.lease_token, Job.status == 'running')
+        .values(status=case((exhausted, 'failed'), else_='queued'), error=str(error)[:256], lease_expires_at=None,
+                finished_at=case((exhausted, datetime.utcnow()), else_=None))
+        .execution_options(synchronize_session=False))
+    db.session.commit()
+
+
+# Fail running jobs whose lease expired on their last attempt. Their worker died, possibly killed by the job
+# itself (out of memory, a crash in native code), so claiming them again could only repeat that forever
+def fail_abandoned():
+    now = datetime.utcnow()
+    max_attempts = current_app.config.get('JOB_MAX_ATTEMPTS', 3)
+    result = db.session.execute(
+        update(Job).where(Job.status == 'running', Job.lease_expires_at < now, Job.attempts >= max_attempts)
+        .values(status='failed', error=f'Lease expired on attempt {max_attempts}', lease_expires_at=None,
+                finished_at=now)
+        .execution_options(synchronize_session=False))
+    db.session.commit()
+    return result.rowcount
+
+
+def _seconds_between(start, end):
+    if db.engine.dialect.name == 'postgresql':
+        return func.date_part('epoch', end - start)
+    return (func.julianday(end) - func.julianday(start)) * 86400.0
+
+
+def depth():
+    """Queued and running jobs as (kind, priority class, status, count) rows."""
+    rows = (db.session.query(Job.kind, Job.priority, Job.status, func.count())
+            .filter(Job.status.in_(('queued', 'running'))).group_by(Job.kind, Job.priority, Job.status).all())
+    db.session.rollback()
+    return [(kind, PRIORITY_CLASSES.get(priority, 'background'), status, count)
+            for kind, priority, status, count in rows]
+
+
+def stats(window_seconds=300):
+    """Queue depth and wait times per priority class.
+
+    ``queued``/``running`` count the jobs now waiting and in flight, with the
+    wait of the oldest queued one; ``started`` and the mean/max wait cover
+    jobs claimed in the last ``window_seconds``.
+    """
+    now = datetime.utcnow()
+    classes = {name: {'queued': 0, 'running': 0, 'oldest_wait_seconds': None, 'started': 0,
+                      'mean_wait_seconds': None, 'max_wait_seconds': None} for name in PRIORITIES}
+    depth = (db.session.query(Job.priority, Job.status, func.count(), func.min(Job.created_at))
+             .filter(Job.status.in_(('queued', 'running'))).group_by(Job.priority, Job.status))
+    for priority, status, count, oldest in depth:
+        entry = classes[PRIORITY_CLASSES.get(priority, 'background')]
+        entry[status] += count
+        if status == 'queued':
+            entry['oldest_wait_seconds'] = max(entry['oldest_wait_seconds'] or 0, (now - oldest).total_seconds())
+    wait = _seconds_between(Job.created_at, Job.started_at)
+    waits = (db.session.query(Job.priority, func.count(), func.avg(wait), func.max(wait))
+             .filter(Job.started_at >= now - timedelta(seconds=window_seconds)).group_by(Job.priority))
+    for priority, count, mean, longest in waits:
+        entry = classes[PRIORITY_CLASSES.get(priority, 'background')]
+        entry.update(started=count, mean_wait_seconds=mean, max_wait_seconds=longest)
+    db.session.rollback()
+    return classes
@@ -0,0 +1,390 @@
+import contextvars
+import logging
+import math
+import os
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from datetime import datetime
+from flask import Response, current_app, g, request
+from sqlalchemy import event
+from extensions import db
+import job_queue
+
+logger = logging.getLogger(__name__)
+
+# Instrumentation served in the Prometheus text format at GET /metrics.
+#
+# Metrics live in a per-app Registry (app.extensions['metrics']) and are kept
+# per process, like the memory cache: behind several server processes, scrape
+# each one. Request hooks time every route and count the SQL it runs; worker
+# code records job wait and run times; queue depth and the model cache are read
+# when /metrics is scraped. With PROFILE_SLOW_REQUESTS set, a sampling profiler
+# follows every request thread and writes the collapsed stacks of requests
+# slower than that many seconds to PROFILE_FOLDER, one "frame;frame;frame count"
+# line per distinct stack (the input of flamegraph.pl and speedscope).
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+JOB_BUCKETS = (0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+THROUGHPUT_BUCKETS = (64e3, 256e3, 1e6, 4e6, 16e6, 64e6, 256e6)  # Bytes per second
+
+# SQL of the request being served by this thread, None outside requests
+_request_stats = contextvars.ContextVar('request_stats', default=None)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}  # Label values tuple -> value
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} takes labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key, extra=()):
+        pairs = [*zip(self.labelnames, key), *extra]
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    def clear(self):
+        with self._lock:
+            self.values.clear()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = sorted(self.values.items())
+            lines += self._samples(items)
+        return lines
+
+    def _samples(self, items):
+        return [f'{self.name}{self._labels(key)} {_number(value)}' for key, value in items]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]  # Bucket counts, sum, count
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def _samples(self, items):
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{self._labels(key, [("le", _number(bound))])} {cumulative}')
+            lines.append(f'{self.name}_sum{self._labels(key)} {_number(total)}')
+            lines.append(f'{self.name}_count{self._labels(key)} {count}')
+        return lines
+
+
+class Registry:
+    """Named metrics plus collectors that refresh gauges just before each scrape."""
+
+    def __init__(self, prefix='diyml_'):
+        self.prefix = prefix
+        self.metrics = []
+        self.collectors = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._add(Counter(self.prefix + name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._add(Gauge(self.prefix + name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(self.prefix + name, documentation, labelnames, buckets))
+
+    def render(self):
+        for collect in self.collectors:
+            try:
+                collect()
+            except Exception:
+                logger.exception("Metrics collector %s failed", getattr(collect, '__name__', collect))
+        return '\n'.join(line for metric in self.metrics for line in metric.render()) + '\n'
+
+
+class Metrics:
+    """The app's metrics."""
+
+    def __init__(self):
+        self.registry = registry = Registry()
+        self.request_seconds = registry.histogram(
+            'http_request_duration_seconds', 'Time to serve a request, by route.', ('endpoint', 'method', 'status'))
+        self.request_queries = registry.histogram(
+            'http_request_db_queries', 'SQL statements executed per request.', ('endpoint',), QUERY_COUNT_BUCKETS)
+        self.request_db_seconds = registry.histogram(
+            'http_request_db_seconds', 'Time spent executing SQL per request.', ('endpoint',))
+        self.db_queries = registry.counter(
+            'db_queries_total', 'SQL statements executed, by requests or by workers.', ('source',))
+        self.db_seconds = registry.counter(
+            'db_query_seconds_total', 'Time spent executing SQL, by requests or by workers.', ('source',))
+        self.queue_depth = registry.gauge(
+            'job_queue_depth', 'Jobs queued or running, by kind and priority class.', ('kind', 'priority', 'status'))
+        self.job_wait_seconds = registry.histogram(
+            'job_wait_seconds', 'Time from enqueue to claim of jobs run in this process.', ('kind',), JOB_BUCKETS)
+        self.job_run_seconds = registry.histogram(
+            'job_run_seconds', 'Time to run a claimed batch of jobs and commit its results.', ('kind', 'outcome'),
+            JOB_BUCKETS)
+        self.jobs = registry.counter('jobs_total', 'Jobs run in this process, by outcome.', ('kind', 'outcome'))
+        self.jobs_rejected = registry.counter(
+            'jobs_rejected_total', 'Enqueue requests refused because the queue was full.', ('kind',))
+        self.upload_bytes = registry.counter(
+            'upload_bytes_total', 'Bytes of uploaded files received; rate() gives bytes per second.')
+        self.upload_files = registry.counter('upload_files_total', 'Uploaded files received.')
+        self.upload_throughput = registry.histogram(
+            'upload_bytes_per_second', 'Upload request body throughput, from request start to the last file stored.',
+            buckets=THROUGHPUT_BUCKETS)
+        self.model_cache = registry.gauge(
+            'model_cache', 'Models held by the inference model cache (models, bytes, hits, misses, evictions).',
+            ('stat',))
+        self.inference_cache = registry.counter(
+            'inference_cache_images_total', 'Images of inference requests answered from the result cache (hit) '
+            'or queued for scoring (miss).', ('outcome',))
+        self.profiles = registry.counter('slow_request_profiles_total', 'Slow request profiles written.')
+
+
+class SlowRequestProfiler:
+    """Samples the stack of every thread serving a request each ``interval`` seconds."""
+
+    def __init__(self, interval, threshold, folder):
+        self.interval = interval
+        self.threshold = threshold
+        self.folder = folder
+        self.active = {}  # Thread ident -> Counter of folded stacks
+        self.thread = None
+        self._lock = threading.Lock()
+
+    def begin(self):
+        with self._lock:
+            self.active[threading.get_ident()] = StackCounter()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='slow-request-profiler', daemon=True)
+                self.thread.start()
+
+    def end(self):
+        with self._lock:
+            return self.active.pop(threading.get_ident(), None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, stacks in self.active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stacks[fold(frame)] += 1
+            del frames
+
+    def dump(self, stacks, endpoint, seconds):
+        """Write the collapsed stacks of a slow request; returns the file's path."""
+        os.makedirs(self.folder, exist_ok=True)
+        name = f"{datetime.utcnow():%Y%m%dT%H%M%S.%f}-{endpoint or 'unknown'}-{seconds * 1000:.0f}ms.folded"
+        path = os.path.join(self.folder, name)
+        with open(path, 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        return path
+
+
+def fold(frame):
+    """A stack as root-first "module:function" frames joined by semicolons."""
+    names = []
+    while frame is not None:
+        names.append(f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_name}")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def init_app(app):
+    metrics = Metrics()
+    app.extensions['metrics'] = metrics
+    threshold = app.config.get('PROFILE_SLOW_REQUESTS')
+    profiler = None
+    if threshold is not None:
+        profiler = SlowRequestProfiler(app.config.get('PROFILE_INTERVAL', 0.005), threshold,
+                                       app.config.get('PROFILE_FOLDER', 'profiles'))
+    app.extensions['profiler'] = profiler
+
+    with app.app_context():
+        for engine in db.engines.values():
+            _instrument_engine(engine, metrics)
+    _instrument_requests(app, metrics, profiler)
+    metrics.registry.collectors += [_queue_depth_collector(metrics), _model_cache_collector(app, metrics)]
+    if app.config.get('METRICS_ENABLED', True):
+        app.add_url_rule('/metrics', 'metrics', metrics_view)
+    return metrics
+
+
+def _instrument_requests(app, metrics, profiler):
+    @app.before_request
+    def start_request():
+        g.metrics_started = time.perf_counter()
+        g.metrics_sql = [0, 0.0]  # Statements, seconds
+        _request_stats.set(g.metrics_sql)
+        if profiler is not None:
+            profiler.begin()
+
+    @app.after_request
+    def record_status(response):
+        g.metrics_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def finish_request(exc):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return
+        seconds = time.perf_counter() - started
+        _request_stats.set(None)
+        queries, sql_seconds = g.pop('metrics_sql')
+        endpoint = request.endpoint or 'none'
+        status = g.pop('metrics_status', 500)
+        metrics.request_seconds.observe(seconds, endpoint=endpoint, method=request.method, status=status)
+        metrics.request_queries.observe(queries, endpoint=endpoint)
+        metrics.request_db_seconds.observe(sql_seconds, endpoint=endpoint)
+        if profiler is not None:
+            _dump_if_slow(profiler, metrics, endpoint, seconds, queries, sql_seconds)
+
+
+def _dump_if_slow(profiler, metrics, endpoint, seconds, queries, sql_seconds):
+    stacks = profiler.end()
+    if seconds >= profiler.threshold and stacks:
+        path = profiler.dump(stacks, endpoint, seconds)
+        metrics.profiles.inc()
+        logger.warning("Slow request %s %s: %.0f ms, %d queries (%.0f ms); stacks in %s",
+                       request.method, request.path, seconds * 1000, queries, sql_seconds * 1000, path)
+
+
+def _instrument_engine(engine, metrics):
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+    def after_execute(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info['metrics_started'].pop()
+        stats = _request_stats.get()
+        if stats is not None:
+            stats[0] += 1
+            stats[1] += seconds
+        source = 'worker' if stats is None else 'request'
+        metrics.db_queries.inc(source=source)
+        metrics.db_seconds.inc(seconds, source=source)
+
+    event.listen(engine, 'before_cursor_execute', before_execute)
+    event.listen(engine, 'after_cursor_execute', after_execute)
+
+
+def _queue_depth_collector(metrics):
+    def collect_queue_depth():
+        metrics.queue_depth.clear()  # Kinds and classes with no jobs left drop out
+        for kind, priority, status, count in job_queue.depth():
+            metrics.queue_depth.set(count, kind=kind, priority=priority, status=status)
+    return collect_queue_depth
+
+
+def _model_cache_collector(app, metrics):
+    def collect_model_cache():
+        for stat, value in app.extensions['model_cache'].stats().items():
+            metrics.model_cache.set(value, stat=stat)
+    return collect_model_cache
+
+
+def metrics_view():
+    return Response(get_metrics().registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+def get_metrics():
+    return current_app.extensions['metrics']
+
+
+def record_upload(nbytes, files=1):
+    """Count stored upload bytes; the request's throughput is measured from its start."""
+    metrics = get_metrics()
+    metrics.upload_bytes.inc(nbytes)
+    metrics.upload_files.inc(files)
+    started = g.get('metrics_started')
+    if started is not None and nbytes:
+        metrics.upload_throughput.observe(nbytes / max(time.perf_counter() - started, 1e-6))
+
+
+def job_waits(jobs):
+    """Seconds each job of a claimed batch waited, read while the claim's values are at hand."""
+    return [(job.started_at - job.created_at).total_seconds() for job in jobs if job.started_at and job.created_at]
+
+
+def record_jobs(kind, count, waits, seconds, outcome):
+    """Record the ``waits`` of a batch of ``count`` jobs (see job_waits) and the batch's run time."""
+    metrics = get_metrics()
+    for wait in waits:
+        metrics.job_wait_seconds.observe(wait, kind=kind)
+    metrics.job_run_seconds.observe(seconds, kind=kind, outcome=outcome)
+    metrics.jobs.inc(count, kind=kind, outcome=outcome)
+
+
+def record_rejected(kind):
+    get_metrics().jobs_rejected.inc(kind=kind)
+
+
+def record_inference_cache(hits=0, misses=0):
+    metrics = get_metrics()
+    if hits:
+        metrics.inference_cache.inc(hits, outcome='hit')
+    if misses:
+        metrics.inference_cache.inc(misses, outcome='miss')
@@ -0,0 +1,56 @@
+import click
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateColumn
+from extensions import db
+import models  # noqa: F401 -- registers every table on db.metadata
+
+# Additive schema upgrades for databases created by an older version of the
+# models (e.g. instance/project.db, dev.db). Missing tables, nullable columns
+# and indexes are created in place; nothing is dropped or rewritten, so running
+# it twice is a no-op.
+
+
+def upgrade(engine=None):
+    """Bring the database up to the current models; returns a list of the changes made."""
+    engine = engine or db.engine
+    changes = []
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+        existing_tables = set(inspector.get_table_names())
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                table.create(conn)
+                changes.append(f'create table {table.name}')
+                continue
+            existing_columns = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                if not column.nullable and column.server_default is None:
+                    raise RuntimeError(f'Cannot add non-nullable column {table.name}.{column.name} in place')
+                # Both names quoted as the dialect needs: "user" is a reserved word on Postgres
+                table_sql = conn.dialect.identifier_preparer.format_table(table)
+                column_sql = CreateColumn(column).compile(dialect=conn.dialect)  # Quotes its name with format_column
+                conn.execute(text(f'ALTER TABLE {table_sql} ADD COLUMN {column_sql}'))
+                changes.append(f'add column {table.name}.{column.name}')
+            existing_indexes = {i['name'] for i in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(conn)
+                    changes.append(f'create index {index.name}')
+        if changes and conn.dialect.name == 'sqlite':
+            conn.execute(text('ANALYZE'))  # Refresh planner statistics for the new indexes
+    return changes
+
+
+@click.command('upgrade-db')
+def upgrade_db_command():
+    """Create missing tables, columns and indexes in the configured database."""
+    changes = upgrade()
+    for change in changes:
+        click.echo(change)
+    click.echo(f'{len(changes)} schema changes applied')
+
+
+def init_app(app):
+    app.cli.add_command(upgrade_db_command)
@@ -1,10 +1,27 @@
 from extensions import db
 from datetime import datetime
+from sqlalchemy import event
+from sqlalchemy.orm import Session, with_loader_criteria
 from werkzeug.security import generate_password_hash, check_password_hash
 
+# Deleting a user, project or image only tombstones it by setting deleted_at;
+# the reaper (reaper.py) removes tombstoned rows, their results and their files
+# in the background. ORM queries skip tombstoned rows unless executed with
+# execution_options(include_deleted=True).
+class SoftDelete:
+    deleted_at = db.Column(db.DateTime, nullable=True, index=True)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _hide_deleted(execute_state):
+    # Also applied to lazy loads, so relationships such as Project.images hide tombstones too
+    if execute_state.is_select and not execute_state.execution_options.get('include_deleted', False):
+        execute_state.statement = execute_state.statement.options(
+            with_loader_criteria(SoftDelete, lambda cls: cls.deleted_at.is_(None), include_aliases=True))
+
 # Model
 # User Model
-class User(db.Model):
+class User(SoftDelete, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     password_hash = db.Column(db.String(128))
@@ -17,26 +34,41 @@ class User(db.Model):
         return check_password_hash(self.password_hash, password)
 
 # Project Model
-class Project(db.Model):
+class Project(SoftDelete, db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
     project_type = db.Column(db.String(50), nullable=False)
     name = db.Column(db.String(100), nullable=True)
     images = db.relationship('Image', backref='project', lazy=True)
     training_config = db.relationship('TrainingConfig', uselist=False, back_populates='project')
 
 # Image Model
-class Image(db.Model):
+class Image(SoftDelete, db.Model):
+    __table_args__ = (
+        db.Index('ix_image_project_feature_size', 'project_id', 'feature_size'),
+        db.Index('ix_image_project_phash', 'project_id', 'phash'),
+        db.Index('ix_image_project_labeled', 'project_id', 'labeled_at'),
+        db.Index('ix_image_project_embedded', 'project_id', 'embedded_at'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(100), nullable=False)
+    content_hash = db.Column(db.String(64), nullable=True, index=True)  # SHA-256 of the stored blob
     label = db.Column(db.String(100), nullable=True)
-    feature_size = db.Column(db.Float, nullable=True)
-    project_id = db.Column(db.Integer, db.ForeignKey('project.id', ondelete='CASCADE'), nullable=False)
+    labeled_at = db.Column(db.DateTime, nullable=True)  # Last relabel; uploads are told apart by id
+    feature_size = db.Column(db.Float, nullable=True)  # File size in bytes, set by feature extraction
+    width = db.Column(db.Integer, nullable=True)
+    height = db.Column(db.Integer, nullable=True)
+    channels = db.Column(db.Integer, nullable=True)
+    phash = db.Column(db.String(16), nullable=True)  # Perceptual (difference) hash as hex
+    embedding = db.deferred(db.Column(db.LargeBinary, nullable=True))  # float32 vector from features.embed
+    embedded_at = db.Column(db.DateTime, nullable=True)  # When embedding was last written; vector_index reads it
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id', ondelete='CASCADE'), nullable=False, index=True)
 
 # Training Configurations Model
 class TrainingConfig(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    project_id = db.Column(db.Integer, db.ForeignKey('project.id', ondelete='CASCADE'), nullable=False)
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id', ondelete='CASCADE'), nullable=False, index=True)
     learning_rate = db.Column(db.Float, nullable=False, default=0.001)
     epochs = db.Column(db.Integer, nullable=False, default=10)
     batch_size = db.Column(db.Integer, nullable=False, default=32)
@@ -44,15 +76,75 @@ class TrainingConfig(db.Model):
 
 # Training Result Model
 class TrainingResult(db.Model):
+    __table_args__ = (db.Index('ix_training_result_project_created', 'project_id', 'created_at'),)
+
     id = db.Column(db.Integer, primary_key=True)
     project_id = db.Column(db.Integer, db.ForeignKey('project.id'), nullable=False)
     accuracy = db.Column(db.Float)
     loss = db.Column(db.Float)
+    model_path = db.Column(db.String(255), nullable=True)  # Saved model, None when there was nothing to train on
+    # Watermark for incremental training: the images read up to snapshot_at, the highest id among them and the
+    # settings (TrainingConfig, backend, image size) the model was trained with
+    settings = db.Column(db.JSON, nullable=True)
+    last_image_id = db.Column(db.Integer, nullable=True)
+    snapshot_at = db.Column(db.DateTime, nullable=True)
+    base_id = db.Column(db.Integer, nullable=True)  # The result fine-tuned from; None for a full retrain
+    images = db.Column(db.Integer, nullable=True)  # Images trained on
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Training Metric Model, one row per finished epoch of a training job
+class TrainingMetric(db.Model):
+    __table_args__ = (db.Index('ix_training_metric_job', 'job_id', 'id'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer, db.ForeignKey('job.id'), nullable=False)
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id'), nullable=False, index=True)
+    epoch = db.Column(db.Integer, nullable=False)  # 1-based
+    epochs = db.Column(db.Integer, nullable=False)  # Total planned
+    loss = db.Column(db.Float)
+    accuracy = db.Column(db.Float)
+    images = db.Column(db.Integer)  # Images trained on during the epoch
+    seconds = db.Column(db.Float)  # Wall time of the epoch
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 # Inference Result Model
 class InferenceResult(db.Model):
+    __table_args__ = (
+        db.Index('ix_inference_result_image_created', 'image_id', 'created_at'),
+        db.Index('ix_inference_result_hash_version', 'content_hash', 'model_version'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     image_id = db.Column(db.Integer, db.ForeignKey('image.id'), nullable=False)
     result = db.Column(db.String(256))  # Placeholder for inference result
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
\ No newline at end of file
+    # Result cache key: the scored blob and the TrainingResult whose model scored it (None for the placeholder)
+    content_hash = db.Column(db.String(64), nullable=True)
+    model_version = db.Column(db.Integer, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Job Model
+class Job(db.Model):
+    __table_args__ = (
+        db.Index('ix_job_schedule', 'kind', 'status', 'priority', 'user_seq', 'id'),
+        db.Index('ix_job_project', 'kind', 'status', 'project_id', 'priority', 'id'),
+        db.Index('ix_job_user', 'kind', 'status', 'user_id'),
+        db.Index('ix_job_status_priority', 'status', 'priority', 'created_at'),
+        db.Index('ix_job_started', 'started_at', 'priority', 'created_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # 'training', 'inference', 'features' or 'index'
+    project_id = db.Column(db.Integer, db.ForeignKey('project.id'), nullable=False)
+    user_id = db.Column(db.Integer, nullable=True)  # The project's owner, for fairness and per-user limits
+    payload = db.Column(db.JSON, nullable=True)
+    priority = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # job_queue.PRIORITIES, lower first
+    user_seq = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # Place in the user's backlog at enqueue
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    worker_id = db.Column(db.String(200), nullable=True)
+    lease_token = db.Column(db.String(32), nullable=True)
+    lease_expires_at = db.Column(db.DateTime, nullable=True)
+    error = db.Column(db.String(256), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
@@ -0,0 +1,69 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# A process pool started on first use and shared by the threads of this
+# process. Processes are spawned rather than forked: the parent is a
+# multi-threaded web server.
+#
+# A pool process that dies (killed by the OOM killer, a crash in a native
+# decoder) breaks a ProcessPoolExecutor for good: every later submit raises
+# BrokenProcessPool. The pool is dropped as soon as that shows, in a submit or
+# in a task's result, so the work in flight fails (and its job is retried) but
+# the next call starts a new pool instead of failing forever.
+
+
+class ProcessPool:
+    def __init__(self):
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get(self, processes):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=processes,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def _discard(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _start(self, processes, start):
+        """``start(executor)`` on the pool, on a new one if the pool broke since it was last used."""
+        executor = self._get(processes)
+        try:
+            return executor, start(executor)
+        except BrokenProcessPool:
+            self._discard(executor)
+            executor = self._get(processes)
+            return executor, start(executor)
+
+    def submit(self, processes, fn, *args):
+        """A future for ``fn(*args)`` run on a pool of ``processes``."""
+        executor, future = self._start(processes, lambda e: e.submit(fn, *args))
+
+        def check(done):
+            if not done.cancelled() and isinstance(done.exception(), BrokenProcessPool):
+                self._discard(executor)
+        future.add_done_callback(check)
+        return future
+
+    def map(self, processes, fn, iterable, chunksize=1):
+        """The list of ``fn`` over ``iterable``, run on a pool of ``processes``."""
+        items = list(iterable)  # Submitted again if the pool has to be replaced
+        executor, results = self._start(processes, lambda e: e.map(fn, items, chunksize=chunksize))
+        try:
+            return list(results)
+        except BrokenProcessPool:
+            self._discard(executor)
+            raise
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
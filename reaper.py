@@ -0,0 +1,247 @@
+import click
+import logging
+import os
+import queue
+import shutil
+import time
+import uuid
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import delete, exists, select, update
+from models import Image, InferenceResult, Job, Project, TrainingConfig, TrainingMetric, TrainingResult, User, db
+import job_queue
+import storage
+import vector_index
+
+logger = logging.getLogger(__name__)
+
+# Background garbage collection for deletes. The API only tombstones rows
+# (models.SoftDelete), which is a handful of UPDATE statements however large
+# the project; the reaper then removes tombstoned images with their inference
+# results, then emptied projects with their jobs, configs, training results and metrics,
+# then users without projects, one bulk DELETE per batch. Files (uploads and
+# trained models) are unlinked once the rows referencing them are committed away.
+# Each pass first fails jobs abandoned on their last attempt (job_queue.fail_abandoned),
+# whose projects would otherwise stay busy for good.
+
+INCLUDE_DELETED = {'include_deleted': True, 'synchronize_session': False}
+
+
+def tombstone_image(image):
+    image.deleted_at = datetime.utcnow()
+
+
+def tombstone_project(project_id):
+    _tombstone_projects(Project.id == project_id, datetime.utcnow())
+
+
+def tombstone_user(user):
+    """Tombstone a user with its projects and images; the username is freed for new registrations at once."""
+    now = datetime.utcnow()
+    user.username = f'deleted-{uuid.uuid4().hex}'
+    user.deleted_at = now
+    _tombstone_projects(Project.user_id == user.id, now)
+
+
+def _tombstone_projects(criterion, now):
+    # Ids rather than a subquery, which the planner would answer by scanning every image
+    project_ids = db.session.scalars(select(Project.id).where(criterion)).all()
+    if not project_ids:
+        return
+    db.session.execute(update(Image).where(Image.project_id.in_(project_ids), Image.deleted_at.is_(None))
+                       .values(deleted_at=now).execution_options(**INCLUDE_DELETED))
+    # Jobs still queued are cancelled; running ones finish before the reaper touches the project
+    db.session.execute(update(Job).where(Job.project_id.in_(project_ids), Job.status == 'queued')
+                       .values(status='failed', error='Project deleted', finished_at=now, lease_expires_at=None)
+                       .execution_options(**INCLUDE_DELETED))
+    db.session.execute(update(Project).where(Project.id.in_(project_ids))
+                       .values(deleted_at=now).execution_options(**INCLUDE_DELETED))
+
+
+# Projects with a job in flight, whose results might still reference their rows
+def _busy_projects():
+    return select(Job.project_id).where(Job.status == 'running')
+
+
+def reap(upload_folder, batch_size=1000):
+    """Delete one batch of tombstoned images, projects and users; returns the number of rows and files removed."""
+    counts = {'images': 0, 'projects': 0, 'users': 0, 'files': 0}
+
+    images = db.session.execute(
+        select(Image.id, Image.filename, Image.content_hash)
+        .where(Image.deleted_at.is_not(None), Image.project_id.not_in(_busy_projects()))
+        .order_by(Image.id).limit(batch_size).execution_options(**INCLUDE_DELETED)).all()
+    if images:
+        image_ids = [row.id for row in images]
+        db.session.execute(delete(InferenceResult).where(InferenceResult.image_id.in_(image_ids))
+                           .execution_options(**INCLUDE_DELETED))
+        db.session.execute(delete(Image).where(Image.id.in_(image_ids)).execution_options(**INCLUDE_DELETED))
+        db.session.commit()
+        counts['images'] = len(image_ids)
+        counts['files'] = remove_unreferenced_files(upload_folder, images)
+
+    project_ids = db.session.scalars(
+        select(Project.id)
+        .where(Project.deleted_at.is_not(None), Project.id.not_in(_busy_projects()),
+               ~exists().where(Image.project_id == Project.id))
+        .order_by(Project.id).limit(batch_size).execution_options(**INCLUDE_DELETED)).all()
+    if project_ids:
+        model_paths = db.session.scalars(select(TrainingResult.model_path).where(
+            TrainingResult.project_id.in_(project_ids), TrainingResult.model_path.is_not(None))).all()
+        for model in (TrainingMetric, Job, TrainingResult, TrainingConfig, Project):
+            column = model.id if model is Project else model.project_id
+            db.session.execute(delete(model).where(column.in_(project_ids)).execution_options(**INCLUDE_DELETED))
+        db.session.commit()
+        counts['projects'] = len(project_ids)
+        counts['files'] += remove_files(model_paths)
+        cache_folder = current_app.config.get('DECODED_CACHE_FOLDER')
+        for project_id in project_ids if cache_folder else []:
+            shutil.rmtree(os.path.join(cache_folder, str(project_id)), ignore_errors=True)
+        for project_id in project_ids:
+            vector_index.remove(project_id)
+
+    user_ids = db.session.scalars(
+        select(User.id)
+        .where(User.deleted_at.is_not(None), ~exists().where(Project.user_id == User.id))
+        .order_by(User.id).limit(batch_size).execution_options(**INCLUDE_DELETED)).all()
+    if user_ids:
+        db.session.execute(delete(User).where(User.id.in_(user_ids)).execution_options(**INCLUDE_DELETED))
+        db.session.commit()
+        counts['users'] = len(user_ids)
+    return counts
+
+
+def reap_all(upload_folder, batch_size=1000):
+    """Reap batch after batch until nothing tombstoned is left (or only projects with running jobs)."""
+    totals = {'images': 0, 'projects': 0, 'users': 0, 'files': 0}
+    while True:
+        counts = reap(upload_folder, batch_size)
+        for key, value in counts.items():
+            totals[key] += value
+        if not (counts['images'] or counts['projects'] or counts['users']):
+            return totals
+
+
+def remove_unreferenced_files(upload_folder, rows):
+    """Unlink the files of deleted image rows that no remaining row (tombstoned or not) still uses.
+
+    An upload of the same bytes can find a blob in place (save_stream's dedup,
+    upload_image's content_hash) and commit its row just after the check. So
+    unreferenced blobs are first set aside, where uploads no longer find them,
+    and unlinked only if still unreferenced REAPER_RECHECK_DELAY seconds later;
+    the others are put back.
+    """
+    hashes = {row.content_hash for row in rows if row.content_hash}
+    filenames = {row.filename for row in rows if not row.content_hash}
+    referenced = set()
+    if hashes:
+        referenced |= set(db.session.scalars(
+            select(Image.content_hash).where(Image.content_hash.in_(hashes))
+            .execution_options(**INCLUDE_DELETED)))
+    if filenames:
+        referenced |= set(db.session.scalars(
+            select(Image.filename).where(Image.content_hash.is_(None), Image.filename.in_(filenames))
+            .execution_options(**INCLUDE_DELETED)))
+    db.session.rollback()  # End the read transaction before touching the filesystem
+    removed = 0
+    aside = [content_hash for content_hash in hashes - referenced
+             if storage.set_aside_blob(upload_folder, content_hash)]
+    if aside:
+        time.sleep(current_app.config.get('REAPER_RECHECK_DELAY', 2.0))  # Uploads that found them commit meanwhile
+        revived = set(db.session.scalars(
+            select(Image.content_hash).where(Image.content_hash.in_(aside)).execution_options(**INCLUDE_DELETED)))
+        db.session.rollback()
+        for content_hash in aside:
+            if content_hash in revived:
+                storage.restore_blob(upload_folder, content_hash)
+            else:
+                storage.discard_blob(upload_folder, content_hash)
+                removed += 1
+    # Files stored before content addressing
+    return removed + remove_files(os.path.join(upload_folder, filename) for filename in filenames - referenced)
+
+
+def remove_files(paths):
+    removed = 0
+    for path in paths:
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+def sweep_orphaned_blobs(upload_folder, grace_seconds=3600, batch_size=1000):
+    """Unlink blobs no image references, e.g. left behind by a crash between commit and unlink.
+
+    Blobs younger than ``grace_seconds`` are kept: an upload writes its blob
+    before committing the row that references it. Blobs a reaper set aside and
+    died before settling are put back if referenced, else removed.
+    """
+    cutoff = time.time() - grace_seconds
+    candidates = []  # (content_hash, set aside)
+    for prefix in os.listdir(upload_folder) if os.path.isdir(upload_folder) else []:
+        directory = os.path.join(upload_folder, prefix)
+        if len(prefix) != 2 or not os.path.isdir(directory):
+            continue
+        for entry in os.scandir(directory):
+            content_hash = entry.name.removesuffix(storage.SET_ASIDE_SUFFIX)
+            if storage.is_content_hash(content_hash) and entry.stat().st_mtime < cutoff:
+                candidates.append((content_hash, content_hash != entry.name))
+    removed = 0
+    for i in range(0, len(candidates), batch_size):
+        batch = candidates[i:i + batch_size]
+        referenced = set(db.session.scalars(
+            select(Image.content_hash).where(Image.content_hash.in_({content_hash for content_hash, _ in batch}))
+            .execution_options(**INCLUDE_DELETED)))
+        db.session.rollback()
+        for content_hash, set_aside in batch:
+            if content_hash in referenced:
+                if set_aside:
+                    storage.restore_blob(upload_folder, content_hash)
+                continue
+            if set_aside:
+                storage.discard_blob(upload_folder, content_hash)
+            else:
+                storage.remove_blob(upload_folder, content_hash)
+            removed += 1
+    return removed
+
+
+def reaper_worker(app, task_queue):
+    """Reap on every wakeup from a delete, and every REAPER_INTERVAL seconds for other processes' deletes."""
+    interval = app.config.get('REAPER_INTERVAL', 5.0)
+    batch_size = app.config.get('REAPER_BATCH_SIZE', 1000)
+    with app.app_context():
+        while True:
+            try:
+                abandoned = job_queue.fail_abandoned()  # Before reaping, as their projects count as busy
+                if abandoned:
+                    logger.warning("Failed %d jobs whose lease expired on their last attempt", abandoned)
+                counts = reap_all(app.config['UPLOAD_FOLDER'], batch_size)
+                if any(counts.values()):
+                    logger.info("Reaped %s", counts)
+            except Exception:
+                logger.exception("Reaper pass failed")
+                db.session.rollback()
+            try:
+                signal = task_queue.get(timeout=interval)
+            except queue.Empty:
+                continue
+            task_queue.task_done()
+            if signal is None:
+                break
+        db.session.remove()
+
+
+@click.option('--batch-size', default=1000, show_default=True, help='Rows per DELETE.')
+@click.option('--sweep', is_flag=True, help='Also unlink blobs that no image references.')
+def reap_command(batch_size, sweep):
+    """Delete tombstoned users, projects and images and unlink their files."""
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    counts = reap_all(upload_folder, batch_size)
+    if sweep:
+        counts['files'] += sweep_orphaned_blobs(
+            upload_folder, current_app.config.get('ORPHAN_GRACE_SECONDS', 3600), batch_size)
+    click.echo(', '.join(f'{value} {key}' for key, value in counts.items()) + ' removed')
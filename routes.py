@@ -1,5 +1,6 @@
 from flask import Blueprint, request, jsonify
 import services
+from cache import cached
 
 api = Blueprint('api', __name__)
 
@@ -8,9 +9,14 @@ def register():
     return services.register_user(request)
 
 @api.route('/user/<username>/', methods=['GET'])
+@cached(lambda username: [f'user:{username}'])
 def get_user(username):
     return services.get_user(username)
 
+@api.route('/user/<username>/projects/', methods=['GET'])
+def list_user_projects(username):
+    return services.list_user_projects(username)
+
 @api.route('/delete_user/<username>/', methods=['DELETE'])
 def delete_user(username):
     return services.delete_user(username)
@@ -20,9 +26,22 @@ def create_project():
     return services.create_project(request)
 
 @api.route('/project/<int:project_id>/', methods=['GET'])
+@cached(lambda project_id: [f'project:{project_id}', f'images:{project_id}'])
 def get_project(project_id):
     return services.get_project(project_id)
 
+@api.route('/project/<int:project_id>/images/', methods=['GET'])
+def list_project_images(project_id):
+    return services.list_project_images(project_id)
+
+@api.route('/project/<int:project_id>/training_results/', methods=['GET'])
+def list_project_training_results(project_id):
+    return services.list_project_training_results(project_id)
+
+@api.route('/project/<int:project_id>/inference_results/', methods=['GET'])
+def list_project_inference_results(project_id):
+    return services.list_project_inference_results(project_id)
+
 @api.route('/delete_project/<int:project_id>/', methods=['DELETE'])
 def delete_project(project_id):
     return services.delete_project(project_id)
@@ -31,18 +50,41 @@ def delete_project(project_id):
 def upload_image(project_id):
     return services.upload_image(project_id, request)
 
+@api.route('/upload_images/<int:project_id>/', methods=['POST'])
+def bulk_upload_images(project_id):
+    return services.bulk_upload_images(project_id, request)
+
+@api.route('/blobs/<content_hash>/', methods=['GET'])
+def get_blob(content_hash):
+    return services.get_blob(content_hash)
+
 @api.route('/image/<int:image_id>/', methods=['GET'])
+@cached(lambda image_id: [f'image:{image_id}'])
 def get_image(image_id):
     return services.get_image(image_id)
 
+@api.route('/image/<int:image_id>/label/', methods=['PUT'])
+def relabel_image(image_id):
+    return services.relabel_image(image_id, request)
+
 @api.route('/delete_image/<username>/<int:project_id>/<int:image_id>/', methods=['DELETE'])
 def delete_image(username, project_id, image_id):
     return services.delete_image(username, project_id, image_id)
 
 @api.route('/analyze_project/<int:project_id>/', methods=['GET'])
+@cached(lambda project_id: [f'images:{project_id}'])
 def analyze_project(project_id):
     return services.analyze_project(project_id)
 
+@api.route('/project/<int:project_id>/similar/', methods=['GET', 'POST'])
+def similar_images(project_id):
+    return services.similar_images(project_id, request)
+
+@api.route('/project/<int:project_id>/duplicates/', methods=['GET'])
+@cached(lambda project_id: [f'images:{project_id}'])
+def list_duplicates(project_id):
+    return services.list_duplicates(project_id)
+
 @api.route('/configure_training/<int:project_id>/', methods=['POST'])
 def configure_training(project_id):
     return services.configure_training(project_id, request)
@@ -52,6 +94,7 @@ def enqueue_training(project_id):
     return services.enqueue_training(project_id)
 
 @api.route('/training_results/<int:project_id>/', methods=['GET'])
+@cached(lambda project_id: [f'training:{project_id}'])
 def get_training_results(project_id):
     return services.get_training_results(project_id)
 
@@ -59,10 +102,27 @@ def get_training_results(project_id):
 def enqueue_inference(project_id, image_id):
     return services.enqueue_inference(project_id, image_id)
 
+@api.route('/enqueue_inference_batch/<int:project_id>/', methods=['POST'])
+def enqueue_inference_batch(project_id):
+    return services.enqueue_inference_batch(project_id, request)
+
 @api.route('/inference_results/<int:image_id>/', methods=['GET'])
+@cached(lambda image_id: [f'inference:{image_id}'])
 def get_inference_results(image_id):
     return services.get_inference_results(image_id)
 
+@api.route('/jobs/<int:job_id>/', methods=['GET'])
+def get_job(job_id):
+    return services.get_job(job_id)
+
+@api.route('/jobs/stats/', methods=['GET'])
+def get_queue_stats():
+    return services.get_queue_stats()
+
+@api.route('/jobs/<int:job_id>/progress/', methods=['GET'])
+def get_training_progress(job_id):
+    return services.get_training_progress(job_id)
+
 @api.route('/uploads/<filename>', methods=['GET'])
 def uploaded_file(filename):
     return services.uploaded_file(filename)
@@ -1,19 +1,79 @@
-from flask import jsonify, request, current_app, send_from_directory
-from werkzeug.utils import secure_filename
+from flask import Response, json, jsonify, request, current_app, send_from_directory, stream_with_context
+from werkzeug.utils import secure_filename, send_file as werkzeug_send_file
+import logging
 import os
 import queue
-from models import User, Project, Image, TrainingConfig, TrainingResult, InferenceResult, db
+import tarfile
+import time
+import zipfile
+from models import User, Project, Image, TrainingConfig, TrainingMetric, TrainingResult, InferenceResult, Job, db
 from datetime import datetime
+from sqlalchemy import Integer, case, cast, func, insert
+from sqlalchemy.orm import joinedload
+import job_queue
+import reaper
+import task_manager
+import training
+import storage
+import cache
+import features
+import ingest
+import metrics
+import vector_index
 
-# Initialize queues for managing asynchronous tasks
-training_queue = queue.Queue()
-inference_queue = queue.Queue()
+logger = logging.getLogger(__name__)
 
 # Helper function to check allowed file extensions
 def allowed_file(filename):
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+# Helper function to format optional timestamps
+def format_time(value):
+    return value.strftime('%Y-%m-%d %H:%M:%S') if value else None
+
+# Keyset pagination: ?after=<last id seen>&limit=N&fields=a,b
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+PROJECT_FIELDS = {'project_id': Project.id, 'project_name': Project.name, 'project_type': Project.project_type}
+IMAGE_FIELDS = {
+    'image_id': Image.id, 'filename': Image.filename, 'content_hash': Image.content_hash, 'label': Image.label,
+    'feature_size': Image.feature_size, 'width': Image.width, 'height': Image.height,
+    'channels': Image.channels, 'phash': Image.phash,
+}
+TRAINING_RESULT_FIELDS = {'result_id': TrainingResult.id, 'accuracy': TrainingResult.accuracy,
+                          'loss': TrainingResult.loss, 'images': TrainingResult.images,
+                          'base_id': TrainingResult.base_id, 'created_at': TrainingResult.created_at}
+INFERENCE_RESULT_FIELDS = {'result_id': InferenceResult.id, 'image_id': InferenceResult.image_id,
+                           'prediction': InferenceResult.result, 'model_version': InferenceResult.model_version,
+                           'created_at': InferenceResult.created_at}
+
+class InvalidFields(ValueError):
+    pass
+
+# Columns named by ?fields=, or all of them
+def selected_fields(available):
+    requested = request.args.get('fields')
+    if not requested:
+        return list(available)
+    fields = requested.split(',')
+    unknown = [f for f in fields if f not in available]
+    if unknown:
+        raise InvalidFields(f"Unknown fields {', '.join(unknown)}; choose from {', '.join(available)}")
+    return fields
+
+def keyset_page(available, id_column, *criteria):
+    """One query selecting only the requested columns of the page after ``?after=``."""
+    fields = selected_fields(available)
+    limit = max(1, min(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    after = request.args.get('after', 0, type=int)
+    rows = (db.session.query(id_column.label('_cursor'), *[available[f].label(f) for f in fields])
+            .filter(*criteria, id_column > after).order_by(id_column).limit(limit + 1).all())
+    items = [{f: format_time(getattr(row, f)) if isinstance(getattr(row, f), datetime) else getattr(row, f)
+              for f in fields} for row in rows[:limit]]
+    return {'items': items, 'next_cursor': rows[limit - 1]._cursor if len(rows) > limit else None}
+
 # Register a new user
 def register_user(request):
     data = request.json
@@ -32,20 +92,38 @@ def get_user(username):
     user = User.query.filter_by(username=username).first()
     if not user:
         return jsonify({'error': 'User not found'}), 404
+    try:
+        projects = keyset_page(PROJECT_FIELDS, Project.id, Project.user_id == user.id)
+    except InvalidFields as e:
+        return jsonify({'error': str(e)}), 400
     user_info = {
         'username': user.username,
         'user_id': user.id,
-        'projects': [{'project_id': p.id, 'project_name': p.name, 'project_type': p.project_type} for p in user.projects]
+        'projects': projects['items'],
+        'projects_next_cursor': projects['next_cursor']
     }
     return jsonify(user_info), 200
 
+# List a user's projects page by page
+def list_user_projects(username):
+    user_id = db.session.query(User.id).filter_by(username=username).scalar()
+    if user_id is None:
+        return jsonify({'error': 'User not found'}), 404
+    try:
+        return jsonify(keyset_page(PROJECT_FIELDS, Project.id, Project.user_id == user_id)), 200
+    except InvalidFields as e:
+        return jsonify({'error': str(e)}), 400
+
 # Delete a user by username
 def delete_user(username):
     user = User.query.filter_by(username=username).first()
     if not user:
         return jsonify({'error': 'User not found'}), 404
-    db.session.delete(user)
+    project_ids = [p.id for p in user.projects]
+    reaper.tombstone_user(user)  # Rows and files are removed in the background
     db.session.commit()
+    cache.invalidate(f'user:{username}', *[f'{tag}:{pid}' for pid in project_ids for tag in ('project', 'images')])
+    task_manager.wake_reaper()
     return jsonify({'message': 'User deleted successfully'}), 200
 
 # Create a new project
@@ -59,15 +137,60 @@ def create_project(request):
     project = Project(user_id=user.id, project_type=data['project_type'], name=data['name'])
     db.session.add(project)
     db.session.commit()
+    cache.invalidate(f'user:{user.username}')
     return jsonify({'message': 'Project created successfully', 'project_id': project.id}), 201
 
+# Get information about a project, its owner and training configuration in one query
+def get_project(project_id):
+    project = (Project.query.options(joinedload(Project.user), joinedload(Project.training_config))
+               .filter_by(id=project_id).first())
+    if not project:
+        return jsonify({'error': 'Project not found'}), 404
+    config = project.training_config
+    return jsonify({
+        'project_id': project.id,
+        'project_name': project.name,
+        'project_type': project.project_type,
+        'user_id': project.user_id,
+        'associated_user': project.user.username,
+        'num_images': db.session.query(func.count(Image.id)).filter(Image.project_id == project.id).scalar(),
+        'training_config': {
+            'learning_rate': config.learning_rate,
+            'epochs': config.epochs,
+            'batch_size': config.batch_size
+        } if config else None
+    }), 200
+
+# List a project's images, training results or inference results page by page
+def list_project_images(project_id):
+    return _list_project_rows(project_id, IMAGE_FIELDS, Image.id, Image.project_id == project_id)
+
+def list_project_training_results(project_id):
+    return _list_project_rows(project_id, TRAINING_RESULT_FIELDS, TrainingResult.id,
+                              TrainingResult.project_id == project_id)
+
+def list_project_inference_results(project_id):
+    in_project = InferenceResult.image_id.in_(db.session.query(Image.id).filter(Image.project_id == project_id))
+    return _list_project_rows(project_id, INFERENCE_RESULT_FIELDS, InferenceResult.id, in_project)
+
+def _list_project_rows(project_id, available, id_column, *criteria):
+    if not db.session.query(Project.id).filter_by(id=project_id).scalar():
+        return jsonify({'error': 'Project not found'}), 404
+    try:
+        return jsonify(keyset_page(available, id_column, *criteria)), 200
+    except InvalidFields as e:
+        return jsonify({'error': str(e)}), 400
+
 # Delete a project
 def delete_project(project_id):
     project = Project.query.get(project_id)
     if not project:
         return jsonify({'error': 'Project not found'}), 404
-    db.session.delete(project)
+    username = project.user.username
+    reaper.tombstone_project(project.id)  # Rows and files are removed in the background
     db.session.commit()
+    cache.invalidate(f'user:{username}', f'project:{project_id}', f'images:{project_id}', f'training:{project_id}')
+    task_manager.wake_reaper()
     return jsonify({'message': 'Project deleted successfully'}), 200
 
 # Upload an image to a project
@@ -75,29 +198,110 @@ def upload_image(project_id, request):
     project = Project.query.get(project_id)
     if not project:
         return jsonify({'error': 'Project not found'}), 404
-    if 'file' not in request.files:
-        return jsonify({'error': 'No file part'}), 400
-    file = request.files['file']
-    if file.filename == '' or not allowed_file(file.filename):
-        return jsonify({'error': 'Invalid file or no file selected'}), 400
-    filename = secure_filename(file.filename)
     UPLOAD_FOLDER = current_app.config['UPLOAD_FOLDER']
-    filepath = os.path.join(UPLOAD_FOLDER, filename)
-    file.save(filepath)
-    image = Image(filename=filename, label=request.form.get('label', ''), project_id=project.id)
+    content_hash = request.form.get('content_hash')
+    if 'file' in request.files:
+        file = request.files['file']
+        if file.filename == '' or not allowed_file(file.filename):
+            return jsonify({'error': 'Invalid file or no file selected'}), 400
+        filename = secure_filename(file.filename)
+        chunk_size = current_app.config.get('UPLOAD_CHUNK_SIZE', storage.CHUNK_SIZE)
+        content_hash, size, created = storage.save_stream(file.stream, UPLOAD_FOLDER, chunk_size)
+        metrics.record_upload(size)
+    elif content_hash:
+        # The client already knows we hold these bytes (see get_blob), so only the row is added
+        if not storage.blob_exists(UPLOAD_FOLDER, content_hash):
+            return jsonify({'error': 'Unknown content hash'}), 404
+        filename = secure_filename(request.form.get('filename', ''))
+        if not allowed_file(filename):
+            return jsonify({'error': 'Invalid file or no file selected'}), 400
+        created = False
+    else:
+        return jsonify({'error': 'No file part'}), 400
+    image = Image(filename=filename, content_hash=content_hash, label=request.form.get('label', ''), project_id=project.id)
     db.session.add(image)
     db.session.commit()
-    return jsonify({'message': 'Image uploaded successfully', 'filename': filename}), 201
+    cache.invalidate(f'images:{project.id}')
+    task_manager.schedule_features(project.id, [image.id])
+    return jsonify({
+        'message': 'Image uploaded successfully',
+        'filename': filename,
+        'image_id': image.id,
+        'content_hash': content_hash,
+        'deduplicated': not created
+    }), 201
+
+# Upload many images to a project: multipart files, or a tar/zip archive as the request body
+def bulk_upload_images(project_id, request):
+    project = db.session.get(Project, project_id)
+    if not project:
+        return jsonify({'error': 'Project not found'}), 404
+    # Lift the single-image limits before the body is touched
+    request.max_content_length = current_app.config.get('MAX_INGEST_CONTENT_LENGTH')
+    request.max_form_parts = current_app.config.get('MAX_INGEST_FILES')
+    request.max_form_memory_size = current_app.config.get('MAX_INGEST_FORM_MEMORY')
+    UPLOAD_FOLDER = current_app.config['UPLOAD_FOLDER']
+    chunk_size = current_app.config.get('UPLOAD_CHUNK_SIZE', storage.CHUNK_SIZE)
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+
+    results, images, received = [], [], 0
+    try:
+        for name, stream, label in ingest.iter_request(request, UPLOAD_FOLDER, chunk_size):
+            filename = secure_filename(os.path.basename(name))
+            if not allowed_file(filename):
+                results.append({'filename': name, 'status': 'rejected', 'error': 'Invalid file type'})
+                continue
+            content_hash, size, created = storage.save_stream(stream, UPLOAD_FOLDER, chunk_size)
+            received += size
+            images.append({'filename': filename, 'content_hash': content_hash, 'label': label, 'project_id': project.id})
+            results.append({'filename': name, 'status': 'accepted', 'content_hash': content_hash,
+                            'deduplicated': not created})
+    except (tarfile.TarError, zipfile.BadZipFile, ValueError) as e:
+        return jsonify({'error': f'Unreadable upload: {e}'}), 400
+    metrics.record_upload(received, len(images))
+
+    # One transaction, and one INSERT, for every accepted file
+    image_ids = list(db.session.scalars(insert(Image).returning(Image.id, sort_by_parameter_order=True),
+                                        images)) if images else []
+    db.session.commit()
+    cache.invalidate(f'images:{project.id}')
+    task_manager.schedule_features(project.id, image_ids)
+    accepted = iter(image_ids)
+    for result in results:
+        if result['status'] == 'accepted':
+            result['image_id'] = next(accepted)
+    return jsonify({
+        'message': 'Images ingested' if images else 'No images accepted',
+        'accepted': len(images),
+        'rejected': len(results) - len(images),
+        'results': results
+    }), 201 if images else 400
+
+# Check whether content is already stored, so clients can skip re-uploading it
+def get_blob(content_hash):
+    UPLOAD_FOLDER = current_app.config['UPLOAD_FOLDER']
+    if not storage.blob_exists(UPLOAD_FOLDER, content_hash):
+        return jsonify({'error': 'Content not found'}), 404
+    size = os.path.getsize(storage.blob_path(UPLOAD_FOLDER, content_hash))
+    return jsonify({'content_hash': content_hash, 'size': size}), 200
 
 # Get information about an image
 def get_image(image_id):
-    image = Image.query.get(image_id)
+    image = (Image.query.options(joinedload(Image.project).joinedload(Project.user))
+             .filter_by(id=image_id).first())
     if not image:
         return jsonify({'error': 'Image not found'}), 404
+    cache.depends_on(f'project:{image.project_id}')
     image_info = {
         'image_id': image.id,
         'filename': image.filename,
+        'content_hash': image.content_hash,
         'label': image.label,
+        'feature_size': image.feature_size,
+        'width': image.width,
+        'height': image.height,
+        'channels': image.channels,
+        'phash': image.phash,
         'project_id': image.project_id,
         'project_name': image.project.name,
         'user_id': image.project.user_id,
@@ -119,53 +323,182 @@ def delete_image(username, project_id, image_id):
     if not image:
         return jsonify({'error': 'Image not found or does not belong to the specified project'}), 404
 
-    try:
-        UPLOAD_FOLDER = 'uploads'
-        filename = image.filename
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
-        os.remove(filepath)  # Delete the file from the filesystem
-        db.session.delete(image)  # Delete the database record
+    reaper.tombstone_image(image)  # The reaper removes the row, its results and, once unreferenced, its file
+    db.session.commit()
+    cache.invalidate(f'image:{image_id}', f'inference:{image_id}', f'images:{project.id}')
+    task_manager.wake_reaper()
+    return jsonify({'message': 'Image deleted successfully'}), 200
+
+# Change an image's label; training picks it up as relabeled
+def relabel_image(image_id, request):
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('label'), str):
+        return jsonify({'error': 'Missing label'}), 400
+    image = Image.query.filter_by(id=image_id).first()
+    if not image:
+        return jsonify({'error': 'Image not found'}), 404
+    label, project_id = data['label'], image.project_id
+    if image.label != label:
+        image.label = label
+        image.labeled_at = datetime.utcnow()
         db.session.commit()
-        return jsonify({'message': 'Image deleted successfully'}), 200
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'error': str(e)}), 500
+        cache.invalidate(f'image:{image_id}', f'images:{project_id}')
+    return jsonify({'image_id': image_id, 'label': label}), 200
 
 # ANALYZE data
+PERCENTILES = (0.5, 0.9, 0.99)
+
 def analyze_project(project_id):
-    project = Project.query.get(project_id)
+    project = db.session.get(Project, project_id)
     if not project:
         return jsonify({'error': 'Project not found'}), 404
-    
-    images = Image.query.filter_by(project_id=project_id).all()
-    
-    if not images:
+
+    # Every statistic is aggregated in the database; no Image rows are loaded
+    in_project = Image.project_id == project_id
+    stats = db.session.query(
+        func.count(Image.id),
+        func.count(Image.feature_size),
+        func.sum(Image.feature_size),
+        func.avg(Image.feature_size),
+        func.min(Image.feature_size),
+        func.max(Image.feature_size),
+    ).filter(in_project).one()
+    num_images, num_sized, total_size, avg_size, min_size, max_size = stats
+
+    if not num_images:
         return jsonify({'message': 'No images found for this project'}), 404
-    
-    # Extract feature sizes
-    feature_sizes = [image.feature_size for image in images if image.feature_size is not None]
-    
-    if not feature_sizes:
+
+    if not num_sized:
         return jsonify({'message': 'No feature sizes available for images in this project'}), 404
-    
-    total_size = sum(feature_sizes)
-    avg_size = total_size / len(feature_sizes)
-    min_size = min(feature_sizes)
-    max_size = max(feature_sizes)
-    
+
+    label_counts = dict(db.session.query(func.coalesce(Image.label, ''), func.count(Image.id))
+                        .filter(in_project).group_by(func.coalesce(Image.label, '')).all())
+
     analysis_result = {
         'project_id': project_id,
-        'num_images': len(images),
+        'num_images': num_images,
+        'num_images_with_features': num_sized,
         'total_feature_size': total_size,
         'average_feature_size': avg_size,
         'smallest_image_size': min_size,
         'largest_image_size': max_size,
+        'label_counts': label_counts,
+        'feature_size_percentiles': feature_size_percentiles(in_project, num_sized),
+        'feature_size_histogram': feature_size_histogram(in_project, min_size, max_size,
+                                                         request.args.get('bins', 10, type=int)),
     }
-    
+
     return jsonify(analysis_result), 200
 
+# Nearest neighbors by embedding of a project image (GET ?image_id=) or of an uploaded file (POST), ?k= of them
+def similar_images(project_id, request):
+    if not db.session.query(Project.id).filter_by(id=project_id).scalar():
+        return jsonify({'error': 'Project not found'}), 404
+    if vector_index.np is None or features.PILImage is None:
+        return jsonify({'error': 'Similarity search needs NumPy and Pillow'}), 501
+    k = max(1, min(request.args.get('k', 10, type=int), current_app.config.get('SIMILAR_MAX_K', 100)))
+    if request.method == 'POST':
+        file = request.files.get('file')
+        if file is None or not allowed_file(file.filename):
+            return jsonify({'error': 'Invalid file or no file selected'}), 400
+        embedding, exclude = features.embed(file.stream), ()
+        query = {'filename': secure_filename(file.filename)}
+        if embedding is None:
+            return jsonify({'error': 'Cannot decode this file'}), 415
+    else:
+        image_id = request.args.get('image_id', type=int)
+        if image_id is None:
+            return jsonify({'error': 'Provide image_id or upload a file'}), 400
+        row = (db.session.query(Image.embedding)
+               .filter(Image.id == image_id, Image.project_id == project_id).first())
+        if row is None:
+            return jsonify({'error': 'Image not found'}), 404
+        if row.embedding is None:
+            return jsonify({'error': 'Image has no embedding yet, try again once its features are extracted'}), 409
+        embedding, exclude = row.embedding, (image_id,)
+        query = {'image_id': image_id}
+
+    neighbors = vector_index.search(project_id, embedding, k, exclude)
+    rows = {row.id: row for row in db.session.query(Image.id, Image.filename, Image.content_hash, Image.label)
+            .filter(Image.id.in_([image_id for image_id, _score in neighbors]))}
+    threshold = current_app.config.get('NEAR_DUPLICATE_SIMILARITY', 0.98)
+    return jsonify({
+        'project_id': project_id,
+        'query': query,
+        'neighbors': [{
+            'image_id': image_id,
+            'score': round(score, 6),
+            'filename': rows[image_id].filename,
+            'content_hash': rows[image_id].content_hash,
+            'label': rows[image_id].label,
+            'near_duplicate': score >= threshold,
+        } for image_id, score in neighbors if image_id in rows],
+        'index': vector_index.status(project_id),
+    }), 200
+
+# Groups of near-duplicate images in a project, page by page: ?after=<next_cursor>&limit=N. Candidates share a
+# perceptual hash (an index lookup however large the project); embeddings then split hashes shared by accident
+def list_duplicates(project_id):
+    if not db.session.query(Project.id).filter_by(id=project_id).scalar():
+        return jsonify({'error': 'Project not found'}), 404
+    limit = max(1, min(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    in_project = Image.project_id == project_id
+    hashes = [row.phash for row in db.session.query(Image.phash)
+              .filter(in_project, Image.phash > request.args.get('after', ''))
+              .group_by(Image.phash).having(func.count(Image.id) > 1)
+              .order_by(Image.phash).limit(limit + 1)]
+    members = {}
+    for row in (db.session.query(Image.id, Image.phash, Image.embedding)
+                .filter(in_project, Image.phash.in_(hashes[:limit])).order_by(Image.id) if hashes else []):
+        members.setdefault(row.phash, []).append(row)
+    threshold = current_app.config.get('NEAR_DUPLICATE_SIMILARITY', 0.98)
+    return jsonify({
+        'groups': [{'phash': phash, 'image_ids': group}
+                   for phash in hashes[:limit] for group in near_duplicate_groups(members[phash], threshold)],
+        'next_cursor': hashes[limit - 1] if len(hashes) > limit else None,
+    }), 200
+
+# Split rows sharing a perceptual hash into groups of at least two whose embeddings are alike
+def near_duplicate_groups(rows, threshold):
+    if vector_index.np is None:
+        return [[row.id for row in rows]]
+    groups = []  # (first embedding, ids)
+    for row in rows:
+        vector = vector_index.np.frombuffer(row.embedding, dtype=vector_index.np.float32) if row.embedding else None
+        for first, ids in groups:
+            if vector is None or first is None or float(first @ vector) >= threshold:
+                ids.append(row.id)
+                break
+        else:
+            groups.append((vector, [row.id]))
+    return [ids for _first, ids in groups if len(ids) > 1]
+
+# Percentiles of feature_size: percentile_cont on Postgres, nearest-rank index lookups elsewhere
+def feature_size_percentiles(in_project, num_sized):
+    names = [f'p{round(p * 100)}' for p in PERCENTILES]
+    if db.engine.dialect.name == 'postgresql':
+        values = db.session.query(*[func.percentile_cont(p).within_group(Image.feature_size) for p in PERCENTILES]
+                                  ).filter(in_project).one()
+        return dict(zip(names, values))
+    sized = db.session.query(Image.feature_size).filter(in_project, Image.feature_size.isnot(None))
+    return {name: sized.order_by(Image.feature_size).offset(int(p * (num_sized - 1))).limit(1).scalar()
+            for name, p in zip(names, PERCENTILES)}
+
+# Equal-width feature_size histogram, bucketed and counted by a single GROUP BY
+def feature_size_histogram(in_project, min_size, max_size, bins):
+    bins = max(1, min(bins, 100))
+    width = (max_size - min_size) / bins or 1
+    # floor, as a cast rounds on Postgres but truncates on SQLite; the largest sizes land in the last bin
+    index = cast(func.floor((Image.feature_size - min_size) / width), Integer)
+    bucket = case((index >= bins - 1, bins - 1), else_=index)
+    counts = [0] * bins
+    for index, count in (db.session.query(bucket, func.count(Image.id))
+                         .filter(in_project, Image.feature_size.isnot(None)).group_by(bucket)):
+        counts[index] = count
+    return {'bin_edges': [min_size + i * width for i in range(bins + 1)], 'counts': counts}
+
 # POST training configs
-def configure_training(project_id):
+def configure_training(project_id, request):
     project = Project.query.get(project_id)
     if not project:
         return jsonify({'error': 'Project not found'}), 404
@@ -184,41 +517,277 @@ def configure_training(project_id):
     config.epochs = data['epochs']
     config.batch_size = data['batch_size']
     db.session.commit()
+    cache.invalidate(f'project:{project_id}')
     
     return jsonify({'message': 'Training configuration updated successfully'}), 200
 
+# 429 for an enqueue refused by backpressure (TASK_QUEUE_MAXSIZE)
+def queue_full(kind, project_id):
+    logger.warning("%s queue full, rejected a job for project %s", kind.capitalize(), project_id)
+    metrics.record_rejected(kind)
+    return jsonify({'error': f'{kind.capitalize()} queue is full, try again later'}), 429
+
+# A queued training run takes the latest config, and stays a full retrain if either request asked for one
+def merge_training(queued, new):
+    return dict(new, full=True) if (queued or {}).get('full') or new.get('full') else new
+
 # POST training queue
 def enqueue_training(project_id):
-    training_queue.put(project_id)
-    return jsonify({'message': 'Training task enqueued'}), 202
+    """Enqueues training with the project's current config; a run still queued is reused with that config.
+
+    Training fine-tunes the latest model on new and relabeled images when the
+    config is unchanged; ``{"full": true}`` retrains from scratch instead.
+    """
+    payload = {'config': training.training_settings(project_id)}
+    if (request.get_json(silent=True) or {}).get('full'):
+        payload['full'] = True
+    try:
+        job, coalesced = task_manager.submit_coalesced('training', project_id, payload, merge=merge_training)
+    except queue.Full:
+        return queue_full('training', project_id)
+    return jsonify({'message': 'Training task enqueued', 'job_id': job.id, 'coalesced': coalesced}), 202
 
 # GET training results
 def get_training_results(project_id):
-    results = TrainingResult.query.filter_by(project_id=project_id).all()
+    results = (TrainingResult.query.filter_by(project_id=project_id)
+               .order_by(TrainingResult.created_at, TrainingResult.id).all())
     if not results:
         return jsonify({'error': 'No training results found'}), 404
-    return jsonify([{'accuracy': r.accuracy, 'loss': r.loss, 'created_at': r.created_at.strftime('%Y-%m-%d %H:%M:%S')} for r in results]), 200
+    return jsonify([{'accuracy': r.accuracy, 'loss': r.loss, 'images': r.images, 'incremental': r.base_id is not None,
+                     'created_at': r.created_at.strftime('%Y-%m-%d %H:%M:%S')} for r in results]), 200
+
+# Inference results are cached by (image content hash, model version): a result is reused for any image
+# with the same content while the model that scored it is the project's current one
+def cached_result(content_hash, version):
+    if not content_hash:
+        return None
+    return (InferenceResult.query.filter_by(content_hash=content_hash, model_version=version)
+            .order_by(InferenceResult.id.desc()).first())
 
 # POST inference queue
 def enqueue_inference(project_id, image_id):
-    """Enqueues an inference task for a specific project and image."""
-    # Simulate the inference task enqueueing
-    inference_task = {'project_id': project_id, 'image_id': image_id}
-    inference_queue.put(inference_task)
-    return jsonify({'message': 'Inference task enqueued'}), 202
+    """Enqueues an inference task for a specific project and image.
+
+    Content the project's current model has already scored is answered at
+    once from the result cache, without a job.
+    """
+    content_hash = (db.session.query(Image.content_hash)
+                    .filter(Image.id == image_id, Image.project_id == project_id).scalar())
+    version = task_manager.model_version(project_id)
+    result = cached_result(content_hash, version)
+    if result is not None:
+        metrics.record_inference_cache(hits=1)
+        return jsonify({'message': 'Inference result cached', 'job_id': None, 'cached': True, 'image_id': image_id,
+                        'prediction': result.result, 'model_version': version}), 200
+    try:
+        job, coalesced = task_manager.submit_coalesced('inference', project_id, {'image_ids': [image_id]})
+    except queue.Full:
+        return queue_full('inference', project_id)
+    metrics.record_inference_cache(misses=1)
+    return jsonify({'message': 'Inference task enqueued', 'job_id': job.id, 'coalesced': coalesced,
+                    'cached': False}), 202
+
+# POST batch inference queue
+def enqueue_inference_batch(project_id, request):
+    """Enqueues inference for a list of project images, or all of them with {"all": true}."""
+    if not db.session.get(Project, project_id):
+        return jsonify({'error': 'Project not found'}), 404
+    data = request.json or {}
+    version = task_manager.model_version(project_id)
+    scored = (db.session.query(InferenceResult.id)
+              .filter(InferenceResult.content_hash == Image.content_hash, InferenceResult.model_version == version)
+              .exists())
+    query = db.session.query(Image.id, scored.label('cached')).filter(Image.project_id == project_id)
+    if data.get('all'):
+        requested = None
+    elif isinstance(data.get('image_ids'), list) and data['image_ids']:
+        requested = data['image_ids']
+        query = query.filter(Image.id.in_(requested))
+    else:
+        return jsonify({'error': 'Provide image_ids or all'}), 400
+    rows = query.order_by(Image.id).all()
+    if not rows:
+        return jsonify({'error': 'No images found for this project'}), 404
+
+    image_ids = [row.id for row in rows if not row.cached]  # Cached ones are served by get_inference_results
+    batch_size = current_app.config.get('INFERENCE_BATCH_SIZE', 64)
+    payloads = [{'image_ids': image_ids[i:i + batch_size]} for i in range(0, len(image_ids), batch_size)]
+    maxsize = current_app.config.get('TASK_QUEUE_MAXSIZE', 0)
+    if maxsize and len(payloads) > maxsize:  # Would never fit, so not a 429 the client should retry
+        return jsonify({'error': f'{len(image_ids)} images exceed what the inference queue holds; '
+                                 f'send at most {maxsize * batch_size} image_ids per request',
+                        'max_images': maxsize * batch_size}), 413
+    try:
+        jobs = task_manager.submit_many('inference', project_id, payloads, priority='batch') if payloads else []
+    except queue.Full:
+        return queue_full('inference', project_id)
+    metrics.record_inference_cache(hits=len(rows) - len(image_ids), misses=len(image_ids))
+    found = {row.id for row in rows}
+    return jsonify({
+        'message': 'Inference batch enqueued' if jobs else 'Inference results cached',
+        'job_ids': [job.id for job in jobs],
+        'num_images': len(rows),
+        'cached_image_ids': [row.id for row in rows if row.cached],
+        'skipped_image_ids': [i for i in requested if i not in found] if requested else []
+    }), 202 if jobs else 200
 
 # GET inference results
 def get_inference_results(image_id):
-    result = InferenceResult.query.filter_by(image_id=image_id).first()
+    """The image's result from the project's current model, else its latest one marked ``"current": false``."""
+    image = db.session.query(Image.project_id, Image.content_hash).filter(Image.id == image_id).first()
+    result = version = None
+    if image:
+        cache.depends_on(f'training:{image.project_id}')  # A new model makes the cached answer stale
+        if image.content_hash:  # So does scoring another image with the same content
+            cache.depends_on(f'content:{image.content_hash}')
+        version = task_manager.model_version(image.project_id)
+        result = cached_result(image.content_hash, version)
+    if result is None:
+        result = InferenceResult.query.filter_by(image_id=image_id).order_by(InferenceResult.id.desc()).first()
     if not result:
         return jsonify({'error': 'Inference result not found'}), 404
     return jsonify({
         'image_id': image_id,
         'prediction': result.result,
+        'model_version': result.model_version,
+        'current': bool(image) and result.model_version == version,
         'created_at': result.created_at.strftime('%Y-%m-%d %H:%M:%S')
     }), 200
 
+# GET job status
+def get_job(job_id):
+    job = db.session.get(Job, job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify({
+        'job_id': job.id,
+        'kind': job.kind,
+        'project_id': job.project_id,
+        'priority': job_queue.PRIORITY_CLASSES.get(job.priority),
+        'status': job.status,
+        'attempts': job.attempts,
+        'error': job.error,
+        'created_at': format_time(job.created_at),
+        'started_at': format_time(job.started_at),
+        'finished_at': format_time(job.finished_at)
+    }), 200
+
+# GET queue depth and wait times per priority class
+def get_queue_stats():
+    window = current_app.config.get('JOB_STATS_WINDOW', 300)
+    return jsonify({'window_seconds': window, 'classes': job_queue.stats(window)}), 200
+
+# Training progress from the per-epoch metrics committed so far, with those after metric id ``after``
+def training_progress(job_id, after=0):
+    job = db.session.get(Job, job_id)
+    metrics = (TrainingMetric.query.filter(TrainingMetric.job_id == job_id, TrainingMetric.id > after)
+               .order_by(TrainingMetric.id).all())
+    mean_seconds = (db.session.query(func.avg(TrainingMetric.seconds))
+                    .filter(TrainingMetric.job_id == job_id).scalar())
+    latest = metrics[-1] if metrics else (
+        TrainingMetric.query.filter_by(job_id=job_id).order_by(TrainingMetric.id.desc()).first())
+    db.session.rollback()  # End the read transaction, so the next poll sees newly committed epochs
+    eta = None
+    if latest and job.status == 'running' and mean_seconds is not None:
+        eta = (latest.epochs - latest.epoch) * mean_seconds
+    return {
+        'job_id': job.id,
+        'status': job.status,
+        'epoch': latest.epoch if latest else 0,
+        'epochs': latest.epochs if latest else None,
+        'images_per_sec': _images_per_sec(latest) if latest else None,
+        'eta_seconds': eta,
+        'metrics': [{
+            'epoch': m.epoch,
+            'epochs': m.epochs,
+            'loss': m.loss,
+            'accuracy': m.accuracy,
+            'images': m.images,
+            'seconds': m.seconds,
+            'images_per_sec': _images_per_sec(m),
+            'created_at': format_time(m.created_at),
+        } for m in metrics],
+        'next_cursor': metrics[-1].id if metrics else after,
+    }
+
+def _images_per_sec(metric):
+    return metric.images / metric.seconds if metric.seconds else None
+
+# GET training progress: long-polls with ?after=<cursor>&timeout=<seconds>, or streams Server-Sent Events
+def get_training_progress(job_id):
+    job = db.session.get(Job, job_id)
+    if not job or job.kind != 'training':
+        return jsonify({'error': 'Training job not found'}), 404
+    config = current_app.config
+    interval = config.get('PROGRESS_POLL_INTERVAL', 0.5)
+    after = request.headers.get('Last-Event-ID', request.args.get('after', 0), type=int)
+    if request.accept_mimetypes.best_match(['application/json', 'text/event-stream']) == 'text/event-stream':
+        return Response(stream_with_context(_progress_events(job_id, after, interval, config)),
+                        mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    deadline = time.monotonic() + min(request.args.get('timeout', 0, type=float), config.get('PROGRESS_MAX_WAIT', 30))
+    while True:
+        progress = training_progress(job_id, after)
+        if progress['metrics'] or progress['status'] in ('done', 'failed') or time.monotonic() >= deadline:
+            return jsonify(progress), 200
+        time.sleep(interval)
+
+def _progress_events(job_id, after, interval, config):
+    keepalive = config.get('PROGRESS_KEEPALIVE', 15)
+    last_sent = time.monotonic()
+    while True:
+        progress = training_progress(job_id, after)
+        finished = progress['status'] in ('done', 'failed')
+        if progress['metrics'] or finished:
+            after = progress['next_cursor']
+            event = 'done' if finished else 'progress'
+            yield f'id: {after}\nevent: {event}\ndata: {json.dumps(progress)}\n\n'
+            last_sent = time.monotonic()
+            if finished:
+                return
+        elif time.monotonic() - last_sent >= keepalive:
+            yield ': keep-alive\n\n'  # Lets proxies and clients tell an idle stream from a dead one
+            last_sent = time.monotonic()
+        time.sleep(interval)
+
 # Functions for image
 def uploaded_file(filename):
-    """Function to retrieve files from the upload directory."""
-    return send_from_directory(current_app.config['UPLOAD_FOLDER'], filename)
+    """Function to retrieve files from the upload directory, by content hash or legacy filename."""
+    UPLOAD_FOLDER = current_app.config['UPLOAD_FOLDER']
+    if not storage.blob_exists(UPLOAD_FOLDER, filename):
+        # Files stored before content addressing can change under the same name
+        return send_from_directory(os.path.abspath(UPLOAD_FOLDER), filename,
+                                   max_age=current_app.config.get('UPLOAD_LEGACY_MAX_AGE'))
+    path = storage.blob_path(UPLOAD_FOLDER, filename)
+    etag = filename
+    width = request.args.get('w', type=int)
+    if width:
+        if width not in current_app.config.get('THUMBNAIL_WIDTHS', ()):
+            return jsonify({'error': 'Unsupported thumbnail width'}), 400
+        try:
+            path = storage.make_thumbnail(UPLOAD_FOLDER, filename, width)
+        except RuntimeError as e:
+            return jsonify({'error': str(e)}), 501
+        except (OSError, ValueError):
+            return jsonify({'error': 'Cannot make a thumbnail of this file'}), 415
+        etag = f'{filename}-w{width}'
+    return send_upload(path, etag)
+
+# Send a content-addressed file: by the fronting proxy (X-Accel-Redirect / X-Sendfile) or with Range support
+def send_upload(path, etag):
+    mode = current_app.config.get('UPLOAD_SERVE_MODE', 'direct')
+    mimetype = storage.guess_mimetype(path)
+    if mode == 'x-accel-redirect':
+        relative = os.path.relpath(path, current_app.config['UPLOAD_FOLDER']).replace(os.sep, '/')
+        response = current_app.response_class(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = current_app.config['UPLOAD_ACCEL_PREFIX'].rstrip('/') + '/' + relative
+        response.set_etag(etag)
+        response.make_conditional(request)
+    else:  # Answers Range and conditional requests itself
+        response = werkzeug_send_file(os.path.abspath(path), request.environ, mimetype=mimetype, etag=etag,
+                                      use_x_sendfile=mode == 'x-sendfile', response_class=current_app.response_class)
+    # Content-addressed bytes never change, so clients and proxies may keep them indefinitely
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config.get('UPLOAD_MAX_AGE', 31536000)
+    response.cache_control.immutable = True
+    return response
@@ -0,0 +1,149 @@
+import glob
+import hashlib
+import os
+import re
+import tempfile
+from features import PILImage
+
+# Content-addressed blob storage for uploads. Every distinct file is stored once
+# as UPLOAD_FOLDER/<first two hex digits>/<sha256>, whatever its name and however
+# many projects reference it; Image.content_hash points at the blob. Scaled-down
+# variants live under UPLOAD_FOLDER/thumbs/w<width>/ with the same layout.
+
+CHUNK_SIZE = 1024 * 1024
+SET_ASIDE_SUFFIX = '.reaping'  # A blob the reaper is about to remove, out of reach of new uploads
+HASH_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+def is_content_hash(value):
+    return bool(value and HASH_PATTERN.match(value))
+
+
+def blob_path(upload_folder, content_hash):
+    return os.path.join(upload_folder, content_hash[:2], content_hash)
+
+
+def blob_exists(upload_folder, content_hash):
+    return is_content_hash(content_hash) and os.path.exists(blob_path(upload_folder, content_hash))
+
+
+# Location of an image's file, including images uploaded before content addressing
+def image_path(upload_folder, image):
+    if image.content_hash:
+        return blob_path(upload_folder, image.content_hash)
+    return os.path.join(upload_folder, image.filename)
+
+
+def save_stream(stream, upload_folder, chunk_size=CHUNK_SIZE):
+    """Copy a stream to disk chunk by chunk while hashing it.
+
+    Returns ``(content_hash, size, created)``; ``created`` is False when the
+    blob was already stored and the new copy was discarded.
+    """
+    os.makedirs(upload_folder, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=upload_folder, prefix='.upload-')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        content_hash = digest.hexdigest()
+        path = blob_path(upload_folder, content_hash)
+        created = not os.path.exists(path)
+        if created:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)  # Atomic, so concurrent uploads of the same bytes are harmless
+        else:
+            os.remove(tmp_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return content_hash, size, created
+
+
+def _remove(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def remove_blob(upload_folder, content_hash):
+    _remove([blob_path(upload_folder, content_hash)]
+            + glob.glob(os.path.join(upload_folder, 'thumbs', 'w*', content_hash[:2], content_hash)))
+
+
+def set_aside_blob(upload_folder, content_hash):
+    """Move a blob out of the way before removing it; False if it isn't stored.
+
+    Uploads of the same bytes no longer find it and store their own copy.
+    """
+    path = blob_path(upload_folder, content_hash)
+    try:
+        os.rename(path, path + SET_ASIDE_SUFFIX)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def restore_blob(upload_folder, content_hash):
+    """Put a set-aside blob back; a copy stored meanwhile holds the same bytes."""
+    path = blob_path(upload_folder, content_hash)
+    try:
+        os.replace(path + SET_ASIDE_SUFFIX, path)
+    except FileNotFoundError:  # Settled by a sweep already
+        pass
+
+
+def discard_blob(upload_folder, content_hash):
+    """Remove a set-aside blob and its thumbnails, leaving any copy an upload stored meanwhile."""
+    _remove([blob_path(upload_folder, content_hash) + SET_ASIDE_SUFFIX]
+            + glob.glob(os.path.join(upload_folder, 'thumbs', 'w*', content_hash[:2], content_hash)))
+
+
+def thumbnail_path(upload_folder, content_hash, width):
+    return os.path.join(upload_folder, 'thumbs', f'w{width}', content_hash[:2], content_hash)
+
+
+def make_thumbnail(upload_folder, content_hash, width):
+    """Path of the blob scaled down to ``width`` pixels wide, generated on first use and kept on disk."""
+    path = thumbnail_path(upload_folder, content_hash, width)
+    if os.path.exists(path):
+        return path
+    if PILImage is None:
+        raise RuntimeError('Thumbnails need Pillow')
+    with PILImage.open(blob_path(upload_folder, content_hash)) as img:
+        image_format = img.format
+        height = max(1, img.height * width // img.width)
+        img.draft(img.mode, (width, height))  # JPEGs decode straight at a reduced scale
+        img.thumbnail((width, height))  # Never upscales
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.thumb-')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                img.save(out, image_format)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    return path
+
+
+# Sniff the image type from magic bytes, since blobs carry no extension
+def guess_mimetype(path):
+    with open(path, 'rb') as f:
+        head = f.read(8)
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if head.startswith(b'\xff\xd8'):
+        return 'image/jpeg'
+    return 'application/octet-stream'
@@ -1,39 +1,530 @@
+import atexit
+import click
+import logging
+import os
 import queue
+import socket
+import sys
 import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
 from flask import current_app
-from models import TrainingResult, InferenceResult, db
+from sqlalchemy import func, or_, update
+from models import Image, Job, TrainingMetric, TrainingResult, InferenceResult, db
+import job_queue
+import cache
+import metrics
+import features
+import group_commit
+import inference_pool
+import reaper
+import storage
+import training
+import vector_index
 
-# Queue setup
-training_queue = queue.Queue()
-inference_queue = queue.Queue()
+logger = logging.getLogger(__name__)
 
-def training_worker(app):
-    with app.app_context():
-        while True:
-            project_id = training_queue.get()
-            if project_id is None:
+
+# Config key holding the number of worker threads per job kind
+WORKER_SETTINGS = {
+    'training': 'TRAINING_WORKERS',
+    'inference': 'INFERENCE_WORKERS',
+    'features': 'FEATURE_WORKERS',
+    'index': 'INDEX_WORKERS',
+}
+
+
+class WorkerPool:
+    """Worker threads draining the durable job queue, one group per job kind.
+
+    The in-memory queues only carry wakeups (job ids) and the ``None`` shutdown
+    sentinel; the jobs themselves live in the database, so workers also poll and
+    pick up jobs enqueued by other processes.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        maxsize = app.config.get('TASK_QUEUE_MAXSIZE', 0)
+        self.queues = {kind: queue.Queue(maxsize=maxsize) for kind in WORKER_SETTINGS}
+        self.queues['reaper'] = queue.Queue(maxsize=1)  # Wakeups coalesce; one pass reaps every tombstone
+        self.threads = []
+
+    @property
+    def training_queue(self):
+        return self.queues['training']
+
+    @property
+    def inference_queue(self):
+        return self.queues['inference']
+
+    def start(self):
+        workers = {'training': training_worker, 'inference': inference_worker, 'features': features_worker,
+                   'index': index_worker}
+        for kind, setting in WORKER_SETTINGS.items():
+            for i in range(self.app.config.get(setting, 1)):
+                self._spawn(workers[kind], self.queues[kind], f'{kind}-worker-{i}')
+        if self.app.config.get('REAPER_INTERVAL'):
+            self._spawn(reaper.reaper_worker, self.queues['reaper'], 'reaper')
+
+    def _spawn(self, target, task_queue, name):
+        thread = threading.Thread(target=target, args=(self.app, task_queue), name=name, daemon=True)
+        thread.task_queue = task_queue
+        thread.start()
+        self.threads.append(thread)
+
+    def notify(self, kind, job_id):
+        """Wake an idle worker for ``kind``; a dropped wakeup only delays the job until the next poll."""
+        try:
+            self.queues[kind].put_nowait(job_id)
+        except queue.Full:
+            pass
+
+    def shutdown(self, timeout=None):
+        """Send one ``None`` sentinel per worker and wait for them to finish their current job."""
+        threads, self.threads = self.threads, []
+        for thread in threads:
+            thread.task_queue.put(None)
+        for thread in threads:
+            thread.join(timeout)
+        # The writer goes last so workers' final results still get committed
+        writer = self.app.extensions.get('group_commit')
+        if writer is not None and writer.thread.is_alive():
+            writer.shutdown(timeout)
+
+
+class ModelCache:
+    """LRU cache of loaded models keyed by (project_id, training_result_id), bounded by a byte budget.
+
+    The key carries the id of the project's latest TrainingResult, so a model
+    trained in another process is picked up on the next lookup without any
+    cross-process invalidation.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.models = OrderedDict()  # (project_id, version) -> (model, nbytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, project_id, version, loader):
+        key = (project_id, version)
+        with self._lock:
+            entry = self.models.get(key)
+            if entry is not None:
+                self.models.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        model = loader(project_id, version)
+        self.put(key, model)
+        return model
+
+    def put(self, key, model):
+        nbytes = getattr(model, 'nbytes', None) or sys.getsizeof(model)
+        with self._lock:
+            # A newer version of the project's model supersedes any cached one
+            for stale in [k for k in self.models if k[0] == key[0]]:
+                self._drop(stale)
+            self.models[key] = (model, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes and len(self.models) > 1:
+                self._drop(next(iter(self.models)))
+                self.evictions += 1
+
+    def invalidate(self, project_id):
+        with self._lock:
+            for key in [k for k in self.models if k[0] == project_id]:
+                self._drop(key)
+
+    def _drop(self, key):
+        self.nbytes -= self.models.pop(key)[1]
+
+    def stats(self):
+        with self._lock:
+            return {'models': len(self.models), 'bytes': self.nbytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+def init_app(app):
+    app.extensions['model_cache'] = ModelCache(app.config.get('MODEL_CACHE_BYTES', 512 * 1024 * 1024))
+    pool = WorkerPool(app)
+    app.extensions['worker_pool'] = pool
+    if app.config.get('GROUP_COMMIT'):
+        app.extensions['group_commit'] = group_commit.GroupCommitWriter(app)
+    pool.start()
+    atexit.register(pool.shutdown)
+    app.cli.command('backfill-features')(backfill_features_command)
+    app.cli.command('reap')(reaper.reap_command)
+    return pool
+
+
+def get_pool():
+    return current_app.extensions['worker_pool']
+
+
+def get_model_cache():
+    return current_app.extensions['model_cache']
+
+
+# Enqueue a durable job and wake a local worker for it
+def submit(kind, project_id, payload=None, priority=None):
+    return submit_many(kind, project_id, [payload], priority)[0]
+
+
+def submit_many(kind, project_id, payloads, priority=None):
+    jobs = job_queue.enqueue_many(kind, project_id, payloads, priority)
+    pool = get_pool()
+    for job in jobs:
+        pool.notify(kind, job.id)
+    return jobs
+
+
+# Like submit, but hands back a still queued duplicate instead; returns (job, coalesced)
+def submit_coalesced(kind, project_id, payload=None, priority=None, merge=None):
+    job, coalesced = job_queue.enqueue_coalesced(kind, project_id, payload, priority, merge)
+    if not coalesced:
+        get_pool().notify(kind, job.id)
+    return job, coalesced
+
+
+# Have the reaper collect freshly tombstoned rows now rather than at its next interval
+def wake_reaper():
+    get_pool().notify('reaper', True)
+
+
+class PlaceholderModel:
+    """Stand-in model until training produces real weights; scores a whole batch per call."""
+
+    def __init__(self, project_id, version):
+        self.project_id = project_id
+        self.version = version
+
+    def predict(self, images):
+        return ["Example Result"] * len(images)
+
+
+def load_model(project_id, version):
+    model_path = None
+    if version is not None:
+        model_path = db.session.query(TrainingResult.model_path).filter(TrainingResult.id == version).scalar()
+    if model_path is None:
+        return PlaceholderModel(project_id, version)
+    model = training.load_classifier(model_path)
+    logger.info("Model loaded successfully for project_id: %s", project_id)
+    return model
+
+
+# The version of the model inference uses: the id of the TrainingResult that saved the project's current
+# model, so a retrain that keeps the model (nothing new to learn) keeps the cached results; None before training
+def model_version(project_id):
+    latest = (db.session.query(func.max(TrainingResult.id))
+              .filter(TrainingResult.project_id == project_id).scalar_subquery())
+    path = db.session.query(TrainingResult.model_path).filter(TrainingResult.id == latest).scalar_subquery()
+    return (db.session.query(func.min(TrainingResult.id))
+            .filter(TrainingResult.project_id == project_id,
+                    or_(TrainingResult.id == latest, TrainingResult.model_path == path)).scalar())
+
+
+# The project's current model, loaded only when its latest TrainingResult isn't cached yet
+def get_model(project_id):
+    return get_model_cache().get(project_id, model_version(project_id), load_model)
+
+
+def train(jobs):
+    rows = []
+    for job in jobs:
+        logger.info("Training project %s...", job.project_id)
+        payload = job.payload or {}
+        # Snapshot taken at enqueue; older jobs read the current one
+        settings = payload.get('config') or training.training_settings(job.project_id)
+        base = None if payload.get('full') else training.training_base(job.project_id, settings)
+        checkpoint = load_checkpoint(job.project_id, base.id) if base is not None else None
+        rows.append(dict(training.train_project(job.project_id, epoch_recorder(job), settings, base, checkpoint),
+                         created_at=datetime.utcnow()))
+        get_model_cache().invalidate(job.project_id)
+    return [('insert', TrainingResult, rows)]
+
+
+# The model to fine-tune, from the cache when inference has it loaded; None if its file is gone
+def load_checkpoint(project_id, version):
+    try:
+        return get_model_cache().get(project_id, version, load_model)
+    except OSError:
+        logger.warning("Model of training result %s is missing; retraining project %s in full", version, project_id)
+        return None
+
+
+# Commit every finished epoch as a TrainingMetric, renewing the job's lease so long runs aren't reclaimed
+def epoch_recorder(job):
+    job_id, project_id = job.id, job.project_id
+    lease = timedelta(seconds=current_app.config.get('JOB_LEASE_SECONDS', 300))
+
+    def record(progress, settings):
+        now = datetime.utcnow()
+        commit_results([
+            ('insert', TrainingMetric, [{
+                'job_id': job_id, 'project_id': project_id, 'epoch': progress['epoch'], 'epochs': settings['epochs'],
+                'loss': progress['loss'], 'accuracy': progress['accuracy'], 'images': progress['images'],
+                'seconds': progress['seconds'], 'created_at': now,
+            }]),
+            ('update', Job, [{'id': job_id, 'lease_expires_at': now + lease}]),
+        ], [])
+    return record
+
+
+# Predictions of a project's model for Image rows: on the inference process pool with INFERENCE_PROCESSES,
+# else in this thread with the model cache
+def predict(project_id, version, images):
+    config = current_app.config
+    processes = config.get('INFERENCE_PROCESSES', 0)
+    if processes and version is not None:
+        model_path = db.session.query(TrainingResult.model_path).filter(TrainingResult.id == version).scalar()
+        if model_path is not None:
+            return inference_pool.predict(version, model_path, images, config['UPLOAD_FOLDER'], processes,
+                                          config.get('INFERENCE_PROCESS_MODEL_BYTES', 256 * 1024 * 1024))
+    return get_model_cache().get(project_id, version, load_model).predict(images)
+
+
+def infer(jobs):
+    """Score every image of a micro-batch of same-project jobs with one model call and one insert.
+
+    Content the current model has already scored, in this batch or before, is
+    not scored again; every image still gets a result row.
+    """
+    project_id = jobs[0].project_id
+    image_ids = [image_id for job in jobs for image_id in job.payload['image_ids']]
+    images = Image.query.filter(Image.id.in_(image_ids), Image.project_id == project_id).all()
+    if not images:
+        return []
+    version = model_version(project_id)
+    hashes = {image.content_hash for image in images if image.content_hash}
+    known = dict(db.session.query(InferenceResult.content_hash, InferenceResult.result)
+                 .filter(InferenceResult.content_hash.in_(hashes), InferenceResult.model_version == version)
+                 .all()) if hashes else {}
+    unscored = {}  # One image per blob this model hasn't scored; images without a hash are scored on their own
+    for image in images:
+        if (image.content_hash or image.id) not in known:
+            unscored.setdefault(image.content_hash or image.id, image)
+    if unscored:
+        known.update(zip(unscored, predict(project_id, version, list(unscored.values()))))
+    now = datetime.utcnow()
+    return [('insert', InferenceResult, [
+        {'image_id': image.id, 'result': known[image.content_hash or image.id],
+         'content_hash': image.content_hash, 'model_version': version, 'created_at': now}
+        for image in images
+    ])]
+
+
+# Size, dimensions and perceptual hash for images as Image update rows, decoded on the process pool
+def image_feature_updates(image_ids):
+    UPLOAD_FOLDER = current_app.config['UPLOAD_FOLDER']
+    rows = (db.session.query(Image.id, Image.filename, Image.content_hash)
+            .filter(Image.id.in_(image_ids)).all())
+    paths = [storage.image_path(UPLOAD_FOLDER, row) for row in rows]
+    extracted = features.extract_many(paths, current_app.config.get('FEATURE_PROCESSES', 0))
+    now = datetime.utcnow()
+    return [dict(values, id=row.id, embedded_at=now if values.get('embedding') is not None else None)
+            for row, values in zip(rows, extracted) if values]
+
+
+def extract(jobs):
+    return [('update', Image, image_feature_updates([i for job in jobs for i in job.payload['image_ids']]))]
+
+
+# Rebuild the similarity index of each project once; coalescing leaves one job per project
+def index(jobs):
+    for project_id in sorted({job.project_id for job in jobs}):
+        logger.info("Rebuilt the %s similarity index segment of project %s",
+                    vector_index.rebuild(project_id), project_id)
+    return []
+
+
+HANDLERS = {'training': train, 'inference': infer, 'features': extract, 'index': index}
+
+
+# Queue an index rebuild for projects whose embeddings changed; a full queue leaves it to the next one
+def schedule_index(project_ids):
+    if vector_index.np is None:
+        return
+    for project_id in sorted(set(project_ids)):
+        try:
+            submit_coalesced('index', project_id)
+        except queue.Full:
+            metrics.record_rejected('index')
+            logger.warning("Index queue full; project %s is indexed on its next upload", project_id)
+
+
+def index_extracted(jobs):
+    schedule_index(job.project_id for job in jobs)
+
+
+# Jobs queued once a handler's writes are committed
+FOLLOW_UPS = {'features': index_extracted}
+
+
+# Queue feature extraction for new uploads; a full queue leaves them for backfill_features
+def schedule_features(project_id, image_ids):
+    batch_size = current_app.config.get('FEATURE_BATCH_SIZE', 256)
+    payloads = [{'image_ids': image_ids[i:i + batch_size]} for i in range(0, len(image_ids), batch_size)]
+    try:
+        submit_many('features', project_id, payloads)
+    except queue.Full:
+        metrics.record_rejected('features')
+        logger.warning("Feature queue full; %d images of project %s left for backfill", len(image_ids), project_id)
+
+
+def backfill_features(batch_size=1000):
+    """Extract features for every image still missing them (or its embedding), in id order, one commit per batch."""
+    missing = Image.feature_size.is_(None)
+    if features.np is not None and features.PILImage is not None:
+        missing = or_(missing, Image.embedding.is_(None))
+    done, last_id = 0, 0
+    while True:
+        rows = (db.session.query(Image.id, Image.project_id)
+                .filter(Image.id > last_id, missing)
+                .order_by(Image.id).limit(batch_size).all())
+        if not rows:
+            return done
+        updates = image_feature_updates([row.id for row in rows])
+        if updates:
+            db.session.execute(update(Image), updates)
+        db.session.commit()
+        cache.invalidate(*[f"image:{u['id']}" for u in updates], *{f'images:{row.project_id}' for row in rows})
+        schedule_index(row.project_id for row in rows)
+        done += len(updates)
+        last_id = rows[-1].id
+
+
+# Commit a handler's writes together with the completion of its jobs
+def commit_results(writes, lease_tokens):
+    writer = current_app.extensions.get('group_commit')
+    if writer is None:
+        group_commit.apply(writes, lease_tokens)
+        db.session.commit()
+        return
+    db.session.rollback()  # End this worker's read transaction; the writer commits on its own connection
+    writer.submit(writes, lease_tokens).result()
+
+
+# Cache tags of the responses a handler's writes make stale
+def result_tags(jobs, writes):
+    tags = []
+    for operation, model, rows in writes:
+        if model is TrainingResult:
+            tags += [f"training:{row['project_id']}" for row in rows]
+        elif model is InferenceResult:
+            tags += [f"inference:{row['image_id']}" for row in rows]
+            tags += [f"content:{row['content_hash']}" for row in rows if row.get('content_hash')]
+        elif model is Image:
+            tags += [f"image:{row['id']}" for row in rows] + [f'images:{job.project_id}' for job in jobs]
+    return tags
+
+
+def run_jobs(jobs):
+    started = time.perf_counter()
+    kind, waits = jobs[0].kind, metrics.job_waits(jobs)  # Before any commit can expire the jobs
+    try:
+        writes = HANDLERS[kind](jobs)
+        commit_results(writes, [job.lease_token for job in jobs])
+        cache.invalidate(*result_tags(jobs, writes))
+    except Exception as e:
+        logger.exception("%s jobs %s failed", kind, [job.id for job in jobs])
+        for job in jobs:
+            job_queue.fail(job, e)
+        metrics.record_jobs(kind, len(jobs), waits, time.perf_counter() - started, 'failed')
+        return
+    metrics.record_jobs(kind, len(jobs), waits, time.perf_counter() - started, 'done')
+    if kind in FOLLOW_UPS:
+        FOLLOW_UPS[kind](jobs)
+
+
+# Claim a job plus, for inference, more pending jobs of the same project up to a micro-batch.
+# The jobs are detached from the session: their claim-time values are all run_jobs reads.
+def claim_batch(kind, worker_id):
+    job = job_queue.claim(kind, worker_id)
+    if job is None:
+        return []
+    db.session.expunge(job)
+    if kind != 'inference':
+        return [job]
+    max_size = current_app.config.get('INFERENCE_BATCH_SIZE', 64)
+    deadline = time.monotonic() + current_app.config.get('INFERENCE_BATCH_WAIT', 0.05)
+    jobs, size = [job], len(job.payload['image_ids'])
+    first_size = max(1, size)
+    while size < max_size:
+        # As many jobs as fill the batch if they are the size of the first; any past it go back
+        claimed = job_queue.claim_many(kind, worker_id, job.project_id, -(-(max_size - size) // first_size))
+        extra = []
+        for more in claimed:
+            if size < max_size:
+                jobs.append(more)
+                size += len(more.payload['image_ids'])
+            else:
+                extra.append(more)
+        job_queue.release(extra)
+        if not claimed:
+            if time.monotonic() >= deadline:
                 break
-            # Implement training logic
-            print(f"Training project {project_id}...")
-            result = TrainingResult(project_id=project_id, accuracy=0.9, loss=0.1)
-            db.session.add(result)
-            db.session.commit()
-            training_queue.task_done()
-
-def inference_worker(app):
+            time.sleep(0.005)
+    return jobs
+
+
+# Process every claimable job of a kind in the calling thread (tests, one-off drains)
+def run_pending(kind, worker_id='inline'):
+    processed = 0
+    while True:
+        jobs = claim_batch(kind, worker_id)
+        if not jobs:
+            return processed
+        run_jobs(jobs)
+        processed += len(jobs)
+
+
+def _worker_loop(app, task_queue, kind):
+    worker_id = f'{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}'
+    poll_interval = app.config.get('JOB_POLL_INTERVAL', 1.0)
     with app.app_context():
         while True:
-            task = inference_queue.get()
-            if task is None:
+            try:
+                jobs = claim_batch(kind, worker_id)
+                if jobs:
+                    run_jobs(jobs)
+            except Exception:
+                logger.exception("%s worker %s could not claim a job", kind, worker_id)
+                db.session.rollback()
+                jobs = []
+            # Only sleep on the wakeup queue when there was nothing to do
+            try:
+                signal = task_queue.get(block=not jobs, timeout=poll_interval)
+            except queue.Empty:
+                continue
+            task_queue.task_done()
+            if signal is None:
                 break
-            print(f"Model loaded successfully for project_id: {task['project_id']}")
-            result = InferenceResult(image_id=task['image_id'], result="Example Result")
-            db.session.add(result)
-            db.session.commit()
-            inference_queue.task_done()
-
-# Start threads
-if __name__ == '__main__':
-    app = current_app._get_current_object()
-    threading.Thread(target=training_worker, args=(app,), daemon=True).start()
-    threading.Thread(target=inference_worker, args=(app,), daemon=True).start()
+        db.session.remove()
+
+
+@click.option('--batch-size', default=1000, show_default=True, help='Images per commit.')
+def backfill_features_command(batch_size):
+    """Compute size, dimensions, perceptual hash and embedding for images uploaded before extraction ran."""
+    click.echo(f'Extracted features for {backfill_features(batch_size)} images')
+
+
+def training_worker(app, task_queue):
+    _worker_loop(app, task_queue, 'training')
+
+
+def inference_worker(app, task_queue):
+    _worker_loop(app, task_queue, 'inference')
+
+
+def features_worker(app, task_queue):
+    _worker_loop(app, task_queue, 'features')
+
+
+def index_worker(app, task_queue):
+    _worker_loop(app, task_queue, 'index')
@@ -1,9 +1,60 @@
+import asyncio
 import io
+import math
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
 import unittest
+import zipfile
+from collections import OrderedDict, namedtuple
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from unittest import mock
 from flask import json
+import sqlalchemy
+from sqlalchemy import event
+from werkzeug.serving import make_server
 from app import create_app
 from extensions import db
 from config import TestConfig
+from models import Image, InferenceResult, Job, Project, TrainingResult, User
+import api_client
+import benchmark
+import cache
+import client
+import dataloader
+import features
+import group_commit
+import inference_pool
+import job_queue
+import metrics
+import migrations
+import process_pool
+import reaper
+import storage
+import task_manager
+import training
+import vector_index
+
+
+@contextmanager
+def count_queries(with_parameters=False):
+    """Collect the SQL statements (and optionally their parameters) executed inside the block."""
+    statements = []
+
+    def listener(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters) if with_parameters else statement)
+
+    event.listen(db.engine, 'before_cursor_execute', listener)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', listener)
+
 
 class TestFlaskApi(unittest.TestCase):
 
@@ -15,6 +66,8 @@ class TestFlaskApi(unittest.TestCase):
     def setUp(self):
         """Set up the application context and test client before each test."""
         self.app = self.create_app()
+        self.upload_dir = tempfile.mkdtemp()
+        self.app.config['UPLOAD_FOLDER'] = self.upload_dir
         self.app_context = self.app.app_context()
         self.app_context.push()
         self.client = self.app.test_client()
@@ -25,6 +78,7 @@ class TestFlaskApi(unittest.TestCase):
         db.session.remove()
         db.drop_all()
         self.app_context.pop()
+        shutil.rmtree(self.upload_dir)
 
     def test_register_user(self):
         """Test user registration functionality."""
@@ -104,6 +158,250 @@ class TestFlaskApi(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIn('Image deleted successfully', response.json['message'])
 
+    def test_upload_deduplicates_content(self):
+        """Identical bytes are stored once, and known content can be attached without re-uploading."""
+        self.test_upload_image()
+        first = self.client.get('/api/image/1/').json
+        response = self.client.post('/api/upload_image/1/', data={
+            'file': (io.BytesIO(b"test image data"), 'other.png')
+        }, content_type='multipart/form-data')
+        self.assertEqual(response.json['content_hash'], first['content_hash'])
+        self.assertTrue(response.json['deduplicated'])
+
+        self.assertEqual(self.client.get(f"/api/blobs/{first['content_hash']}/").json['size'], 15)
+        self.assertEqual(self.client.head('/api/blobs/' + '0' * 64 + '/').status_code, 404)
+        response = self.client.post('/api/upload_image/1/', data={
+            'content_hash': first['content_hash'], 'filename': 'again.jpg'
+        })
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(os.listdir(os.path.join(self.upload_dir, first['content_hash'][:2]))), 1)
+
+        # The blob outlives the deletion of one of the images referencing it
+        self.client.delete('/api/delete_image/testuser/1/1/')
+        self.assertEqual(self.client.get(f"/api/uploads/{first['content_hash']}").data, b"test image data")
+
+    def test_bulk_upload_multipart(self):
+        """Many files in one multipart request are stored in one transaction with per-file results."""
+        self.test_create_project()
+        response = self.client.post('/api/upload_images/1/', data={
+            'files': [(io.BytesIO(b"a"), 'a.png'), (io.BytesIO(b"b"), 'b.jpg'), (io.BytesIO(b"c"), 'c.txt')],
+            'labels': json.dumps({'a.png': 'cat'})
+        }, content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((response.json['accepted'], response.json['rejected']), (2, 1))
+        self.assertEqual([r['status'] for r in response.json['results']], ['accepted', 'accepted', 'rejected'])
+        self.assertEqual(self.client.get('/api/image/1/').json['label'], 'cat')
+        for labels in ('{not json', '["cat"]', '{"a.png": 3}'):
+            response = self.client.post('/api/upload_images/1/', data={
+                'files': [(io.BytesIO(b"a"), 'a.png')], 'labels': labels}, content_type='multipart/form-data')
+            self.assertEqual(response.status_code, 400, labels)
+
+        # The body is parsed as it streams, chunk boundaries anywhere; labels past werkzeug's 500 KB form default fit
+        self.app.config['UPLOAD_CHUNK_SIZE'] = 7
+        labels = {f'{i:06}.png': 'dog' for i in range(40000)}
+        response = self.client.post('/api/upload_images/1/', data={
+            'label': 'cat', 'labels': json.dumps(labels),
+            'files': [(io.BytesIO(b"d" * 50), '000001.png'), (io.BytesIO(b"e" * 50), 'e.png')]
+        }, content_type='multipart/form-data')
+        self.assertEqual([r['status'] for r in response.json['results']], ['accepted', 'accepted'])
+        self.assertEqual([self.client.get(f"/api/image/{r['image_id']}/").json['label']
+                          for r in response.json['results']], ['dog', 'cat'])
+        self.assertEqual(self.client.get(f"/api/uploads/{response.json['results'][0]['content_hash']}").data, b"d" * 50)
+        self.app.config['MAX_INGEST_FORM_MEMORY'] = 1024
+        response = self.client.post('/api/upload_images/1/', data={
+            'labels': json.dumps(labels), 'files': [(io.BytesIO(b"a"), 'a.png')]}, content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 413)
+
+    def test_bulk_upload_archives(self):
+        """Tar and zip bodies are unpacked, labelling each image by its directory."""
+        self.test_create_project()
+        tar_body = io.BytesIO()
+        with tarfile.open(fileobj=tar_body, mode='w:gz') as archive:
+            for name, data in [('cats/1.png', b'cat'), ('dogs/2.jpg', b'dog'), ('README', b'x')]:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+        response = self.client.post('/api/upload_images/1/', data=tar_body.getvalue(), content_type='application/gzip')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json['accepted'], 2)
+        self.assertEqual(self.client.get('/api/image/2/').json['label'], 'dogs')
+
+        zip_body = io.BytesIO()
+        with zipfile.ZipFile(zip_body, 'w') as archive:
+            archive.writestr('birds/3.jpeg', b'bird')
+        response = self.client.post('/api/upload_images/1/', data=zip_body.getvalue(), content_type='application/zip')
+        self.assertEqual(response.json['results'][0]['image_id'], 3)
+        response = self.client.post('/api/upload_images/1/', data=b'not a zip', content_type='application/zip')
+        self.assertEqual(response.status_code, 400)
+
+    @unittest.skipIf(features.PILImage is None, 'Pillow is not installed')
+    def test_feature_extraction_after_upload(self):
+        """Uploads queue a features job that records size, dimensions, channels and perceptual hash."""
+        self.test_create_project()
+        body = io.BytesIO()
+        features.PILImage.new('RGBA', (40, 30), (255, 0, 0, 255)).save(body, 'PNG')
+        self.client.post('/api/upload_image/1/', data={
+            'file': (io.BytesIO(body.getvalue()), 'red.png')
+        }, content_type='multipart/form-data')
+        self.assertIsNone(self.client.get('/api/image/1/').json['width'])
+        self.assertEqual(task_manager.run_pending('features'), 1)
+        image = self.client.get('/api/image/1/').json
+        self.assertEqual((image['width'], image['height'], image['channels']), (40, 30, 4))
+        self.assertEqual(image['feature_size'], len(body.getvalue()))
+        self.assertEqual(len(image['phash']), 16)
+
+    @unittest.skipIf(features.PILImage is None, 'Pillow is not installed')
+    def test_read_header_jpeg_and_process_pool(self):
+        """JPEG dimensions come from the SOF header, and extraction also runs on the process pool."""
+        path = os.path.join(self.upload_dir, 'gray.jpg')
+        features.PILImage.new('L', (17, 9)).save(path, 'JPEG')
+        self.assertEqual(features.read_header(path), (17, 9, 1))
+        [extracted] = features.extract_many([path], processes=1)
+        self.assertEqual(extracted['width'], 17)
+
+    def test_backfill_features_command(self):
+        """The backfill command fills in features for images that never had them extracted."""
+        self.test_upload_image()
+        result = self.app.test_cli_runner().invoke(args=['backfill-features'])
+        self.assertIn('Extracted features for 1 images', result.output)
+        self.assertEqual(self.client.get('/api/image/1/').json['feature_size'], 15)
+
+    def test_analyze_project_aggregates(self):
+        """Analysis reports sizes, label counts, percentiles and a histogram computed in SQL."""
+        self.test_create_project()
+        sizes = [(10.0, 'cat'), (20.0, 'cat'), (30.0, 'dog'), (40.0, 'dog'), (None, 'dog')]
+        db.session.add_all([Image(filename=f'{i}.png', label=label, feature_size=size, project_id=1)
+                            for i, (size, label) in enumerate(sizes)])
+        db.session.commit()
+        response = self.client.get('/api/analyze_project/1/?bins=2')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['num_images'], 5)
+        self.assertEqual(response.json['num_images_with_features'], 4)
+        self.assertEqual(response.json['total_feature_size'], 100.0)
+        self.assertEqual(response.json['average_feature_size'], 25.0)
+        self.assertEqual(response.json['label_counts'], {'cat': 2, 'dog': 3})
+        self.assertEqual(response.json['feature_size_percentiles']['p50'], 20.0)
+        self.assertEqual(response.json['feature_size_histogram'], {'bin_edges': [10.0, 25.0, 40.0], 'counts': [2, 2]})
+        response = self.client.get('/api/analyze_project/1/?bins=3')
+        self.assertEqual(response.json['feature_size_histogram'], {'bin_edges': [10.0, 20.0, 30.0, 40.0], 'counts': [1, 1, 2]})
+
+    def test_paginated_listings(self):
+        """Listings are keyset-paginated, honour fields= and cost one query per page."""
+        self.test_create_project()
+        for name in ('Second', 'Third'):
+            self.client.post('/api/create_project/', json={'username': 'testuser', 'project_type': 'x', 'name': name})
+        with count_queries() as statements:
+            response = self.client.get('/api/user/testuser/projects/?limit=2&fields=project_name')
+        self.assertEqual(len(statements), 2)  # User id lookup plus the page
+        self.assertEqual(response.json['items'], [{'project_name': 'Test Project'}, {'project_name': 'Second'}])
+        response = self.client.get(f"/api/user/testuser/projects/?limit=2&after={response.json['next_cursor']}")
+        self.assertEqual([p['project_id'] for p in response.json['items']], [3])
+        self.assertIsNone(response.json['next_cursor'])
+        self.assertEqual(self.client.get('/api/user/testuser/').json['projects_next_cursor'], None)
+        self.assertEqual(self.client.get('/api/project/1/images/?fields=password').status_code, 400)
+
+    def test_get_project_and_image_query_counts(self):
+        """Project and image lookups eager-load their owners instead of lazy loading."""
+        self.test_upload_image()
+        with count_queries() as statements:
+            response = self.client.get('/api/project/1/')
+        self.assertEqual(response.json['associated_user'], 'testuser')
+        self.assertEqual(response.json['num_images'], 1)
+        self.assertEqual(len(statements), 2)
+        with count_queries() as statements:
+            response = self.client.get('/api/image/1/')
+        self.assertEqual(response.json['associated_user'], 'testuser')
+        self.assertEqual(len(statements), 1)
+        response = self.client.get('/api/project/1/images/?fields=image_id,filename')
+        self.assertEqual(response.json['items'], [{'image_id': 1, 'filename': 'test.jpg'}])
+
+    def test_cached_reads_and_etags(self):
+        """Repeated GETs are served from cache with ETags, until a mutation invalidates them."""
+        self.test_create_project()
+        first = self.client.get('/api/project/1/')
+        with count_queries() as statements:
+            second = self.client.get('/api/project/1/')
+        self.assertEqual(statements, [])
+        self.assertEqual(second.json, first.json)
+        response = self.client.get('/api/project/1/', headers={'If-None-Match': first.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+        self.client.post('/api/configure_training/1/', json={'learning_rate': 0.5, 'epochs': 1, 'batch_size': 4})
+        self.assertEqual(self.client.get('/api/project/1/').json['training_config']['learning_rate'], 0.5)
+        self.client.post('/api/upload_image/1/', data={
+            'file': (io.BytesIO(b"x"), 'x.png')
+        }, content_type='multipart/form-data')
+        self.assertEqual(self.client.get('/api/project/1/').json['num_images'], 1)
+
+        self.assertEqual(self.client.get('/api/inference_results/1/').status_code, 404)
+        self.client.post('/api/enqueue_inference/1/1/')
+        task_manager.run_pending('inference')
+        self.assertEqual(self.client.get('/api/inference_results/1/').status_code, 200)
+        self.assertEqual(len(self.client.get('/api/user/testuser/').json['projects']), 1)
+        self.client.post('/api/create_project/', json={'username': 'testuser', 'project_type': 'x', 'name': 'Two'})
+        self.assertEqual(len(self.client.get('/api/user/testuser/').json['projects']), 2)
+
+    def test_memory_cache_bounds_tags(self):
+        """Tag versions are dropped on invalidation and past a bound, costing misses but never stale hits."""
+        memory = cache.MemoryCache(max_entries=2, max_tags=3)
+        first = memory.tag_versions(['a', 'b'])
+        memory.invalidate(['a', 'never-read'])
+        self.assertEqual(list(memory.tags), ['b'])
+        self.assertNotEqual(memory.tag_versions(['a']), first[:1])
+        memory.tag_versions(['c', 'd', 'e'])
+        self.assertEqual(list(memory.tags), ['c', 'd', 'e'])
+        self.assertEqual(cache.get_cache().default_ttl, self.app.config['CACHE_MEMORY_TTL'])
+
+    def test_uploaded_file_ranges_and_caching(self):
+        """Blobs are served with content-hash ETags, long-lived caching, Range support, or via the proxy."""
+        self.test_create_project()
+        content_hash = self.client.post('/api/upload_image/1/', data={
+            'file': (io.BytesIO(b"0123456789"), 'digits.png')
+        }, content_type='multipart/form-data').json['content_hash']
+        url = f'/api/uploads/{content_hash}'
+        response = self.client.get(url)
+        self.assertEqual(response.headers['ETag'], f'"{content_hash}"')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        response.close()
+        response = self.client.get(url, headers={'Range': 'bytes=2-5'})
+        self.assertEqual((response.status_code, response.data), (206, b"2345"))
+        response.close()
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': f'"{content_hash}"'}).status_code, 304)
+
+        self.app.config.update(UPLOAD_SERVE_MODE='x-accel-redirect', UPLOAD_ACCEL_PREFIX='/internal/')
+        response = self.client.get(url)
+        self.assertEqual(response.headers['X-Accel-Redirect'], f'/internal/{content_hash[:2]}/{content_hash}')
+        self.assertEqual(response.data, b"")
+        self.app.config['UPLOAD_SERVE_MODE'] = 'x-sendfile'
+        response = self.client.get(url)
+        self.assertTrue(response.headers['X-Sendfile'].endswith(content_hash))
+
+    @unittest.skipIf(features.PILImage is None, 'Pillow is not installed')
+    def test_uploaded_file_thumbnails(self):
+        """?w= serves a scaled-down copy that is generated once and kept on disk."""
+        self.test_create_project()
+        body = io.BytesIO()
+        features.PILImage.new('RGB', (400, 300), (0, 0, 255)).save(body, 'PNG')
+        content_hash = self.client.post('/api/upload_image/1/', data={
+            'file': (io.BytesIO(body.getvalue()), 'blue.png')
+        }, content_type='multipart/form-data').json['content_hash']
+        response = self.client.get(f'/api/uploads/{content_hash}?w=128')
+        self.assertEqual(response.headers['ETag'], f'"{content_hash}-w128"')
+        with features.PILImage.open(io.BytesIO(response.data)) as thumb:
+            self.assertEqual((thumb.format, thumb.size), ('PNG', (128, 96)))
+        response.close()
+        with mock.patch.object(features.PILImage, 'open') as pil_open:
+            self.assertEqual(self.client.get(f'/api/uploads/{content_hash}?w=128').status_code, 200)
+        pil_open.assert_not_called()
+        self.assertEqual(self.client.get(f'/api/uploads/{content_hash}?w=100').status_code, 400)
+        with mock.patch.object(features.PILImage.Image, 'save', side_effect=OSError('No space left on device')):
+            self.assertRaises(OSError, storage.make_thumbnail, self.upload_dir, content_hash, 256)
+        self.assertEqual(os.listdir(os.path.dirname(storage.thumbnail_path(self.upload_dir, content_hash, 256))), [])
+
+        self.client.delete('/api/delete_image/testuser/1/1/')
+        reaper.reap_all(self.upload_dir)
+        self.assertFalse(os.path.exists(storage.thumbnail_path(self.upload_dir, content_hash, 128)))
+
     def test_delete_project(self):
         """Test project deletion functionality."""
         self.test_create_project()  # Ensure a project is created
@@ -111,6 +409,1030 @@ class TestFlaskApi(unittest.TestCase):
         response = self.client.delete(f'/api/delete_project/{project_id}/')
         self.assertEqual(response.status_code, 200)
         self.assertIn('Project deleted successfully', response.json['message'])
-    
+
+
+    def test_upgrade_adds_missing_columns(self):
+        """An older database gains the models' new columns and indexes in place, tables named by reserved words too."""
+        engine = sqlalchemy.create_engine('sqlite://')
+        with engine.begin() as conn:
+            conn.execute(sqlalchemy.text('CREATE TABLE "user" (id INTEGER PRIMARY KEY, username VARCHAR(80) NOT NULL, '
+                                         'password_hash VARCHAR(128))'))
+        changes = migrations.upgrade(engine)
+        self.assertIn('add column user.deleted_at', changes)
+        self.assertIn('deleted_at', {c['name'] for c in sqlalchemy.inspect(engine).get_columns('user')})
+        self.assertEqual(migrations.upgrade(engine), [])
+
+    def upload_pixels(self, project_id, shade, label):
+        body = io.BytesIO()
+        features.PILImage.new('L', (24, 24), shade).save(body, 'PNG')
+        return self.client.post(f'/api/upload_image/{project_id}/', data={
+            'file': (io.BytesIO(body.getvalue()), f'{shade}.png'), 'label': label
+        }, content_type='multipart/form-data').json['image_id']
+
+    @unittest.skipIf(training.np is None or features.PILImage is None, 'NumPy and Pillow are not installed')
+    def test_training_uses_config_and_feeds_inference(self):
+        """The NumPy backend trains on the project's labeled images with its TrainingConfig, reproducibly."""
+        self.app.config['MODEL_FOLDER'] = os.path.join(self.upload_dir, 'models')
+        self.app.config['DECODED_CACHE_FOLDER'] = os.path.join(self.upload_dir, 'cache')
+        self.test_create_project()
+        for shade in (0, 20, 40, 60):
+            self.upload_pixels(1, shade, 'dark')
+        for shade in (190, 220, 250):
+            self.upload_pixels(1, shade, 'light')
+        self.client.post('/api/configure_training/1/', json={'learning_rate': 0.5, 'epochs': 20, 'batch_size': 2})
+        results = []
+        for _ in range(2):
+            self.client.post('/api/enqueue_training/1/')
+            task_manager.run_pending('training')
+            results.append(TrainingResult.query.order_by(TrainingResult.id.desc()).first())
+        self.assertEqual(results[0].accuracy, 1.0)
+        self.assertEqual(results[0].loss, results[1].loss)
+        self.assertTrue(os.path.exists(results[1].model_path))
+
+        self.client.post('/api/configure_training/1/', json={'learning_rate': 0.0, 'epochs': 1, 'batch_size': 7})
+        self.assertAlmostEqual(training.train_project(1)['loss'], math.log(2), places=6)
+
+        image_id = self.upload_pixels(1, 10, '')
+        self.client.post(f'/api/enqueue_inference/1/{image_id}/')
+        task_manager.run_pending('inference')
+        self.assertEqual(self.client.get(f'/api/inference_results/{image_id}/').json['prediction'], 'dark')
+
+        self.app.config['INFERENCE_PROCESSES'] = 1  # Scored on the process pool; results are still written here
+        self.addCleanup(inference_pool._pool.shutdown)  # Its resident models are keyed by this database's ids
+        image_id = self.upload_pixels(1, 240, '')
+        self.client.post(f'/api/enqueue_inference/1/{image_id}/')
+        task_manager.run_pending('inference')
+        self.assertEqual(self.client.get(f'/api/inference_results/{image_id}/').json['prediction'], 'light')
+
+    @unittest.skipIf(training.np is None or features.PILImage is None, 'NumPy and Pillow are not installed')
+    def test_training_progress_long_poll_and_events(self):
+        """Each epoch is recorded; progress is served by long-poll from a cursor or as Server-Sent Events."""
+        self.app.config['MODEL_FOLDER'] = os.path.join(self.upload_dir, 'models')
+        self.test_create_project()
+        self.upload_pixels(1, 0, 'dark')
+        self.upload_pixels(1, 255, 'light')
+        self.client.post('/api/configure_training/1/', json={'learning_rate': 0.1, 'epochs': 3, 'batch_size': 1})
+        job_id = self.client.post('/api/enqueue_training/1/').json['job_id']
+        self.app.config['PROGRESS_POLL_INTERVAL'] = 0.01
+        queued = self.client.get(f'/api/jobs/{job_id}/progress/?timeout=0.05').json
+        self.assertEqual((queued['status'], queued['epoch'], queued['metrics']), ('queued', 0, []))
+
+        task_manager.run_pending('training')
+        progress = self.client.get(f'/api/jobs/{job_id}/progress/').json
+        self.assertEqual((progress['status'], progress['epoch'], progress['epochs']), ('done', 3, 3))
+        self.assertEqual([m['epoch'] for m in progress['metrics']], [1, 2, 3])
+        self.assertEqual(progress['metrics'][0]['images'], 2)
+        self.assertGreater(progress['images_per_sec'], 0)
+        self.assertIsNone(progress['eta_seconds'])
+        later = self.client.get(f"/api/jobs/{job_id}/progress/?after={progress['next_cursor']}").json
+        self.assertEqual((later['metrics'], later['epoch']), ([], 3))
+
+        response = self.client.get(f'/api/jobs/{job_id}/progress/', headers={
+            'Accept': 'text/event-stream', 'Last-Event-ID': str(progress['next_cursor'] - 2)})
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        lines = response.get_data(as_text=True).split('\n')
+        self.assertEqual(lines[:2], [f"id: {progress['next_cursor']}", 'event: done'])
+        self.assertEqual([m['epoch'] for m in json.loads(lines[2][len('data: '):])['metrics']], [2, 3])
+        self.assertEqual(self.client.get('/api/jobs/999/progress/').status_code, 404)
+
+    @unittest.skipIf(training.np is None or features.PILImage is None, 'NumPy and Pillow are not installed')
+    def test_incremental_training(self):
+        """With unchanged settings only new and relabeled images are trained on, from the latest model."""
+        self.app.config['MODEL_FOLDER'] = os.path.join(self.upload_dir, 'models')
+        self.test_create_project()
+        for shade in (0, 30, 60):
+            self.upload_pixels(1, shade, 'dark')
+        for shade in (200, 230):
+            self.upload_pixels(1, shade, 'light')
+        self.client.post('/api/configure_training/1/', json={'learning_rate': 0.5, 'epochs': 4, 'batch_size': 2})
+
+        def train(**body):
+            job_id = self.client.post('/api/enqueue_training/1/', json=body or None).json['job_id']
+            task_manager.run_pending('training')
+            metrics = self.client.get(f'/api/jobs/{job_id}/progress/').json['metrics']
+            return TrainingResult.query.order_by(TrainingResult.id.desc()).first(), [m['images'] for m in metrics]
+
+        full, images = train()
+        self.assertEqual((full.base_id, full.images, full.last_image_id, images), (None, 5, 5, [5] * 4))
+        self.upload_pixels(1, 128, 'grey')
+        tuned, images = train()
+        self.assertEqual((tuned.base_id, tuned.images, tuned.last_image_id, images), (full.id, 1, 6, [1] * 4))
+        self.assertEqual(training.load_classifier(tuned.model_path).classes, ['dark', 'light', 'grey'])
+        self.client.post('/api/enqueue_inference/1/1/')
+        task_manager.run_pending('inference')
+        unchanged, images = train()
+        self.assertEqual((unchanged.base_id, unchanged.images, unchanged.model_path, images),
+                         (tuned.id, 0, tuned.model_path, []))
+        # The kept model keeps its version, and with it the inference results cached for it
+        self.assertEqual(task_manager.model_version(1), tuned.id)
+        self.assertEqual(self.client.post('/api/enqueue_inference/1/1/').json['cached'], True)
+
+        self.assertEqual(self.client.put('/api/image/1/label/', json={'label': 'light'}).json,
+                         {'image_id': 1, 'label': 'light'})
+        self.assertEqual(self.client.put('/api/image/1/label/', json={}).status_code, 400)
+        self.assertEqual(self.client.put('/api/image/99/label/', json={'label': 'x'}).status_code, 404)
+        relabeled, images = train()
+        self.assertEqual((relabeled.base_id, relabeled.images, images), (unchanged.id, 1, [1] * 4))
+
+        forced, _ = train(full=True)
+        self.assertEqual((forced.base_id, forced.images), (None, 6))
+        self.client.post('/api/configure_training/1/', json={'learning_rate': 0.5, 'epochs': 2, 'batch_size': 2})
+        self.upload_pixels(1, 100, 'grey')
+        reconfigured, images = train()
+        self.assertEqual((reconfigured.base_id, reconfigured.images, images), (None, 7, [7] * 2))
+        self.assertEqual([(r['images'], r['incremental']) for r in self.client.get('/api/training_results/1/').json],
+                         [(5, False), (1, True), (0, True), (1, True), (6, False), (7, False)])
+
+    def test_training_backend_registry(self):
+        """Backends register by name; an unknown TRAINING_BACKEND fails the job."""
+        self.test_create_project()
+        self.assertIn('numpy', training.BACKENDS)
+        self.app.config['TRAINING_BACKEND'] = 'missing'
+        job_id = self.client.post('/api/enqueue_training/1/').json['job_id']
+        self.app.config['JOB_MAX_ATTEMPTS'] = 1
+        task_manager.run_pending('training')
+        self.assertIn('missing', self.client.get(f'/api/jobs/{job_id}/').json['error'])
+
+        @training.register_backend('constant')
+        class ConstantBackend(training.TrainingBackend):
+            def fit(self, loader, num_classes, settings, on_epoch=None):
+                return None, {'loss': 0.0, 'accuracy': None}
+        self.addCleanup(training.BACKENDS.pop, 'constant')
+        self.app.config['TRAINING_BACKEND'] = 'constant'
+        self.client.post('/api/enqueue_training/1/')
+        task_manager.run_pending('training')
+        self.assertEqual(TrainingResult.query.one().loss, 0.0)
+
+    def test_deletes_are_tombstoned_then_reaped(self):
+        """Deletes only hide rows; the reaper removes them with their results, jobs and unreferenced files."""
+        self.test_create_project()
+        self.client.post('/api/create_project/', json={'username': 'testuser', 'project_type': 'x', 'name': 'Two'})
+        hashes = [self.client.post(f'/api/upload_image/{project_id}/', data={
+            'file': (io.BytesIO(body), 'a.png')
+        }, content_type='multipart/form-data').json['content_hash']
+            for project_id, body in ((1, b"only in one"), (1, b"shared"), (2, b"shared"))]
+        self.client.post('/api/enqueue_training/1/')
+        task_manager.run_pending('training')
+        self.client.post('/api/enqueue_inference/1/1/')
+        task_manager.run_pending('inference')
+        queued = self.client.post('/api/enqueue_training/1/').json['job_id']
+
+        with count_queries() as statements:
+            response = self.client.delete('/api/delete_project/1/')
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(len(statements), 8)
+        self.assertEqual(self.client.get('/api/project/1/').status_code, 404)
+        self.assertEqual(self.client.get('/api/image/1/').status_code, 404)
+        self.assertEqual(self.client.get(f'/api/jobs/{queued}/').json['status'], 'failed')
+        self.assertEqual(len(self.client.get('/api/user/testuser/').json['projects']), 1)
+        self.assertTrue(os.path.exists(storage.blob_path(self.upload_dir, hashes[0])))
+
+        self.assertEqual(reaper.reap_all(self.upload_dir), {'images': 2, 'projects': 1, 'users': 0, 'files': 1})
+        self.assertFalse(os.path.exists(storage.blob_path(self.upload_dir, hashes[0])))
+        self.assertTrue(os.path.exists(storage.blob_path(self.upload_dir, hashes[1])))
+        remaining = {model.__name__: model.query.execution_options(include_deleted=True).count()
+                     for model in (Project, Image, TrainingResult, InferenceResult, Job)}
+        self.assertEqual(remaining, {'Project': 1, 'Image': 1, 'TrainingResult': 0, 'InferenceResult': 0, 'Job': 1})
+
+        self.client.delete('/api/delete_user/testuser/')
+        self.assertEqual(self.client.post('/api/register/', json={
+            'username': 'testuser', 'password': 'testpassword'}).status_code, 201)
+        self.assertEqual(reaper.reap_all(self.upload_dir), {'images': 1, 'projects': 1, 'users': 1, 'files': 1})
+        self.assertEqual(User.query.execution_options(include_deleted=True).count(), 1)
+
+    def test_reaper_keeps_blobs_reused_meanwhile(self):
+        """A blob an upload starts referencing while the reaper removes it is put back, not unlinked."""
+        self.test_upload_image()
+        content_hash = Image.query.one().content_hash
+        self.client.delete('/api/delete_image/testuser/1/1/')
+
+        def late_upload(seconds):  # Found the blob before it was set aside, commits its row only now
+            self.assertFalse(storage.blob_exists(self.upload_dir, content_hash))
+            db.session.add(Image(filename='again.png', content_hash=content_hash, project_id=1))
+            db.session.commit()
+        with mock.patch.object(reaper.time, 'sleep', side_effect=late_upload):
+            self.assertEqual(reaper.reap_all(self.upload_dir)['files'], 0)
+        self.assertTrue(storage.blob_exists(self.upload_dir, content_hash))
+
+        storage.set_aside_blob(self.upload_dir, content_hash)  # Left behind by a reaper that died
+        self.assertEqual(reaper.sweep_orphaned_blobs(self.upload_dir, grace_seconds=-1), 0)
+        self.assertTrue(storage.blob_exists(self.upload_dir, content_hash))
+
+    def test_reaper_waits_for_running_jobs(self):
+        """A project with a job in flight is reaped only after the job finishes."""
+        self.test_upload_image()
+        self.client.post('/api/enqueue_training/1/')
+        job = job_queue.claim('training', 'worker')
+        self.client.delete('/api/delete_project/1/')
+        self.assertEqual(reaper.reap_all(self.upload_dir)['projects'], 0)
+        task_manager.run_jobs([job])
+        self.assertEqual(reaper.reap_all(self.upload_dir), {'images': 1, 'projects': 1, 'users': 0, 'files': 1})
+
+
+class QueueTestConfig(TestConfig):
+    TASK_QUEUE_MAXSIZE = 1
+
+
+class TestWorkerPool(unittest.TestCase):
+
+    def setUp(self):
+        """Use a file database so worker threads get their own connections."""
+        self.db_dir = tempfile.mkdtemp()
+
+        class Config(QueueTestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(self.db_dir, 'jobs.db')
+            JOB_POLL_INTERVAL = 0.05
+
+        self.app = create_app(Config)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+        self.pool = self.app.extensions['worker_pool']
+        db.create_all()
+
+    def tearDown(self):
+        self.pool.shutdown()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.db_dir)
+
+    def test_enqueue_training_backpressure(self):
+        """A full training backlog rejects new jobs with 429."""
+        self.assertEqual(self.client.post('/api/enqueue_training/1/').status_code, 202)
+        response = self.client.post('/api/enqueue_training/2/')  # Another request for project 1 would coalesce
+        self.assertEqual(response.status_code, 429)
+
+    def test_training_worker_drains_shared_queue(self):
+        """Jobs enqueued through the API are processed by the pool's workers."""
+        self.app.config['TRAINING_WORKERS'] = 1
+        self.app.config['INFERENCE_WORKERS'] = 0
+        self.pool.start()
+        job_id = self.client.post('/api/enqueue_training/1/').json['job_id']
+        deadline = time.time() + 5
+        while self.client.get(f'/api/jobs/{job_id}/').json['status'] != 'done' and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.client.get(f'/api/jobs/{job_id}/').json['status'], 'done')
+        self.assertEqual(TrainingResult.query.filter_by(project_id=1).count(), 1)
+
+    def test_group_commit_writer(self):
+        """Results from concurrent workers are committed through the group-commit writer on a WAL database."""
+        self.assertEqual(db.session.execute(db.text('PRAGMA journal_mode')).scalar(), 'wal')
+        self.app.config.update(TASK_QUEUE_MAXSIZE=0, TRAINING_WORKERS=0, INFERENCE_WORKERS=3)
+        self.app.extensions['group_commit'] = group_commit.GroupCommitWriter(self.app)
+        db.session.add_all([Image(filename=f'{i}.png', project_id=1) for i in range(20)])
+        db.session.commit()
+        self.pool.start()
+        for image_id in range(1, 21):
+            self.client.post(f'/api/enqueue_inference/1/{image_id}/')
+        deadline = time.time() + 5
+        while Job.query.filter_by(status='done').count() < 20 and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(Job.query.filter_by(status='done').count(), 20)
+        self.assertEqual(InferenceResult.query.count(), 20)
+
+
+class TestApiClient(unittest.TestCase):
+    """api_client against a live server on a file database, with workers draining the queue."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+        class Config(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(self.tmp_dir, 'client.db')
+            UPLOAD_FOLDER = os.path.join(self.tmp_dir, 'uploads')
+            JOB_POLL_INTERVAL = 0.05
+            TRAINING_WORKERS = 1
+            INFERENCE_WORKERS = 1
+
+        self.app = create_app(Config)
+        with self.app.app_context():
+            db.create_all()
+        self.app.extensions['worker_pool'].start()
+        self.server = make_server('127.0.0.1', 0, self.app, threaded=True)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.api = api_client.Client(f'http://127.0.0.1:{self.server.server_port}/api', backoff=0.01)
+
+    def tearDown(self):
+        self.api.close()
+        self.server.shutdown()
+        self.app.extensions['worker_pool'].shutdown()
+        with self.app.app_context():
+            db.session.remove()
+            db.drop_all()
+        shutil.rmtree(self.tmp_dir)
+
+    def write_files(self, count):
+        paths = []
+        for i in range(count):
+            paths.append(os.path.join(self.tmp_dir, f'{i}.png'))
+            with open(paths[-1], 'wb') as f:
+                f.write(b'image %d' % (i % 3))
+        return paths
+
+    def test_sync_client_end_to_end(self):
+        """Bulk uploads dedupe and keep input order; jobs are polled to completion."""
+        self.api.register_user('alice', 'secret')
+        project_id = self.api.create_project('alice', 'Image Classification', 'Cats')['project_id']
+        paths = self.write_files(6)
+        results = self.api.upload_images(project_id, [(path, 'cat') for path in paths], concurrency=3)
+        self.assertEqual([r['filename'] for r in results], [os.path.basename(p) for p in paths])
+        self.assertEqual(sum(not r['deduplicated'] for r in results), 3)
+        image_ids = [image['image_id'] for image in self.api.project_images(project_id, fields=['image_id'])]
+        self.assertEqual(sorted(image_ids), sorted(r['image_id'] for r in results))
+
+        job = self.api.wait_for_job(self.api.enqueue_training(project_id)['job_id'], timeout=10)
+        self.assertEqual(job['status'], 'done')
+        predictions = self.api.infer_images(project_id, image_ids + [999], chunk_size=4, timeout=10)
+        self.assertEqual(set(predictions), set(image_ids))
+        with self.assertRaises(api_client.ApiError) as error:
+            self.api.get_project(999)
+        self.assertEqual(error.exception.status, 404)
+        self.api.delete_project(project_id)
+        self.assertEqual(list(self.api.user_projects('alice')), [])
+
+    def test_retries_backpressure_with_backoff(self):
+        """429 responses are retried with backoff before the error is raised."""
+        self.app.extensions['worker_pool'].shutdown()
+        self.app.config['TASK_QUEUE_MAXSIZE'] = 1
+        self.api.enqueue_training(1)
+        with mock.patch.object(api_client.time, 'sleep') as sleep:
+            with self.assertRaises(api_client.ApiError) as error:
+                self.api.enqueue_training(2)
+        self.assertEqual(error.exception.status, 429)
+        self.assertEqual(sleep.call_count, self.api.retries)
+
+    def test_dedupe_falls_back_to_uploading_bytes(self):
+        """A blob reaped between the dedupe check and the upload is sent after all."""
+        self.api.register_user('dave', 'secret')
+        project_id = self.api.create_project('dave', 'Image Classification')['project_id']
+        path = self.write_files(1)[0]
+        with mock.patch.object(self.api, 'get', return_value={}):  # The check claims the server holds the bytes
+            result = self.api.upload_image(project_id, path, 'cat')
+        self.assertEqual((result['content_hash'], result['deduplicated']), (api_client.hash_file(path), False))
+
+    @unittest.skipIf(training.np is None or features.PILImage is None, 'NumPy and Pillow are not installed')
+    def test_menu_follows_training_progress(self):
+        """The menu's training option prints every epoch as it finishes, then returns the finished job."""
+        self.app.config['MODEL_FOLDER'] = os.path.join(self.tmp_dir, 'models')
+        self.api.register_user('carol', 'secret')
+        project_id = self.api.create_project('carol', 'Image Classification')['project_id']
+        for shade, label in ((0, 'dark'), (250, 'light')):
+            path = os.path.join(self.tmp_dir, f'{shade}.png')
+            features.PILImage.new('L', (24, 24), shade).save(path)
+            self.api.upload_image(project_id, path, label)
+        self.api.configure_training(project_id, 0.5, 2, 2)
+        answers = iter([str(project_id), 'n', 'y'])
+        with mock.patch('builtins.input', lambda prompt: next(answers)), mock.patch('builtins.print') as output:
+            job = client.enqueue_training(self.api)
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual([call.args[0].split(':')[0] for call in output.call_args_list], ['Epoch 1/2', 'Epoch 2/2'])
+
+    def test_async_client(self):
+        """The asyncio client runs bounded concurrent uploads and polls jobs without blocking the loop."""
+        async def scenario(api):
+            await api.register_user('bob', 'secret')
+            project = await api.create_project('bob', 'Image Classification')
+            results = await api.upload_images(project['project_id'], self.write_files(4) + ['missing.png'],
+                                              concurrency=2, return_exceptions=True)
+            job = await api.enqueue_training(project['project_id'])
+            return results, await api.wait_for_job(job['job_id'], timeout=10), await api.project_images(
+                project['project_id'])
+
+        async def main():
+            async with api_client.AsyncClient(self.api.base_url, concurrency=4) as api:
+                return await scenario(api)
+
+        results, job, images = asyncio.run(main())
+        self.assertEqual(len(results), 5)
+        self.assertIsInstance(results[-1], FileNotFoundError)
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(len(images), 4)
+
+
+class TestJobQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_job_status_polling(self):
+        """Enqueueing returns a job id whose status follows the job to completion."""
+        response = self.client.post('/api/enqueue_training/1/')
+        self.assertEqual(response.status_code, 202)
+        job_id = response.json['job_id']
+        self.assertEqual(self.client.get(f'/api/jobs/{job_id}/').json['status'], 'queued')
+        self.assertEqual(task_manager.run_pending('training'), 1)
+        response = self.client.get(f'/api/jobs/{job_id}/')
+        self.assertEqual(response.json['status'], 'done')
+        self.assertEqual(response.json['attempts'], 1)
+        self.assertEqual(self.client.get('/api/jobs/999/').status_code, 404)
+
+    def test_claim_is_exclusive(self):
+        """A claimed job is not handed to a second worker until its lease expires."""
+        job = job_queue.enqueue('training', 1)
+        claimed = job_queue.claim('training', 'worker-a')
+        self.assertEqual(claimed.id, job.id)
+        self.assertIsNone(job_queue.claim('training', 'worker-b'))
+        claimed.lease_expires_at = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+        stale = namedtuple('Claim', 'id lease_token')(claimed.id, claimed.lease_token)
+        reclaimed = job_queue.claim('training', 'worker-b')
+        self.assertEqual((reclaimed.id, reclaimed.worker_id, reclaimed.attempts), (job.id, 'worker-b', 2))
+        job_queue.fail(stale, RuntimeError('lease lost'))  # The first worker gives up late
+        job = db.session.get(Job, job.id)
+        self.assertEqual((job.status, job.worker_id, job.error), ('running', 'worker-b', None))
+
+        # A job whose lease expires on its last attempt, likely by killing its worker, is failed, not rerun
+        self.app.config['JOB_MAX_ATTEMPTS'] = 2
+        job.lease_expires_at = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+        self.assertIsNone(job_queue.claim('training', 'worker-c'))
+        self.assertEqual(job_queue.claim_many('training', 'worker-c', 1, 1), [])
+        self.assertEqual(job_queue.fail_abandoned(), 1)
+        self.assertEqual(self.client.get(f'/api/jobs/{job.id}/').json['status'], 'failed')
+
+    def test_claim_batch_claims_together(self):
+        """Inference jobs of a project are claimed together; claimed jobs past the batch go back to the queue."""
+        self.app.config['INFERENCE_BATCH_SIZE'] = 4
+        small = job_queue.enqueue('inference', 1, {'image_ids': [1]}).id
+        large = [job_queue.enqueue('inference', 1, {'image_ids': [1, 2, 3]}).id for _ in range(3)]
+        jobs = task_manager.claim_batch('inference', 'w')
+        self.assertEqual([job.id for job in jobs], [small, large[0]])
+        self.assertEqual(jobs[1].status, 'running')
+        released = Job.query.filter(Job.id.in_(large[1:])).all()
+        self.assertEqual({(job.status, job.attempts, job.lease_token) for job in released}, {('queued', 0, None)})
+        self.assertEqual(task_manager.run_pending('inference'), 2)
+
+    def test_failed_job_is_retried(self):
+        """A job that raises is requeued until it runs out of attempts."""
+        self.app.config['JOB_MAX_ATTEMPTS'] = 2
+        job = job_queue.enqueue('training', 1)
+        with mock.patch.dict(task_manager.HANDLERS, {'training': mock.Mock(side_effect=RuntimeError('boom'))}):
+            task_manager.run_pending('training')
+        job = db.session.get(Job, job.id)
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.attempts, 2)
+        self.assertEqual(job.error, 'boom')
+
+    def test_enqueue_inference_batch(self):
+        """Batch inference is split into jobs that a worker coalesces into one model call."""
+        user = User(username='batchuser')
+        db.session.add(user)
+        db.session.flush()
+        project = Project(user_id=user.id, project_type='Image Classification', name='Batch')
+        db.session.add(project)
+        db.session.flush()
+        db.session.add_all([Image(filename=f'{i}.png', project_id=project.id) for i in range(3)])
+        db.session.commit()
+        self.app.config['INFERENCE_BATCH_SIZE'] = 2
+        with mock.patch.dict(self.app.config, TASK_QUEUE_MAXSIZE=1):  # Two jobs never fit, however long one waits
+            response = self.client.post(f'/api/enqueue_inference_batch/{project.id}/', json={'all': True})
+        self.assertEqual((response.status_code, response.json['max_images']), (413, 2))
+
+        response = self.client.post(f'/api/enqueue_inference_batch/{project.id}/', json={'image_ids': [1, 2, 3, 999]})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(len(response.json['job_ids']), 2)
+        self.assertEqual(response.json['skipped_image_ids'], [999])
+        with mock.patch.object(task_manager, 'load_model', wraps=task_manager.load_model) as load_model:
+            self.app.config['INFERENCE_BATCH_SIZE'] = 10
+            task_manager.run_pending('inference')
+        self.assertEqual(load_model.call_count, 1)
+        self.assertEqual(InferenceResult.query.count(), 3)
+
+        response = self.client.post(f'/api/enqueue_inference_batch/{project.id}/', json={'all': True})
+        self.assertEqual(response.json['num_images'], 3)
+        self.assertEqual(self.client.post(f'/api/enqueue_inference_batch/{project.id}/', json={}).status_code, 400)
+
+    def test_inference_results_are_cached_by_content_and_model(self):
+        """Content the current model has scored is answered without a job, for any image holding it."""
+        project_id, = self.make_projects('alice')
+        db.session.add_all([Image(filename=f'{i}.png', content_hash=content_hash, project_id=project_id)
+                            for i, content_hash in enumerate(['a' * 64, 'a' * 64, 'b' * 64])])
+        db.session.commit()
+        self.assertEqual(self.client.post(f'/api/enqueue_inference/{project_id}/1/').status_code, 202)
+        task_manager.run_pending('inference')
+        for image_id in (1, 2):
+            response = self.client.post(f'/api/enqueue_inference/{project_id}/{image_id}/')
+            self.assertEqual((response.status_code, response.json['job_id'], response.json['prediction']),
+                             (200, None, 'Example Result'))
+        self.assertEqual(self.client.get('/api/inference_results/2/').json['current'], True)
+        response = self.client.post(f'/api/enqueue_inference_batch/{project_id}/', json={'all': True})
+        self.assertEqual((response.status_code, len(response.json['job_ids']), response.json['cached_image_ids']),
+                         (202, 1, [1, 2]))
+        task_manager.run_pending('inference')
+        response = self.client.post(f'/api/enqueue_inference_batch/{project_id}/', json={'all': True})
+        self.assertEqual((response.status_code, response.json['job_ids']), (200, []))
+
+        db.session.add(TrainingResult(project_id=project_id, accuracy=None, loss=None))
+        db.session.commit()
+        cache.invalidate(f'training:{project_id}')
+        version = task_manager.model_version(project_id)
+        stale = self.client.get('/api/inference_results/1/').json
+        self.assertEqual((stale['prediction'], stale['model_version'], stale['current']), ('Example Result', None, False))
+        self.client.post(f'/api/enqueue_inference_batch/{project_id}/', json={'all': True})
+        with mock.patch.object(task_manager.PlaceholderModel, 'predict', autospec=True,
+                               side_effect=lambda model, images: ['new'] * len(images)) as predict:
+            task_manager.run_pending('inference')
+        self.assertEqual(sorted(image.id for image in predict.call_args.args[1]), [1, 3])  # One image per blob
+        for image_id in (1, 2, 3):
+            result = self.client.get(f'/api/inference_results/{image_id}/').json
+            self.assertEqual((result['prediction'], result['model_version'], result['current']), ('new', version, True))
+
+        # A cached response goes stale when another image with the same content is scored
+        db.session.add_all([TrainingResult(project_id=project_id, accuracy=None, loss=None),
+                            Image(filename='4.png', content_hash='a' * 64, project_id=project_id)])
+        db.session.commit()
+        cache.invalidate(f'training:{project_id}')
+        self.assertEqual(self.client.get('/api/inference_results/1/').json['current'], False)
+        self.assertEqual(self.client.post(f'/api/enqueue_inference/{project_id}/4/').status_code, 202)
+        with mock.patch.object(task_manager.PlaceholderModel, 'predict', autospec=True,
+                               side_effect=lambda model, images: ['newer'] * len(images)):
+            task_manager.run_pending('inference')
+        result = self.client.get('/api/inference_results/1/').json
+        self.assertEqual((result['prediction'], result['current']), ('newer', True))
+
+    def make_projects(self, *usernames):
+        project_ids = []
+        for username in usernames:
+            user = User.query.filter_by(username=username).first() or User(username=username)
+            project = Project(user=user, project_type='Image Classification')
+            db.session.add(project)
+            db.session.commit()
+            project_ids.append(project.id)
+        return project_ids
+
+    def test_scheduler_priorities_and_fairness(self):
+        """Interactive jobs go first, then users take turns, whoever enqueued the most."""
+        a, b = self.make_projects('alice', 'bob')
+        bulk = job_queue.enqueue_many('inference', a, [{'image_ids': [i]} for i in range(3)], priority='batch')
+        other = job_queue.enqueue('inference', b, {'image_ids': [9]}, priority='batch')
+        urgent = job_queue.enqueue('inference', b, {'image_ids': [10]})
+        order = [job_queue.claim('inference', 'w').id for _ in range(5)]
+        self.assertEqual(order, [urgent.id, bulk[0].id, other.id, bulk[1].id, bulk[2].id])
+        self.assertEqual(self.client.get(f'/api/jobs/{urgent.id}/').json['priority'], 'interactive')
+
+        # A user enqueuing while their backlog drains never overtakes their own older jobs
+        self.app.config['JOB_CONCURRENCY_LIMITS'] = {}
+        first = job_queue.enqueue_many('inference', a, [{'image_ids': [i]} for i in range(3)], priority='batch')
+        self.assertEqual([job_queue.claim('inference', 'w').id for _ in range(2)], [first[0].id, first[1].id])
+        later = [job_queue.enqueue('inference', a, {'image_ids': [i]}, priority='batch') for i in range(2)]
+        self.assertEqual([job_queue.claim('inference', 'w').id for _ in range(3)],
+                         [first[2].id, later[0].id, later[1].id])
+
+    def test_scheduler_concurrency_limits(self):
+        """Jobs over a user's or project's running cap wait while other users' jobs are claimed."""
+        self.app.config['JOB_CONCURRENCY_LIMITS'] = {'training': {'user': 2, 'project': 1}}
+        a1, a2, a3, b = self.make_projects('alice', 'alice', 'alice', 'bob')
+        jobs = {project_id: job_queue.enqueue_many('training', project_id, [None, None])
+                for project_id in (a1, a2, a3, b)}
+        claimed = [job_queue.claim('training', 'w') for _ in range(3)]
+        self.assertEqual([job.project_id for job in claimed], [a1, b, a2])
+        self.assertIsNone(job_queue.claim('training', 'w'))
+        job_queue.complete([claimed[0].lease_token])
+        db.session.commit()
+        self.assertEqual(job_queue.claim('training', 'w').id, jobs[a1][1].id)
+        # Filling a micro-batch for a project the worker holds is not a new claim
+        self.assertEqual(job_queue.claim('training', 'w', project_id=b).id, jobs[b][1].id)
+
+    def test_duplicate_jobs_are_coalesced(self):
+        """Repeated requests while a job is queued reuse it; training runs with the latest config."""
+        project_id, = self.make_projects('alice')
+        first = self.client.post(f'/api/enqueue_training/{project_id}/').json
+        self.client.post(f'/api/configure_training/{project_id}/', json={'learning_rate': 0.1, 'epochs': 3,
+                                                                         'batch_size': 8})
+        second = self.client.post(f'/api/enqueue_training/{project_id}/').json
+        self.assertEqual((first['coalesced'], second['coalesced']), (False, True))
+        self.assertEqual(first['job_id'], second['job_id'])
+        self.assertEqual(db.session.get(Job, first['job_id']).payload['config']['epochs'], 3)
+        self.client.post(f'/api/enqueue_training/{project_id}/', json={'full': True})
+        self.client.post(f'/api/enqueue_training/{project_id}/')  # An incremental request doesn't undo the retrain
+        self.assertTrue(db.session.get(Job, first['job_id']).payload['full'])
+        self.assertEqual(Job.query.filter_by(kind='training').count(), 1)
+
+        image = Image(filename='a.png', project_id=project_id)
+        db.session.add(image)
+        db.session.commit()
+        jobs = {self.client.post(f'/api/enqueue_inference/{project_id}/{image.id}/').json['job_id'] for _ in range(3)}
+        self.assertEqual(len(jobs), 1)
+        task_manager.run_pending('inference')
+        self.assertNotIn(self.client.post(f'/api/enqueue_inference/{project_id}/{image.id}/').json['job_id'], jobs)
+
+    def test_queue_stats(self):
+        """Depth and wait times are reported per priority class."""
+        project_id, = self.make_projects('alice')
+        job_queue.enqueue_many('inference', project_id, [{'image_ids': [1]}, {'image_ids': [2]}], priority='batch')
+        job = job_queue.enqueue('training', project_id)
+        job.created_at = datetime.utcnow() - timedelta(seconds=10)
+        db.session.commit()
+        job_queue.claim('training', 'w')
+        response = self.client.get('/api/jobs/stats/')
+        self.assertEqual(response.status_code, 200)
+        classes = response.json['classes']
+        self.assertEqual((classes['batch']['queued'], classes['batch']['running']), (2, 0))
+        self.assertIsNotNone(classes['batch']['oldest_wait_seconds'])
+        self.assertEqual((classes['training']['running'], classes['training']['started']), (1, 1))
+        self.assertGreaterEqual(classes['training']['mean_wait_seconds'], 9)
+        self.assertEqual(classes['interactive']['queued'], 0)
+
+    def test_model_cache_follows_latest_training_result(self):
+        """Inference reuses the cached model until training produces a new result."""
+        cache = task_manager.get_model_cache()
+        first = task_manager.get_model(1)
+        self.assertIs(task_manager.get_model(1), first)
+        job_queue.enqueue('training', 1)
+        task_manager.run_pending('training')
+        self.assertIsNot(task_manager.get_model(1), first)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 2)
+        self.assertEqual(cache.stats()['models'], 1)
+
+
+class TestModelCache(unittest.TestCase):
+
+    def test_lru_eviction_within_budget(self):
+        """Least recently used models are evicted once the byte budget is exceeded."""
+        cache = task_manager.ModelCache(max_bytes=250)
+        loader = lambda project_id, version: mock.Mock(nbytes=100)
+        cache.get(1, None, loader)
+        cache.get(2, None, loader)
+        cache.get(1, None, loader)
+        cache.get(3, None, loader)
+        self.assertEqual(list(cache.models), [(1, None), (3, None)])
+        self.assertEqual(cache.stats(), {'models': 2, 'bytes': 200, 'hits': 1, 'misses': 3, 'evictions': 1})
+
+
+ImageRow = namedtuple('ImageRow', 'id filename content_hash')
+
+
+@unittest.skipIf(dataloader.np is None or features.PILImage is None, 'NumPy and Pillow are not installed')
+class TestDataLoader(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.rows = []
+        for i in range(10):
+            self.add_image(i * 25)
+        with open(os.path.join(self.folder, 'broken.png'), 'wb') as f:
+            f.write(b'not an image')
+        self.rows.insert(3, ImageRow(100, 'broken.png', None))
+
+    def add_image(self, shade):
+        body = io.BytesIO()
+        features.PILImage.new('L', (12, 12), shade).save(body, 'PNG')
+        body.seek(0)
+        content_hash = storage.save_stream(body, self.folder)[0]
+        self.rows.append(ImageRow(len(self.rows) + 1, 'x.png', content_hash))
+
+    def batches(self, loader):
+        return [(pixels.copy(), [row.id for row in rows]) for pixels, _targets, rows in loader]
+
+    def test_process_pool_prefetch_matches_inline_decoding(self):
+        """Batches decoded ahead on the process pool equal inline ones; undecodable files are skipped."""
+        inline = dataloader.BatchLoader(self.folder, self.rows, 4, 4, shuffle=True, seed=1)
+        pooled = dataloader.BatchLoader(self.folder, self.rows, 4, 4, shuffle=True, seed=1, processes=2, prefetch=2)
+        expected = self.batches(inline)
+        self.assertEqual(sum(len(ids) for _, ids in expected), 10)
+        self.assertEqual(inline.skipped, 1)
+        for (want_pixels, want_ids), (pixels, ids) in zip(expected, self.batches(pooled)):
+            self.assertEqual(ids, want_ids)
+            self.assertTrue((pixels == want_pixels).all())
+        self.assertEqual(pooled.skipped, 1)
+
+    def test_decoded_cache_skips_decoding(self):
+        """Later epochs and loaders read the memory-mapped cache; only new images get decoded."""
+        prefix = os.path.join(self.folder, 'cache', '1', 's4')
+        with mock.patch.object(dataloader, 'decode', wraps=dataloader.decode) as decode:
+            loader = dataloader.BatchLoader(self.folder, self.rows, 4, 4, cache_prefix=prefix)
+            first = self.batches(loader)
+            self.assertEqual(decode.call_count, 11)
+            self.assertEqual(self.batches(loader)[0][1], first[0][1])
+            dataloader.BatchLoader(self.folder, self.rows, 4, 4, cache_prefix=prefix)
+            self.batches(dataloader.BatchLoader(self.folder, self.rows, 4, 4, cache_prefix=prefix))
+            self.assertEqual(decode.call_count, 11)
+            self.add_image(255)
+            rows = self.rows[1:]
+            batches = self.batches(dataloader.BatchLoader(self.folder, rows, 4, 4, cache_prefix=prefix))
+            self.assertEqual(decode.call_count, 12)
+        self.assertEqual(len(dataloader.np.load(prefix + '-ids.npy')), 11)
+        self.assertTrue((batches[0][0][0] == first[0][0][1]).all())
+
+    def save_model(self, name, num_classes=3):
+        path = os.path.join(self.folder, 'models', name)
+        weights = dataloader.np.random.default_rng(0).standard_normal((16, num_classes)).astype('float32')
+        model = training.SoftmaxModel(weights, dataloader.np.zeros(num_classes, dtype='float32'))
+        training.Classifier(model, 'abcdefgh'[:num_classes], 4, 'numpy').save(path)
+        return path
+
+    def test_inference_pool_scores_like_the_model(self):
+        """Pool processes decode batch slices into one shared buffer and label them with resident models."""
+        path = self.save_model('1.npz')
+        classifier = training.load_classifier(path)
+        pixels = dataloader.np.stack([dataloader.decode(storage.image_path(self.folder, row), 4)
+                                      for row in self.rows if row.id != 100]) / dataloader.np.float32(255)
+        expected = [classifier.classes[i] for i in classifier.model.predict(pixels)]
+        expected.insert(3, None)  # broken.png
+        with mock.patch.object(inference_pool, '_models', OrderedDict()), \
+                mock.patch.object(training, 'load_classifier', wraps=training.load_classifier) as load:
+            self.assertEqual(inference_pool.predict(1, path, self.rows, self.folder, 0, 1 << 20), expected)
+            self.assertEqual(inference_pool.predict(1, path, self.rows[:2], self.folder, 0, 1 << 20), expected[:2])
+            self.assertEqual(load.call_count, 1)
+            small = self.save_model('2.npz', num_classes=2)
+            inference_pool.predict(2, small, self.rows[:1], self.folder, 0, classifier.nbytes)
+            self.assertEqual(list(inference_pool._models), [2])
+        with mock.patch.object(inference_pool, 'MIN_CHUNK', 4):
+            self.assertEqual(inference_pool.predict(1, path, self.rows, self.folder, 2, 1 << 20), expected)
+        self.assertEqual([name for name in os.listdir(dataloader.SHARED_MEMORY_DIR or tempfile.gettempdir())
+                          if name.startswith('inference-')], [])
+
+    def test_broken_process_pool_is_replaced(self):
+        """A pool process that dies fails the work in flight, not every call after it."""
+        pool = process_pool.ProcessPool()
+        self.addCleanup(pool.shutdown)
+        self.assertEqual(pool.map(1, abs, [-1, -2]), [1, 2])
+        with self.assertRaises(BrokenProcessPool):
+            pool.submit(1, os._exit, 1).result()
+        self.assertEqual(pool.submit(1, abs, -3).result(), 3)
+        self.assertEqual(pool.map(1, abs, [-4]), [4])
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+        class Config(TestConfig):
+            UPLOAD_FOLDER = os.path.join(self.tmp_dir, 'uploads')
+            PROFILE_FOLDER = os.path.join(self.tmp_dir, 'profiles')
+
+        self.config = Config
+        self.app_context = None
+
+    def tearDown(self):
+        if self.app_context is not None:
+            db.session.remove()
+            db.drop_all()
+            self.app_context.pop()
+        shutil.rmtree(self.tmp_dir)
+
+    def start(self, **settings):
+        self.app = create_app(type('Config', (self.config,), settings))
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+        db.create_all()
+
+    def sample(self, name, **labels):
+        """The value of one sample of the scraped metrics, or None when it isn't exposed."""
+        response = self.client.get('/metrics')
+        self.assertEqual(response.mimetype, 'text/plain')
+        wanted = ','.join(f'{key}="{value}"' for key, value in labels.items())
+        prefix = f'diyml_{name}{{{wanted}}} ' if labels else f'diyml_{name} '
+        for line in response.get_data(as_text=True).splitlines():
+            if line.startswith(prefix):
+                return float(line[len(prefix):])
+        return None
+
+    def test_request_sql_queue_and_upload_metrics(self):
+        self.start()
+        self.client.post('/api/register/', json={'username': 'alice', 'password': 'secret'})
+        self.client.post('/api/create_project/', json={
+            'username': 'alice', 'project_type': 'Image Classification', 'name': 'cats'})
+        self.client.post('/api/upload_image/1/', data={'file': (io.BytesIO(b'x' * 1000), 'a.png')},
+                         content_type='multipart/form-data')
+        self.client.get('/api/user/nobody/')
+        self.client.post('/api/enqueue_inference/1/1/')
+
+        self.assertEqual(self.sample('http_request_duration_seconds_count',
+                                     endpoint='api.get_user', method='GET', status=404), 1)
+        self.assertEqual(self.sample('http_request_duration_seconds_bucket',
+                                     endpoint='api.get_user', method='GET', status=404, le='+Inf'), 1)
+        self.assertGreater(self.sample('http_request_db_queries_sum', endpoint='api.register'), 0)
+        self.assertGreater(self.sample('db_queries_total', source='request'), 0)
+        self.assertEqual(self.sample('upload_bytes_total'), 1000)
+        self.assertEqual(self.sample('upload_bytes_per_second_count'), 1)
+        self.assertEqual(self.sample('job_queue_depth', kind='inference', priority='interactive', status='queued'), 1)
+
+        task_manager.run_pending('inference')
+        self.assertIsNone(self.sample('job_queue_depth', kind='inference', priority='interactive', status='queued'))
+        self.assertEqual(self.sample('job_wait_seconds_count', kind='inference'), 1)
+        self.assertEqual(self.sample('job_run_seconds_count', kind='inference', outcome='done'), 1)
+        self.assertEqual(self.sample('jobs_total', kind='inference', outcome='done'), 1)
+        self.assertGreater(self.sample('db_queries_total', source='worker'), 0)
+
+    def test_histogram_exposition(self):
+        histogram = metrics.Histogram('latency', 'Help "text".', ('route',), buckets=(1, 5))
+        for value in (0.5, 3, 3, 10):
+            histogram.observe(value, route='a"b')
+        self.assertEqual(histogram.render(), [
+            '# HELP latency Help "text".', '# TYPE latency histogram',
+            'latency_bucket{route="a\\"b",le="1"} 1', 'latency_bucket{route="a\\"b",le="5"} 3',
+            'latency_bucket{route="a\\"b",le="+Inf"} 4',
+            'latency_sum{route="a\\"b"} 16.5', 'latency_count{route="a\\"b"} 4',
+        ])
+        with self.assertRaises(ValueError):
+            histogram.observe(1)
+
+    def test_slow_requests_are_profiled(self):
+        """With PROFILE_SLOW_REQUESTS, slow requests leave collapsed stacks; fast ones leave nothing."""
+        self.start(PROFILE_SLOW_REQUESTS=0.5, PROFILE_INTERVAL=0.001)
+        self.client.get('/api/jobs/stats/')
+        self.assertFalse(os.path.exists(self.config.PROFILE_FOLDER))
+
+        def slow_stats():
+            time.sleep(0.6)
+            return {}, 200
+        with mock.patch('services.get_queue_stats', slow_stats):
+            self.client.get('/api/jobs/stats/')
+        [name] = os.listdir(self.config.PROFILE_FOLDER)
+        self.assertIn('api.get_queue_stats', name)
+        with open(os.path.join(self.config.PROFILE_FOLDER, name)) as f:
+            lines = f.read().splitlines()
+        stack, count = lines[0].rsplit(' ', 1)
+        self.assertTrue(stack.endswith('routes:get_queue_stats;test_app:slow_stats'), stack)
+        self.assertGreater(int(count), 10)
+        self.assertEqual(self.sample('slow_request_profiles_total'), 1)
+
+
+@unittest.skipIf(vector_index.np is None or features.PILImage is None, 'NumPy and Pillow are not installed')
+class TestSimilarity(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+        class Config(TestConfig):
+            UPLOAD_FOLDER = os.path.join(self.tmp_dir, 'uploads')
+            INDEX_FOLDER = os.path.join(self.tmp_dir, 'index')
+
+        self.app = create_app(Config)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+        db.create_all()
+        db.session.add(User(username='alice'))
+        db.session.add(Project(user_id=1, project_type='Image Classification', name='shapes'))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.tmp_dir)
+
+    def pattern(self, number, size=32, brightness=0):
+        """PNG bytes of one of a few distinct grayscale patterns."""
+        y, x = vector_index.np.mgrid[0:size, 0:size] / size
+        pixels = [x, y, (x * 4).astype(int) % 2 ^ (y * 4).astype(int) % 2, (x - 0.5) ** 2 + (y - 0.5) ** 2][number]
+        pixels = vector_index.np.clip(pixels * 180 + 20 + brightness, 0, 255).astype(vector_index.np.uint8)
+        body = io.BytesIO()
+        features.PILImage.fromarray(pixels).save(body, 'PNG')
+        return body.getvalue()
+
+    def upload(self, body, name):
+        response = self.client.post('/api/upload_image/1/', data={'file': (io.BytesIO(body), name), 'label': name},
+                                    content_type='multipart/form-data')
+        return response.json['image_id']
+
+    def similar(self, **args):
+        return self.client.get('/api/project/1/similar/', query_string=args)
+
+    def test_similar_images(self):
+        """Neighbors come from the index, from embeddings not indexed yet and from uploaded query files."""
+        ids = [self.upload(self.pattern(i), f'{i}.png') for i in range(4)]
+        self.assertEqual(self.similar(image_id=ids[0]).status_code, 409)  # Features not extracted yet
+        brighter = self.upload(self.pattern(0, size=48, brightness=30), 'copy.png')
+        task_manager.run_pending('features')
+        self.assertEqual(task_manager.run_pending('index'), 1)  # Coalesced into one job for the project
+
+        response = self.similar(image_id=ids[0], k=2)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['index'], {'indexed': 5, 'ivf_lists': 0})
+        [first, second] = response.json['neighbors']
+        self.assertEqual((first['image_id'], first['near_duplicate']), (brighter, True))
+        self.assertGreater(first['score'], 0.98)
+        self.assertFalse(second['near_duplicate'])
+
+        late = self.upload(self.pattern(2), 'late.png')
+        task_manager.run_pending('features')  # Its index job is left queued
+        response = self.client.post('/api/project/1/similar/', data={'file': (io.BytesIO(self.pattern(2)), 'q.png')},
+                                    content_type='multipart/form-data')
+        self.assertEqual({n['image_id'] for n in response.json['neighbors'][:2]}, {ids[2], late})
+        self.assertTrue(response.json['neighbors'][0]['near_duplicate'])
+
+        self.client.delete(f'/api/delete_image/alice/1/{brighter}/')
+        self.assertNotIn(brighter, [n['image_id'] for n in self.similar(image_id=ids[0]).json['neighbors']])
+        self.assertEqual(self.similar().status_code, 400)
+        self.assertEqual(self.similar(image_id=999).status_code, 404)
+        self.assertEqual(self.client.get('/api/project/9/similar/?image_id=1').status_code, 404)
+
+    def add_embeddings(self, count, rng):
+        vectors = rng.standard_normal((count, 16)).astype(vector_index.np.float32)
+        vectors /= vector_index.np.linalg.norm(vectors, axis=1, keepdims=True)
+        db.session.add_all([Image(filename=f'{i}.png', project_id=1, embedding=vector.tobytes(),
+                                  embedded_at=datetime.utcnow()) for i, vector in enumerate(vectors)])
+        db.session.commit()
+        return vectors
+
+    def test_ivf_index_and_delta_segments(self):
+        """An IVF segment probing every list is exact; small additions only rebuild the delta segment."""
+        self.app.config.update(VECTOR_INDEX_IVF_MIN=100, VECTOR_INDEX_LISTS=8, VECTOR_INDEX_DELTA_MIN=20,
+                               VECTOR_INDEX_DELTA_FRACTION=0)
+        rng = vector_index.np.random.default_rng(0)
+        self.add_embeddings(300, rng)
+        self.assertEqual(vector_index.rebuild(1), 'main')
+        self.assertEqual(vector_index.status(1), {'indexed': 300, 'ivf_lists': 8})
+        self.add_embeddings(10, rng)
+        self.assertEqual(vector_index.rebuild(1), 'delta')
+        self.assertEqual(vector_index.status(1), {'indexed': 310, 'ivf_lists': 8})
+
+        rows = db.session.query(Image.id, Image.embedding).order_by(Image.id).all()
+        matrix = vector_index.np.stack([vector_index.np.frombuffer(row.embedding, vector_index.np.float32)
+                                        for row in rows])
+        for query in matrix[[5, 305]]:
+            exact = [rows[i].id for i in vector_index.np.argsort(-(matrix @ query))[:5]]
+            self.assertEqual([i for i, _ in vector_index.search(1, query, 5, nprobe=8)], exact)
+            approximate = vector_index.search(1, query, 5, nprobe=2)
+            self.assertEqual(approximate[0][0], exact[0])
+
+        self.add_embeddings(30, rng)
+        self.assertEqual(vector_index.rebuild(1), 'main')
+        self.assertEqual(sorted(os.listdir(vector_index.project_folder(1))), sorted(
+            [vector_index._names(vector_index.project_folder(1))['main'], 'current.json']))
+
+    def test_late_and_replaced_embeddings(self):
+        """Images embedded after a build are found whatever their ids, and re-embedding replaces the indexed vector."""
+        db.session.add(Image(filename='late.png', project_id=1))  # Id 1, embedded only after the build
+        db.session.commit()
+        rng = vector_index.np.random.default_rng(1)
+        vectors = self.add_embeddings(5, rng)
+        self.assertEqual(vector_index.rebuild(1), 'main')
+        late, moved = db.session.get(Image, 1), db.session.get(Image, 2)
+        late.embedding, late.embedded_at = vectors[4].tobytes(), datetime.utcnow()
+        moved.embedding, moved.embedded_at = (-vectors[0]).tobytes(), datetime.utcnow()
+        db.session.commit()
+
+        for built in (None, 'delta'):
+            if built:
+                self.assertEqual(vector_index.rebuild(1), built)
+                self.assertEqual(vector_index.status(1), {'indexed': 6, 'ivf_lists': 0})
+            found = vector_index.search(1, vectors[4], 6)
+            self.assertEqual(sorted(i for i, _ in found[:2]), [1, 6])  # Image 1 now shares image 6's vector
+            self.assertEqual(len(found), len({i for i, _ in found}))
+            self.assertNotIn(2, [i for i, _ in vector_index.search(1, vectors[0], 1)])
+            self.assertAlmostEqual(dict(vector_index.search(1, -vectors[0], 1))[2], 1, places=5)
+
+    def test_duplicate_groups(self):
+        """Images sharing a perceptual hash are grouped, unless their embeddings tell them apart."""
+        for number, name in [(0, 'a'), (1, 'b'), (0, 'a2'), (2, 'c'), (3, 'd')]:
+            self.upload(self.pattern(number, brightness=len(name) * 10), f'{name}.png')
+        db.session.add_all([Image(filename=f'{i}.png', project_id=1, phash=phash)
+                            for i, phash in enumerate(['ff', 'ff', 'ee', None])])  # Not embedded yet
+        db.session.commit()
+        task_manager.run_pending('features')
+        response = self.client.get('/api/project/1/duplicates/?limit=1')
+        [group] = response.json['groups']
+        self.assertEqual(group['image_ids'], [1, 3])  # The horizontal and vertical gradients share a hash
+        self.assertEqual(self.client.get("/api/image/2/").json['phash'], group['phash'])
+        response = self.client.get(f"/api/project/1/duplicates/?after={response.json['next_cursor']}")
+        self.assertEqual(response.json, {'groups': [{'phash': 'ff', 'image_ids': [6, 7]}], 'next_cursor': None})
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_every_route_is_measured(self):
+        """A tiny run covers every API route without server errors and times queued jobs to completion."""
+        results = benchmark.run(users=6, projects_per_user=2, images_per_project=3, requests_per_route=4,
+                                concurrency=2, upload_requests=4, upload_concurrency=(2,), queue_jobs=2)
+        app = create_app(TestConfig)
+        routes = {rule.endpoint for rule in app.url_map.iter_rules() if rule.endpoint.startswith('api.')}
+        self.assertEqual(set(results['endpoints']), routes)
+        for endpoint, summary in results['endpoints'].items():
+            self.assertEqual(summary['errors'], 0, endpoint)
+            self.assertEqual(summary['requests'], 4)
+        self.assertEqual(results['uploads']['concurrency_2']['status_codes'], {'201': 4})
+        for kind in ('training', 'inference'):
+            self.assertEqual(results['queue'][kind]['outcomes'], {'done': 2})
+        json.dumps(results)
+
+    def test_compare_flags_regressions(self):
+        def result(p50, rps):
+            return {'endpoints': {'api.get_user': {'latency_ms': {'p50': p50}, 'throughput_rps': rps}}}
+
+        lines, regressions = benchmark.compare(result(10, 100), result(11, 95), threshold=0.2)
+        self.assertEqual(regressions, [])
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(benchmark.compare(result(10, 100), result(15, 100))[1], ['api.get_user'])
+        self.assertEqual(benchmark.compare(result(10, 100), result(10, 70))[1], ['api.get_user'])
+        self.assertEqual(benchmark.compare({}, result(10, 100))[0], ['api.get_user'.ljust(45) + ' new'])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,121 @@
+import hashlib
+import io
+import shutil
+import tempfile
+import unittest
+from app import create_app
+from extensions import db
+from config import TestConfig
+from models import Image, InferenceResult, Job, Project, TrainingResult, User
+from test_app import count_queries
+
+# Every endpoint's SQL is replayed through EXPLAIN QUERY PLAN; a plan step that
+# scans a whole table (rather than searching an index) fails the test.
+
+SEED_HASH = hashlib.sha256(b'seed').hexdigest()  # The blob uploaded by seed()
+
+
+def upload(*names):
+    return {'data': {'files' if len(names) > 1 else 'file': [(io.BytesIO(name.encode()), name) for name in names]},
+            'content_type': 'multipart/form-data'}
+
+
+ENDPOINTS = [
+    ('post', '/api/register/', {'json': {'username': 'new', 'password': 'pass'}}),
+    ('post', '/api/create_project/', {'json': {'username': 'owner', 'project_type': 'Image Classification'}}),
+    ('post', '/api/configure_training/1/', {'json': {'learning_rate': 0.01, 'epochs': 2, 'batch_size': 8}}),
+    ('post', '/api/upload_image/1/', upload('new.png')),
+    ('post', '/api/upload_image/1/', {'data': {'content_hash': SEED_HASH, 'filename': 'again.png'}}),
+    ('post', '/api/upload_images/1/', upload('a.png', 'b.png', 'c.png')),
+    ('get', f'/api/blobs/{SEED_HASH}/'),
+    ('get', f'/api/uploads/{SEED_HASH}'),
+    ('get', '/api/user/owner/'),
+    ('get', '/api/user/owner/projects/'),
+    ('get', '/api/project/1/'),
+    ('get', '/api/project/1/images/'),
+    ('get', '/api/project/1/images/?after=5&fields=image_id,label'),
+    ('get', '/api/project/1/training_results/'),
+    ('get', '/api/project/1/inference_results/'),
+    ('get', '/api/image/3/'),
+    ('put', '/api/image/3/label/', {'json': {'label': 'bird'}}),
+    ('get', '/api/analyze_project/1/'),
+    ('get', '/api/project/1/similar/?image_id=3'),
+    ('get', '/api/project/1/duplicates/'),
+    ('get', '/api/training_results/1/'),
+    ('get', '/api/inference_results/3/'),
+    ('post', '/api/enqueue_training/1/'),
+    ('post', '/api/enqueue_inference/1/3/'),
+    ('post', '/api/enqueue_inference_batch/1/', {'json': {'all': True}}),
+    ('get', '/api/jobs/1/'),
+    ('get', '/api/jobs/1/progress/'),
+    ('get', '/api/jobs/stats/'),
+    ('get', '/metrics'),
+    ('delete', '/api/delete_image/owner/1/4/'),
+    ('delete', '/api/delete_project/3/'),
+    ('delete', '/api/delete_user/other/'),  # Tombstones projects 2 and 4 with their images and jobs
+]
+
+
+def full_scans(plan_rows):
+    """Plan steps reading a whole table; SEARCH steps and index scans are fine."""
+    details = [row[-1] for row in plan_rows]
+    return [d for d in details if d.startswith('SCAN') and 'USING' not in d and 'CONSTANT ROW' not in d]
+
+
+class TestQueryPlans(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.upload_dir = tempfile.mkdtemp()
+        self.app.config['UPLOAD_FOLDER'] = self.upload_dir
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+        db.create_all()
+        self.seed()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.upload_dir)
+
+    def seed(self):
+        for name in ('owner', 'other'):
+            user = User(username=name)
+            user.set_password('pass')
+            db.session.add(user)
+        db.session.flush()
+        db.session.add_all([Project(user_id=1 + i % 2, project_type='Image Classification', name=f'p{i}')
+                            for i in range(4)])
+        db.session.flush()
+        self.client.post('/api/upload_image/1/', data={
+            'file': (io.BytesIO(b'seed'), 'seed.png')
+        }, content_type='multipart/form-data')
+        db.session.add_all([Image(filename=f'{i}.png', label='cat' if i % 2 else 'dog', feature_size=float(i),
+                                  phash=f'{i % 5:016x}', project_id=1 + i % 4) for i in range(40)])
+        db.session.add_all([TrainingResult(project_id=1 + i % 4, accuracy=0.5, loss=0.5) for i in range(8)])
+        db.session.add_all([InferenceResult(image_id=1 + i % 40, result='cat') for i in range(80)])
+        # A job history, so ANALYZE does not judge a one-row job table cheaper to scan
+        db.session.add_all([Job(kind=('training', 'inference', 'features')[i % 3], project_id=1 + i % 4,
+                                user_id=1 + i % 2, status='done') for i in range(40)])
+        db.session.commit()
+        db.session.execute(db.text('ANALYZE'))
+
+    def test_every_endpoint_uses_indexes(self):
+        for method, url, *options in ENDPOINTS:
+            with self.subTest(url=url):
+                with count_queries(with_parameters=True) as statements:
+                    response = getattr(self.client, method)(url, **(options[0] if options else {}))
+                self.assertLess(response.status_code, 500)
+                self.assertLessEqual(len(statements), 12, 'query count should not grow with data')
+                connection = db.session.connection()
+                for statement, parameters in statements:
+                    if not statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+                        continue
+                    plan = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+                    self.assertEqual(full_scans(plan), [], statement)
+
+
+if __name__ == '__main__':
+    unittest.main()
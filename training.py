@@ -0,0 +1,280 @@
+import logging
+import os
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import func, or_
+from models import Image, TrainingConfig, TrainingResult, db
+import dataloader
+from dataloader import np
+
+logger = logging.getLogger(__name__)
+
+# Training engine. A backend fits a model to batches from a dataloader.BatchLoader
+# using the project's TrainingConfig (learning_rate, epochs, batch_size) and
+# returns it with its final-epoch loss and accuracy. Backends are registered by
+# name and picked with TRAINING_BACKEND; trained models are saved as .npz files
+# under MODEL_FOLDER and referenced by TrainingResult.model_path.
+#
+# Training is incremental where it can be: when the project's latest result was
+# trained with the same settings, only images uploaded or relabeled since its
+# snapshot are trained on, starting from its weights. A settings change, or a
+# delta too large a share of the project, retrains from scratch.
+
+BACKENDS = {}
+DEFAULT_SETTINGS = {'learning_rate': 0.001, 'epochs': 10, 'batch_size': 32}  # TrainingConfig's column defaults
+# Snapshots are dated this much early, so a relabel committed while one was read is trained on next time
+SNAPSHOT_SLACK = timedelta(minutes=1)
+
+
+def register_backend(name):
+    def decorator(cls):
+        cls.name = name
+        BACKENDS[name] = cls
+        return cls
+    return decorator
+
+
+def get_backend(name):
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise ValueError(f'Unknown training backend {name!r}') from None
+
+
+class TrainingBackend:
+    """Interface of training backends."""
+
+    name = None
+
+    def fit(self, loader, num_classes, settings, on_epoch=None, init=None):
+        """Train on ``loader``; returns ``(model, {'loss': ..., 'accuracy': ...})``.
+
+        ``on_epoch``, when given, is called after every epoch with a dict of
+        ``epoch`` (1-based), ``loss``, ``accuracy``, ``images`` and ``seconds``.
+        ``init``, when given, is a model this backend returned earlier for the
+        first classes; training continues from it without modifying it.
+        """
+        raise NotImplementedError
+
+    def load(self, arrays):
+        """Rebuild a model from the arrays its ``arrays()`` method saved."""
+        raise NotImplementedError
+
+
+class SoftmaxModel:
+    """Multinomial logistic regression over flattened pixels."""
+
+    def __init__(self, weights, bias):
+        self.weights = weights
+        self.bias = bias
+
+    @property
+    def nbytes(self):
+        return self.weights.nbytes + self.bias.nbytes
+
+    def scores(self, pixels):
+        logits = pixels @ self.weights + self.bias
+        logits -= logits.max(axis=1, keepdims=True)
+        exp = np.exp(logits)
+        return exp / exp.sum(axis=1, keepdims=True)
+
+    def predict(self, pixels):
+        return (pixels @ self.weights + self.bias).argmax(axis=1)
+
+    def arrays(self):
+        return {'weights': self.weights, 'bias': self.bias}
+
+
+@register_backend('numpy')
+class NumpySoftmaxBackend(TrainingBackend):
+    """CPU baseline: softmax regression trained by mini-batch gradient descent, vectorized per batch.
+
+    Weights start at zero, or at ``init``'s with zeros for classes it lacks,
+    and batches come in seeded order, so the same data and settings always
+    give the same model.
+    """
+
+    def fit(self, loader, num_classes, settings, on_epoch=None, init=None):
+        model = SoftmaxModel(np.zeros((loader.num_features, num_classes), dtype=np.float32),
+                             np.zeros(num_classes, dtype=np.float32))
+        if init is not None:
+            known = len(init.bias)
+            model.weights[:, :known] = init.weights
+            model.bias[:known] = init.bias
+        learning_rate = np.float32(settings['learning_rate'])
+        metrics = {'loss': None, 'accuracy': None}
+        for epoch in range(1, settings['epochs'] + 1):
+            started = time.perf_counter()
+            total_loss, correct, seen = 0.0, 0, 0
+            for pixels, targets, _rows in loader:
+                n = len(targets)
+                probs = model.scores(pixels)
+                picked = np.arange(n)
+                total_loss += float(-np.log(probs[picked, targets] + 1e-12).sum())
+                correct += int((probs.argmax(axis=1) == targets).sum())
+                seen += n
+                probs[picked, targets] -= 1  # d(cross-entropy)/d(logits)
+                probs /= n
+                model.weights -= learning_rate * (pixels.T @ probs)
+                model.bias -= learning_rate * probs.sum(axis=0)
+            if seen:
+                metrics = {'loss': total_loss / seen, 'accuracy': correct / seen}
+            if on_epoch is not None:
+                on_epoch(dict(metrics, epoch=epoch, images=seen, seconds=time.perf_counter() - started))
+        return model, metrics
+
+    def load(self, arrays):
+        return SoftmaxModel(arrays['weights'], arrays['bias'])
+
+
+class Classifier:
+    """A trained model with its label names, predicting labels for Image rows."""
+
+    def __init__(self, model, classes, image_size, backend):
+        self.model = model
+        self.classes = list(classes)
+        self.image_size = image_size
+        self.backend = backend
+
+    @property
+    def nbytes(self):
+        return self.model.nbytes
+
+    def predict(self, images):
+        """One label per image; None for files that can't be decoded."""
+        loader = dataloader.BatchLoader(current_app.config['UPLOAD_FOLDER'], images, len(images) or 1,
+                                        self.image_size, processes=current_app.config.get('LOADER_PROCESSES', 0))
+        labels = {}
+        for pixels, _targets, rows in loader:
+            for row, index in zip(rows, self.model.predict(pixels)):
+                labels[row.id] = self.classes[index]
+        return [labels.get(image.id) for image in images]
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.model-')
+        with os.fdopen(fd, 'wb') as out:
+            np.savez(out, backend=self.backend, classes=np.array(self.classes), image_size=self.image_size,
+                     **self.model.arrays())
+        os.replace(tmp_path, path)
+
+
+def load_classifier(path):
+    with np.load(path) as data:
+        arrays = {key: data[key] for key in data.files}
+    backend = get_backend(str(arrays.pop('backend')))
+    classes = [str(c) for c in arrays.pop('classes')]
+    image_size = int(arrays.pop('image_size'))
+    return Classifier(backend.load(arrays), classes, image_size, backend.name)
+
+
+def training_settings(project_id):
+    config = db.session.query(TrainingConfig).filter_by(project_id=project_id).first()
+    if config is None:
+        return dict(DEFAULT_SETTINGS)
+    return {'learning_rate': config.learning_rate, 'epochs': config.epochs, 'batch_size': config.batch_size}
+
+
+def model_settings(settings):
+    """``settings`` plus the other choices a model's weights depend on, as kept in TrainingResult.settings."""
+    config = current_app.config
+    return dict(settings, backend=config.get('TRAINING_BACKEND', 'numpy'),
+                image_size=config.get('TRAINING_IMAGE_SIZE', 16))
+
+
+def training_base(project_id, settings):
+    """The project's latest result as a row, if its model can be fine-tuned with ``settings``; else None.
+
+    Results saved without a model, before watermarks were recorded or with
+    other ``model_settings`` call for a full retrain, as does
+    INCREMENTAL_TRAINING = False.
+    """
+    if not current_app.config.get('INCREMENTAL_TRAINING', True):
+        return None
+    base = (db.session.query(TrainingResult.id, TrainingResult.accuracy, TrainingResult.loss,
+                             TrainingResult.model_path, TrainingResult.settings, TrainingResult.last_image_id,
+                             TrainingResult.snapshot_at)
+            .filter(TrainingResult.project_id == project_id).order_by(TrainingResult.id.desc()).first())
+    if base is None or base.model_path is None or base.last_image_id is None:
+        return None
+    return base if base.settings == model_settings(settings) else None
+
+
+def labeled_images(project_id, base=None):
+    """The project's labeled images in id order; with ``base``, only those uploaded or relabeled since it."""
+    query = (db.session.query(Image.id, Image.filename, Image.content_hash, Image.label)
+             .filter(Image.project_id == project_id, Image.label.is_not(None), Image.label != ''))
+    if base is not None:
+        query = query.filter(or_(Image.id > base.last_image_id, Image.labeled_at >= base.snapshot_at))
+    return query.order_by(Image.id).all()
+
+
+def train_project(project_id, on_epoch=None, settings=None, base=None, checkpoint=None):
+    """Train the configured backend on the project's labeled images; returns TrainingResult column values.
+
+    ``settings`` default to the project's current TrainingConfig. Given
+    ``base`` from ``training_base`` and ``checkpoint``, its loaded Classifier,
+    only images uploaded or relabeled since ``base`` are trained on, starting
+    from the checkpoint, unless they are over INCREMENTAL_MAX_FRACTION of the
+    labeled images; without any, ``base``'s model is kept. Projects without
+    any decodable labeled image get a result without a model. ``on_epoch`` is
+    passed to the backend's ``fit`` along with the settings used.
+    """
+    dataloader.require()
+    config = current_app.config
+    settings = settings or training_settings(project_id)
+    if checkpoint is None:
+        base = None
+    snapshot_at = datetime.utcnow() - SNAPSHOT_SLACK
+    rows = labeled_images(project_id, base)
+    if base is not None and rows:
+        total = (db.session.query(func.count(Image.id))
+                 .filter(Image.project_id == project_id, Image.label.is_not(None), Image.label != '').scalar())
+        if len(rows) > config.get('INCREMENTAL_MAX_FRACTION', 0.5) * total:
+            base = None  # A full retrain costs about as much, and forgets deleted images
+            rows = labeled_images(project_id)
+    db.session.rollback()  # Don't hold a read transaction open for the whole run
+    result = {'project_id': project_id, 'settings': model_settings(settings), 'snapshot_at': snapshot_at,
+              'base_id': None if base is None else base.id, 'images': len(rows)}
+    kept = None if base is None else dict(result, accuracy=base.accuracy, loss=base.loss, model_path=base.model_path,
+                                          last_image_id=base.last_image_id)
+    if base is not None and not rows:
+        logger.info("Project %s has no new or relabeled images; keeping the model of result %s", project_id, base.id)
+        return kept
+
+    classes = sorted({row.label for row in rows})
+    if base is not None:  # The checkpoint's classes keep their places; new ones are appended
+        classes = checkpoint.classes + [label for label in classes if label not in checkpoint.classes]
+    index = {label: i for i, label in enumerate(classes)}
+    image_size = config.get('TRAINING_IMAGE_SIZE', 16)
+    cache_folder = config.get('DECODED_CACHE_FOLDER')
+    # Deltas get a cache of their own, so fine-tuning doesn't rewrite the whole project's
+    cache_name = f's{image_size}' if base is None else f's{image_size}-delta'
+    loader = dataloader.BatchLoader(config['UPLOAD_FOLDER'], rows, settings['batch_size'], image_size,
+                                    targets=[index[row.label] for row in rows], shuffle=True,
+                                    seed=config.get('TRAINING_SEED', 0),
+                                    processes=config.get('LOADER_PROCESSES', 0),
+                                    prefetch=config.get('LOADER_PREFETCH', 2),
+                                    cache_prefix=cache_folder and os.path.join(cache_folder, str(project_id),
+                                                                               cache_name))
+    backend = get_backend(config.get('TRAINING_BACKEND', 'numpy'))
+    started = time.perf_counter()
+    resume = {} if base is None else {'init': checkpoint.model}  # Backends that never fine-tune needn't take init
+    model, metrics = backend.fit(loader, len(classes), settings,
+                                 on_epoch and (lambda progress: on_epoch(progress, settings)), **resume)
+    elapsed = time.perf_counter() - started
+    seen = len(rows) * settings['epochs'] - loader.skipped
+    logger.info("Trained project %s with %s%s: %d images x %d epochs in %.2fs (%.0f images/s)",
+                project_id, backend.name, f' from result {base.id}' if base is not None else '',
+                len(rows), settings['epochs'], elapsed, seen / elapsed if elapsed else 0)
+
+    if metrics['accuracy'] is None:
+        return kept or dict(result, accuracy=None, loss=metrics['loss'], model_path=None, last_image_id=None)
+    model_path = os.path.join(config.get('MODEL_FOLDER', 'models'), str(project_id), f'{uuid.uuid4().hex}.npz')
+    Classifier(model, classes, loader.image_size, backend.name).save(model_path)
+    last_image_id = max(rows[-1].id, base.last_image_id) if base is not None else rows[-1].id
+    return dict(result, accuracy=metrics['accuracy'], loss=metrics['loss'], model_path=model_path,
+                last_image_id=last_image_id)
@@ -0,0 +1,372 @@
+import json
+import os
+import shutil
+import threading
+import uuid
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import select
+from models import Image, db
+
+try:
+    import numpy as np
+except ImportError:  # Similarity search needs NumPy; the rest of the API doesn't
+    np = None
+
+# Per-project nearest-neighbor index over image embeddings (features.embed).
+#
+# The embeddings live in the database; the index is derived from them and kept
+# under INDEX_FOLDER/<project_id>/ as segments, each a directory of .npy files
+# opened memory-mapped: ids (n,), vectors (n, dims) and, for projects of at
+# least VECTOR_INDEX_IVF_MIN images, an inverted-file (IVF) coarse quantizer --
+# k-means centroids with the vectors grouped by nearest centroid, so a query
+# only scans the VECTOR_INDEX_NPROBE closest lists. current.json names the
+# project's main segment and a small flat delta segment of images embedded
+# since; an 'index' job rebuilds the delta after every feature extraction and
+# the main segment once the delta outgrows VECTOR_INDEX_DELTA_FRACTION of it.
+#
+# Coverage follows Image.embedded_at, not ids: backfills and retried feature
+# jobs embed old ids late, and re-extraction replaces vectors. A segment keeps
+# the embedded_at of every vector it holds and the time it covers embeddings
+# up to; the delta takes what main doesn't hold at that version, and embeddings
+# newer than both are scanned straight from the database, superseding the
+# segments' copies. Deleted images are filtered out of the results, so answers
+# are never stale.
+
+CHUNK_SIZE = 10000  # Embeddings read from the database per query
+KMEANS_ITERATIONS = 8
+KMEANS_SAMPLE_PER_LIST = 64  # Training vectors per centroid
+# Segments cover embeddings this much older than their build, so one committed while it was read is picked up next
+EMBEDDED_SLACK = timedelta(minutes=1)
+EPOCH = datetime(1970, 1, 1)
+
+_segments = {}  # Project folder -> {segment name: Segment}, shared by the threads of this process
+_segments_lock = threading.Lock()
+
+
+def require():
+    if np is None:
+        raise RuntimeError('Similarity search needs NumPy')
+
+
+def project_folder(project_id):
+    return os.path.join(current_app.config.get('INDEX_FOLDER', 'index'), str(project_id))
+
+
+class Segment:
+    """One built set of vectors, memory-mapped read-only."""
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.ids = np.load(os.path.join(path, 'ids.npy'), mmap_mode='r')
+        self.vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')[:len(self.ids)]
+        self.centroids = self.offsets = None
+        if self.meta['lists']:
+            self.centroids = np.load(os.path.join(path, 'centroids.npy'))
+            self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        self.versions = None  # Segments written before embedded_at was tracked have neither these nor covered_to
+        if 'covered_to' in self.meta:
+            self.versions = np.load(os.path.join(path, 'versions.npy'), mmap_mode='r')
+        self._lookup = None
+
+    @property
+    def covered_to(self):
+        """Every embedding written before this is in the segment, or was written after it and is newer."""
+        return datetime.fromisoformat(self.meta['covered_to']) if self.versions is not None else None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def holds(self, ids, versions):
+        """Mask of the (id, version) pairs this segment has the vector for."""
+        if self._lookup is None:
+            order = np.argsort(self.ids, kind='stable')
+            self._lookup = (np.asarray(self.ids[order]), np.asarray(self.versions[order]))
+        sorted_ids, sorted_versions = self._lookup
+        if not len(sorted_ids):
+            return np.zeros(len(ids), dtype=bool)
+        at = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+        return (sorted_ids[at] == ids) & (sorted_versions[at] == versions)
+
+    def search(self, query, k, nprobe):
+        """The ``k`` best (ids, scores) by dot product, scanning the ``nprobe`` nearest lists of an IVF segment."""
+        if self.centroids is None:
+            return _top(self.ids, self.vectors @ query, k)
+        lists = _top_indices(self.centroids @ query, nprobe)
+        ids, scores = [], []
+        for i in lists:
+            rows = slice(self.offsets[i], self.offsets[i + 1])
+            ids.append(self.ids[rows])
+            scores.append(self.vectors[rows] @ query)
+        return _top(np.concatenate(ids), np.concatenate(scores), k)
+
+
+def _top_indices(scores, k):
+    if k >= len(scores):
+        return np.argsort(-scores, kind='stable')
+    best = np.argpartition(-scores, k - 1)[:k]
+    return best[np.argsort(-scores[best], kind='stable')]
+
+
+def _top(ids, scores, k):
+    best = _top_indices(scores, k)
+    return np.asarray(ids[best], dtype=np.int64), np.asarray(scores[best], dtype=np.float32)
+
+
+def _names(folder):
+    try:
+        with open(os.path.join(folder, 'current.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'main': None, 'delta': None}
+
+
+def current(project_id):
+    """The project's (main, delta) segments, each None when not built."""
+    folder = project_folder(project_id)
+    for attempt in range(3):
+        names = _names(folder)
+        try:
+            return tuple(_open_segment(folder, names[part]) if names.get(part) else None
+                         for part in ('main', 'delta'))
+        except FileNotFoundError:  # Superseded by a rebuild in the meantime
+            if attempt == 2:
+                raise
+
+
+def _open_segment(folder, name):
+    with _segments_lock:
+        opened = _segments.setdefault(folder, {})
+        segment = opened.get(name)
+        if segment is None:
+            segment = Segment(os.path.join(folder, name))
+            # A new segment means a rebuild; forget the ones it superseded
+            for stale in [other for other in opened if not os.path.isdir(os.path.join(folder, other))]:
+                del opened[stale]
+            opened[name] = segment
+        return segment
+
+
+def _version(embedded_at):
+    """embedded_at as integer microseconds, 0 for embeddings written before it was tracked."""
+    return 0 if embedded_at is None else (embedded_at - EPOCH) // timedelta(microseconds=1)
+
+
+def _embedded_filter(project_id, since=None):
+    where = [Image.project_id == project_id, Image.embedding.is_not(None)]
+    if since is not None:
+        where.append(Image.embedded_at >= since)
+    return where
+
+
+def _embedded(project_id, since=None):
+    """Yield (ids, versions, vectors) chunks, in id order, of the project's images embedded from ``since`` on.
+
+    With ``since`` None, every embedded image.
+    """
+    after_id = 0
+    while True:
+        rows = db.session.execute(
+            select(Image.id, Image.embedded_at, Image.embedding)
+            .where(Image.id > after_id, *_embedded_filter(project_id, since))
+            .order_by(Image.id).limit(CHUNK_SIZE)).all()
+        if not rows:
+            return
+        after_id = rows[-1].id
+        yield (np.fromiter((row.id for row in rows), dtype=np.int64, count=len(rows)),
+               np.fromiter((_version(row.embedded_at) for row in rows), dtype=np.int64, count=len(rows)),
+               np.frombuffer(b''.join(row.embedding for row in rows), dtype=np.float32).reshape(len(rows), -1))
+
+
+def search(project_id, query, k=10, exclude_ids=(), nprobe=None):
+    """The ``k`` images of the project whose embeddings are closest to ``query``, as (image_id, score) pairs.
+
+    Scores are cosine similarities, best first; ``exclude_ids`` (say, the
+    query image itself) and deleted images are left out.
+    """
+    require()
+    query = np.frombuffer(query, dtype=np.float32) if isinstance(query, bytes) else query
+    nprobe = nprobe or current_app.config.get('VECTOR_INDEX_NPROBE', 8)
+    fetch = 2 * k + 10 + len(exclude_ids)  # Room for deleted and excluded images
+    main, delta = current(project_id)
+    segments = [segment for segment in (main, delta) if segment is not None]
+    # The live scan starts where the newest segment's coverage ends; before any segment, or with one
+    # written before coverage was tracked, it has to read everything
+    since = segments[-1].covered_to if segments and all(s.covered_to for s in segments) else None
+    ids, scores, newer = [], [], []
+    for chunk_ids, _versions, vectors in _embedded(project_id, since):
+        found = _top(chunk_ids, vectors @ query, fetch)
+        ids.append(found[0])
+        scores.append(found[1])
+        newer.append(chunk_ids)
+    for segment in reversed(segments):  # Delta, then main: each loses the images a newer source re-embedded
+        superseded = np.concatenate(newer) if newer else np.empty(0, dtype=np.int64)
+        if len(segment):
+            found_ids, found_scores = segment.search(query, fetch + len(superseded), nprobe)
+            kept = ~np.isin(found_ids, superseded)
+            ids.append(found_ids[kept][:fetch])
+            scores.append(found_scores[kept][:fetch])
+        newer.append(np.asarray(segment.ids))
+    if not ids:
+        return []
+    ids, scores = _top(np.concatenate(ids), np.concatenate(scores), fetch)
+    live = set(db.session.scalars(select(Image.id).where(Image.project_id == project_id,
+                                                         Image.id.in_([int(i) for i in ids]))))
+    excluded = set(exclude_ids)
+    return [(int(i), float(score)) for i, score in zip(ids, scores)
+            if int(i) in live and int(i) not in excluded][:k]
+
+
+def status(project_id):
+    """Images in the main and delta segments, and IVF lists of the main one."""
+    main, delta = current(project_id) if np is not None else (None, None)
+    replaced = int(np.isin(delta.ids, main.ids).sum()) if delta is not None else 0  # Re-embedded since main
+    return {'indexed': sum(len(segment) for segment in (main, delta) if segment is not None) - replaced,
+            'ivf_lists': main.meta['lists'] if main is not None else 0}
+
+
+def train_centroids(sample, lists, rng, iterations=KMEANS_ITERATIONS):
+    """Spherical k-means: ``lists`` unit centroids of the rows of ``sample``."""
+    centroids = sample[rng.choice(len(sample), lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = nearest(sample, centroids)
+        counts = np.bincount(assignment, minlength=lists)
+        order = np.argsort(assignment, kind='stable')
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        used = counts > 0
+        sums = np.zeros_like(centroids)
+        sums[used] = np.add.reduceat(sample[order], starts[used], axis=0)
+        sums[~used] = sample[rng.choice(len(sample), int((~used).sum()))]  # Reseed empty lists
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids = sums / np.where(norms > 0, norms, 1)
+    return centroids.astype(np.float32)
+
+
+def nearest(vectors, centroids, chunk_size=8192):
+    """Index of the closest centroid for every row, in bounded chunks."""
+    out = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), chunk_size):
+        out[start:start + chunk_size] = np.argmax(vectors[start:start + chunk_size] @ centroids.T, axis=1)
+    return out
+
+
+def build_segment(folder, project_id, since=None, held=None, ivf_min=None, lists=None, seed=0):
+    """Write a segment of the project's embeddings from ``since`` on (all with None), leaving out those the
+    ``held`` segment already has; returns its directory name, or None if empty."""
+    covered_to = datetime.utcnow() - EMBEDDED_SLACK
+    total = (db.session.query(db.func.count(Image.id)).filter(*_embedded_filter(project_id, since)).scalar())
+    if not total:
+        return None
+    name = uuid.uuid4().hex
+    path = os.path.join(folder, name)
+    os.makedirs(path)
+    ids = np.empty(total, dtype=np.int64)
+    versions = np.empty(total, dtype=np.int64)
+    raw, dims, count = None, 0, 0
+    for chunk_ids, chunk_versions, vectors in _embedded(project_id, since):
+        if held is not None:
+            new = ~held.holds(chunk_ids, chunk_versions)
+            chunk_ids, chunk_versions, vectors = chunk_ids[new], chunk_versions[new], vectors[new]
+        # Rows embedded since counting are left to the next build
+        chunk_ids, chunk_versions, vectors = (chunk_ids[:total - count], chunk_versions[:total - count],
+                                              vectors[:total - count])
+        if not len(chunk_ids):
+            continue
+        if raw is None:
+            dims = vectors.shape[1]
+            raw = np.lib.format.open_memmap(os.path.join(path, 'raw.npy'), 'w+', np.float32, (total, dims))
+        ids[count:count + len(chunk_ids)] = chunk_ids
+        versions[count:count + len(chunk_ids)] = chunk_versions
+        raw[count:count + len(chunk_ids)] = vectors
+        count += len(chunk_ids)
+        if count == total:
+            break
+    db.session.rollback()  # End the read transaction; the rest is NumPy and files
+    if not count:  # Deleted since counting, or all held already
+        del raw
+        shutil.rmtree(path)
+        return None
+    # A flat segment keeps the unused tail of raw.npy; Segment skips it
+    ids, versions, raw = ids[:count], versions[:count], raw[:count]
+
+    lists = 0 if ivf_min is None or count < ivf_min else min(lists or int(np.sqrt(count)), count)
+    if lists:
+        rng = np.random.default_rng(seed)
+        sample = raw[np.sort(rng.choice(count, min(count, lists * KMEANS_SAMPLE_PER_LIST), replace=False))]
+        centroids = train_centroids(np.asarray(sample), lists, rng)
+        assignment = nearest(raw, centroids)
+        order = np.argsort(assignment, kind='stable')
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(assignment, minlength=lists)))).astype(np.int64)
+        np.save(os.path.join(path, 'centroids.npy'), centroids)
+        np.save(os.path.join(path, 'offsets.npy'), offsets)
+        ids, versions = ids[order], versions[order]
+        vectors = np.lib.format.open_memmap(os.path.join(path, 'vectors.npy'), 'w+', np.float32, (count, dims))
+        for start in range(0, count, CHUNK_SIZE):
+            vectors[start:start + CHUNK_SIZE] = raw[order[start:start + CHUNK_SIZE]]
+        vectors.flush()
+        del vectors, raw
+        os.remove(os.path.join(path, 'raw.npy'))
+    else:
+        raw.flush()
+        del raw
+        os.replace(os.path.join(path, 'raw.npy'), os.path.join(path, 'vectors.npy'))
+    np.save(os.path.join(path, 'ids.npy'), ids)
+    np.save(os.path.join(path, 'versions.npy'), versions)
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'count': int(count), 'dims': int(dims), 'lists': int(lists),
+                   'covered_to': covered_to.isoformat()}, f)
+    return name
+
+
+def rebuild(project_id):
+    """Bring the project's index up to date with its embeddings; returns what was rebuilt.
+
+    Only the delta segment is rewritten while the embeddings main doesn't
+    hold stay under VECTOR_INDEX_DELTA_FRACTION of it; otherwise, or with no
+    main segment yet, everything is rebuilt into a new main segment.
+    """
+    require()
+    config = current_app.config
+    folder = project_folder(project_id)
+    os.makedirs(folder, exist_ok=True)
+    names = _names(folder)
+    main = current(project_id)[0]
+    full = main is None or main.covered_to is None
+    if not full:
+        rows = db.session.execute(select(Image.id, Image.embedded_at)
+                                  .where(*_embedded_filter(project_id, main.covered_to))).all()
+        fresh = len(rows) - int(main.holds(np.array([row.id for row in rows], dtype=np.int64),
+                                           np.array([_version(row.embedded_at) for row in rows], dtype=np.int64)).sum())
+        full = fresh > max(config.get('VECTOR_INDEX_DELTA_MIN', 1000),
+                           config.get('VECTOR_INDEX_DELTA_FRACTION', 0.05) * len(main))
+    if full:
+        names = {'main': build_segment(folder, project_id, ivf_min=config.get('VECTOR_INDEX_IVF_MIN', 20000),
+                                       lists=config.get('VECTOR_INDEX_LISTS'),
+                                       seed=config.get('VECTOR_INDEX_SEED', 0)),
+                 'delta': None}
+    else:
+        names = {'main': names['main'], 'delta': build_segment(folder, project_id, main.covered_to, main)}
+    tmp = os.path.join(folder, f'current-{uuid.uuid4().hex}.json')
+    with open(tmp, 'w') as f:
+        json.dump(names, f)
+    os.replace(tmp, os.path.join(folder, 'current.json'))
+    _remove_unused(folder, names)
+    return 'main' if full else 'delta'
+
+
+def _remove_unused(folder, names):
+    """Delete superseded segments; processes still searching them keep their open memory maps."""
+    keep = {name for name in names.values() if name}
+    for entry in os.scandir(folder):
+        if entry.is_dir() and entry.name not in keep:
+            shutil.rmtree(entry.path, ignore_errors=True)
+            with _segments_lock:
+                _segments.get(folder, {}).pop(entry.name, None)
+
+
+def remove(project_id):
+    folder = project_folder(project_id)
+    shutil.rmtree(folder, ignore_errors=True)
+    with _segments_lock:
+        _segments.pop(folder, None)